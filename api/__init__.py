@@ -4,7 +4,7 @@ from datetime import datetime
 from functools import wraps
 
 import werkzeug
-from flask import Response, json, jsonify, redirect, request
+from flask import Response, g, json, jsonify, redirect, request
 from flask_caching import Cache
 from flask_login import current_user, login_required, login_user, logout_user
 from flask_mail import Mail, Message
@@ -12,7 +12,9 @@ from werkzeug.exceptions import HTTPException
 
 from api.query_helper import mongo_to_dict_helper
 from api.user.models import User, user_loader
+from api.user.token_cache import UserPrincipal
 
+from .api_metrics import init_metrics
 from .api_redis import init_redis
 from .print_helper import *
 
@@ -195,6 +197,17 @@ def api_get_token_from_request():
     return token
 
 
+def api_set_request_user(user):
+    """ current_user is this user until the end of the request.
+        We don't touch the session, so there are no cookies or user_loader lookups for API keys.
+
+        login_user() would write the session, and a request_loader never runs when the session
+        already has a user, but the key has to replace it. So we write g._login_user, which is
+        the private storage of current_user in flask_login. It is pinned on requirements.txt.
+    """
+    g._login_user = user
+
+
 def admin_login_required(func):
     """
     Decorator for views that checks that the api call is in there, redirecting
@@ -257,22 +270,11 @@ def api_key_or_login_required(func):
                     "no_std": True
                 })
 
-            user = User.verify_auth_token(token)
-            if isinstance(user, User) and user.active:
-                print("\n------------ API LOGIN --------------")
-
-                # The user might be already logged in
-                if current_user.is_authenticated:
-                    # We logout the user if the key belongs to a different user.
-                    if current_user.username != user.username:
-                        logout_user()
-
-                # We login this user normally
-                login_user(user, remember=True)
-
-                ret = func(*args, **kwargs)
-                logout_user()
-                return ret
+            user = User.verify_auth_token_cached(token)
+            if isinstance(user, UserPrincipal) and user.active:
+                # The key is the identity of this request, there is no session to login or logout
+                api_set_request_user(user)
+                return func(*args, **kwargs)
 
         except HTTPException as errh:
             # A function might use Abort to exit, this will generate a
@@ -306,16 +308,10 @@ def api_key_login_or_anonymous(func):
             if not token:
                 return func(*args, **kwargs)
 
-            user = User.verify_auth_token(token)
-            if isinstance(user, User) and user.active:
-                if current_user.is_authenticated:
-                    # Relogin the user if the key belongs to a different one
-                    if current_user.username != user.username:
-                        logout_user()
-                        login_user(user, remember=True)
-
-                else:
-                    login_user(user, remember=True)
+            user = User.verify_auth_token_cached(token)
+            if isinstance(user, UserPrincipal) and user.active:
+                # The key replaces any user logged in on the session, only for this request
+                api_set_request_user(user)
 
             return func(*args, **kwargs)
 
@@ -386,43 +382,89 @@ def handle_bad_request_with_html(e):
     return render_template('errors/page_{}.html'.format(e.code)), e.code
 
 
+API_BLUEPRINTS = (
+    'ai',
+    'gif',
+    'user',
+    'news',
+    'jobs',
+    'admin',
+    'media',
+    'actors',
+    'ticker',
+    'events',
+    'people',
+    'content',
+    'company',
+    'prompts',
+    'payment',
+    'channels',
+    'comments',
+    'galleries',
+    'hello_world',
+)
+
+
+def get_enabled_blueprints(app):
+    """ API_BLUEPRINTS on the config or IMGAPI_BLUEPRINTS=media,user on the environment.
+        A deployment that only serves media doesn't need to load the finance modules.
+    """
+
+    enabled = os.environ.get("IMGAPI_BLUEPRINTS") or app.config.get("API_BLUEPRINTS")
+    if not enabled:
+        return API_BLUEPRINTS
+
+    if isinstance(enabled, str):
+        enabled = [name.strip() for name in enabled.split(",")]
+
+    for module_name in enabled:
+        if module_name not in API_BLUEPRINTS:
+            print_r(" UNKNOWN BLUEPRINT " + module_name)
+
+    return [module_name for module_name in API_BLUEPRINTS if module_name in enabled]
+
+
+def print_import_profile(profile):
+    """ Slowest blueprints first, the memory is the growth of the peak RSS while importing it """
+
+    total = sum(entry['ms'] for entry in profile)
+    print_b(" API BLUEPRINTS %d loaded in %.0f ms " % (len(profile), total))
+
+    for entry in sorted(profile, key=lambda x: x['ms'], reverse=True):
+        print_b("%-12s %8.1f ms %6d modules %8.1f MB" % (entry['module'], entry['ms'], entry['modules'], entry['mb']))
+
+
 def register_api_blueprints(app):
     """ Loads all the modules for the API """
+    import resource
+    import sys
     from importlib import import_module
 
     from api.news import configure_news_media_folder
     global cache
 
-    #print_b(" API BLUE PRINTS ")
-    for module_name in (
-            'ai',
-            'gif',
-            'user',
-            'news',
-            'jobs',
-            'admin',
-            'media',
-            'actors',
-            'ticker',
-            'events',
-            'people',
-            'content',
-            'company',
-            'prompts',
-            'payment',
-            'channels',
-            'comments',
-            'galleries',
-            'hello_world',
-    ):
+    profile = []
+    for module_name in get_enabled_blueprints(app):
+        start = time.perf_counter()
+        modules = len(sys.modules)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
         module = import_module('api.{}.routes'.format(module_name))
         app.register_blueprint(module.blueprint)
 
-        #print(" Registering API " + str(module_name))
+        profile.append({
+            'module': module_name,
+            'ms': (time.perf_counter() - start) * 1000,
+            'modules': len(sys.modules) - modules,
+            'mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) / 1024,
+        })
+
+    print_import_profile(profile)
 
     configure_media_folder(app)
     configure_news_media_folder(app)
     init_redis(app)
+    init_metrics(app)
 
     # Cache
     cache.init_app(app)
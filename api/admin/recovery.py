@@ -0,0 +1,374 @@
+"""
+    Disaster recovery, finds the media on disk which is not on the database and indexes it again.
+
+    We load every file_path we know into a set, scan the user folders and compute the orphans in memory.
+    Orphans are probed on a pool of threads and inserted in batches.
+
+    Progress is written into a checkpoint file after every user folder, if the recovery stops
+    the next call continues after the last folder that was finished.
+
+    The blob storage is scanned after the user folders. A blob keeps a hard link on the folder of its
+    owner, so the user scan recovers it. A blob that no media uses anymore has no owner we can find,
+    it is indexed as private media of REINDEX_BLOB_OWNER so an admin can review it.
+"""
+
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+
+import ffmpeg
+from api.config import get_config_value
+from api.media.models import DB_MediaBlob, File_Tracking
+from api.print_helper import *
+
+RECOVERY_BATCH_SIZE = 200
+RECOVERY_MAX_WORKERS = 8
+RECOVERY_CHECKPOINT = ".REINDEX_CHECKPOINT.json"
+
+# Folders on the media path which don't belong to an user, the blobs are scanned on their own
+RECOVERY_SKIP_FOLDERS = ['oinktv', DB_MediaBlob.BLOB_FOLDER[:-1]]
+
+# Owner of the blobs that nobody references
+RECOVERY_BLOB_OWNER = "admin"
+
+
+def recovery_get_known_paths():
+    """ Streams the paths of every media on the database into a set """
+
+    known = set()
+
+    fields = {'_id': 0, 'file_path': 1, 'username': 1, 'checksum_md5': 1, 'file_format': 1}
+    for item in File_Tracking._get_collection().find({}, fields, batch_size=5000):
+        file_path = item.get('file_path')
+        if not file_path:
+            continue
+
+        known.add(file_path)
+
+        # Media moved into the blob storage keeps a hard link on its legacy location
+        if DB_MediaBlob.is_blob_path(file_path) and item.get('username') and item.get('checksum_md5'):
+            known.add(item['username'] + "/" + item['checksum_md5'] + (item.get('file_format') or ""))
+
+    return known
+
+
+def recovery_get_media_type(extension):
+    extension = "." + extension.upper()
+
+    if File_Tracking.is_extension_image(extension):
+        return "image"
+
+    if File_Tracking.is_extension_video(extension):
+        return "video"
+
+    return None
+
+
+def recovery_scan_folder(media_path, username, known, folder=None, is_public=True):
+    """ Returns how many media files the user folder has, and the ones which are not on the database """
+
+    folder = folder or username
+
+    seen = 0
+    orphans = []
+
+    with os.scandir(media_path + folder) as entries:
+        for entry in entries:
+            if not entry.is_file(follow_symlinks=False):
+                continue
+
+            # Renditions and uploads in progress have more than one extension <md5>.<ext>.CACHE.PNG
+            marr = entry.name.split(".")
+            if len(marr) != 2:
+                continue
+
+            md5, extension = marr
+
+            key = recovery_get_media_type(extension)
+            if not key:
+                continue
+
+            seen += 1
+
+            relative_path = folder + "/" + entry.name
+            if relative_path in known:
+                continue
+
+            orphans.append({
+                'username': username,
+                'is_public': is_public,
+                'checksum_md5': md5,
+                'file_name': entry.name,
+                'extension': extension,
+                'file_type': key,
+                'relative_path': relative_path,
+                'absolute_path': entry.path,
+            })
+
+    return seen, orphans
+
+
+def recovery_scan_blob_folder(media_path, shard, known, owner):
+    """ Same as recovery_scan_folder for a shard of the blob storage BLOBS/ab/cd/<md5><ext>
+        Blobs with the checksum of a media we have are not lost, some media still uses that content.
+    """
+
+    seen = 0
+    orphans = []
+
+    shard_path = DB_MediaBlob.BLOB_FOLDER + shard
+    with os.scandir(media_path + shard_path) as entries:
+        folders = sorted(entry.name for entry in entries if entry.is_dir(follow_symlinks=False))
+
+    for folder in folders:
+        folder_seen, folder_orphans = recovery_scan_folder(media_path,
+                                                           owner,
+                                                           known,
+                                                           folder=shard_path + "/" + folder,
+                                                           is_public=False)
+        seen += folder_seen
+        orphans.extend(folder_orphans)
+
+    if not orphans:
+        return seen, orphans
+
+    checksums = [orphan['checksum_md5'] for orphan in orphans]
+    used = set(File_Tracking.objects(checksum_md5__in=checksums).distinct('checksum_md5'))
+
+    return seen, [orphan for orphan in orphans if orphan['checksum_md5'] not in used]
+
+
+def recovery_register_blobs(new_files):
+    """ The media we indexed from the blob storage are the only reference of their blob """
+
+    for my_file in new_files:
+        DB_MediaBlob.objects(checksum_md5=my_file.checksum_md5).modify(upsert=True,
+                                                                      set__ref_count=1,
+                                                                      set__file_path=my_file.file_path,
+                                                                      set__file_format=my_file.file_format,
+                                                                      set__file_size=my_file.file_size,
+                                                                      set_on_insert__creation_date=datetime.now())
+
+
+def recovery_probe_file(orphan, backend=None):
+    """ Returns the File_Tracking values of a file we lost, or None if the file is not valid.
+        It runs on the pool threads, the backend is resolved by the caller.
+    """
+
+    absolute_path = orphan['absolute_path']
+    key = orphan['file_type']
+
+    try:
+        size = os.path.getsize(absolute_path)
+        if size == 0:
+            return None
+
+        info = {}
+
+        if key == "image":
+            image = backend.open(filename=absolute_path)
+            info['width'], info['height'] = backend.get_display_size(image)
+            backend.close(image)
+
+        if key == "video":
+            probe = ffmpeg.probe(absolute_path)
+            video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
+            info['width'] = int(video_stream['width'])
+            info['height'] = int(video_stream['height'])
+            info['duration'] = float(video_stream.get('duration', probe['format'].get('duration', 0)))
+
+    except Exception as e:
+        print_r(" FAILED PROBING " + absolute_path + " " + str(e))
+        return None
+
+    now = datetime.now()
+    return {
+        'info': info,
+        'file_name': orphan['file_name'],
+        'file_path': orphan['relative_path'],
+        'file_type': key,
+        'file_size': size,
+        'file_format': "." + orphan['extension'],
+        'checksum_md5': orphan['checksum_md5'],
+        'username': orphan['username'],
+        'is_anon': False,
+        'is_public': orphan['is_public'],
+        'init_date': now,
+        'creation_date': now,
+    }
+
+
+def recovery_index_orphans(orphans, executor, backend, on_insert=None):
+    """ Probes and inserts the orphans in batches, returns how many were indexed and how many failed """
+
+    indexed = 0
+    failed = 0
+
+    probe = partial(recovery_probe_file, backend=backend)
+
+    for start in range(0, len(orphans), RECOVERY_BATCH_SIZE):
+        batch = orphans[start:start + RECOVERY_BATCH_SIZE]
+
+        new_files = [File_Tracking(**values) for values in executor.map(probe, batch) if values]
+        failed += len(batch) - len(new_files)
+
+        if not new_files:
+            continue
+
+        try:
+            File_Tracking.objects.insert(new_files, load_bulk=False)
+            indexed += len(new_files)
+
+            if on_insert:
+                on_insert(new_files)
+        except Exception as e:
+            print_exception(e, "Failed inserting batch")
+            failed += len(new_files)
+
+    return indexed, failed
+
+
+def recovery_get_checkpoint_path():
+    return get_config_value("REINDEX_CHECKPOINT", File_Tracking.get_media_path() + RECOVERY_CHECKPOINT)
+
+
+def recovery_load_checkpoint():
+    try:
+        with open(recovery_get_checkpoint_path(), "r") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def recovery_save_checkpoint(checkpoint):
+    checkpoint['updated'] = datetime.now().isoformat()
+
+    elapsed = time.time() - checkpoint['start_time']
+    checkpoint['files_per_second'] = int(checkpoint['files_seen'] / elapsed) if elapsed > 0 else 0
+
+    # Write and rename, so a crash doesn't leave half a checkpoint
+    path = recovery_get_checkpoint_path()
+    with open(path + ".tmp", "w") as f:
+        json.dump(checkpoint, f, indent=4)
+
+    os.replace(path + ".tmp", path)
+
+
+def recovery_process_folder(checkpoint, scan, folder, executor, backend, on_insert=None):
+    """ Scans and indexes a folder, then saves the checkpoint. Returns how many orphans it had """
+
+    try:
+        seen, orphans = scan(folder)
+    except OSError as e:
+        print_r(" FAILED SCANNING " + folder + " " + str(e))
+        seen, orphans = 0, []
+
+    if orphans:
+        print_r(" FOLDER " + folder + " LOST " + str(len(orphans)) + " FILES ")
+
+    indexed, failed = recovery_index_orphans(orphans, executor, backend, on_insert)
+
+    checkpoint['files_seen'] += seen
+    checkpoint['orphans'] += len(orphans)
+    checkpoint['indexed'] += indexed
+    checkpoint['failed'] += failed
+
+    return len(orphans)
+
+
+def recovery_list_folders(path, after=None, skip=()):
+    if not os.path.exists(path):
+        return []
+
+    folders = sorted(entry.name for entry in os.scandir(path)
+                     if entry.is_dir(follow_symlinks=False) and entry.name not in skip)
+
+    if after:
+        folders = [folder for folder in folders if folder > after]
+
+    return folders
+
+
+def recovery_reindex(restart=False, max_seconds=None):
+    """ Indexes every media on disk that is not on the database.
+        If max_seconds is set we stop after the folder which runs over it, call again to continue.
+    """
+
+    from services.imaging import get_imaging_backend
+
+    media_path = File_Tracking.get_media_path()
+
+    checkpoint = recovery_load_checkpoint()
+    if restart or not checkpoint or checkpoint['state'] == 'finished':
+        checkpoint = {
+            'state': 'running',
+            'started': datetime.now().isoformat(),
+            'start_time': time.time(),
+            'last_folder': None,
+            'folders_done': 0,
+            'files_seen': 0,
+            'orphans': 0,
+            'indexed': 0,
+            'failed': 0,
+        }
+    else:
+        print_b(" RESUMING REINDEX AFTER " + str(checkpoint['last_folder']))
+
+    # Checkpoints from before we scanned the blobs
+    checkpoint.setdefault('last_blob_folder', None)
+    checkpoint.setdefault('blob_folders_done', 0)
+    checkpoint.setdefault('orphan_blobs', 0)
+
+    known = recovery_get_known_paths()
+    print_b(" REINDEX " + str(len(known)) + " media on the database ")
+
+    folders = recovery_list_folders(media_path, checkpoint['last_folder'], RECOVERY_SKIP_FOLDERS)
+    checkpoint['folders_total'] = checkpoint['folders_done'] + len(folders)
+
+    blob_folders = recovery_list_folders(media_path + DB_MediaBlob.BLOB_FOLDER, checkpoint['last_blob_folder'])
+    checkpoint['blob_folders_total'] = checkpoint['blob_folders_done'] + len(blob_folders)
+
+    start = time.time()
+    max_workers = get_config_value("REINDEX_MAX_WORKERS", RECOVERY_MAX_WORKERS)
+
+    # The pool threads don't have an application context
+    backend = get_imaging_backend(get_config_value("IMAGING_BACKEND"))
+
+    blob_owner = get_config_value("REINDEX_BLOB_OWNER", RECOVERY_BLOB_OWNER)
+    scan_user = partial(recovery_scan_folder, media_path, known=known)
+    scan_blobs = partial(recovery_scan_blob_folder, media_path, known=known, owner=blob_owner)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for username in folders:
+            recovery_process_folder(checkpoint, scan_user, username, executor, backend)
+
+            checkpoint['last_folder'] = username
+            checkpoint['folders_done'] += 1
+            recovery_save_checkpoint(checkpoint)
+
+            if checkpoint['folders_done'] % 100 == 0:
+                print_b(" REINDEX " + str(checkpoint['folders_done']) + "/" + str(checkpoint['folders_total']) +
+                        " folders " + str(checkpoint['files_per_second']) + " files/s ")
+
+            if max_seconds and time.time() - start > max_seconds:
+                print_b(" REINDEX STOPPED, CALL AGAIN TO CONTINUE ")
+                return checkpoint
+
+        for shard in blob_folders:
+            checkpoint['orphan_blobs'] += recovery_process_folder(checkpoint, scan_blobs, shard, executor, backend,
+                                                                  recovery_register_blobs)
+
+            checkpoint['last_blob_folder'] = shard
+            checkpoint['blob_folders_done'] += 1
+            recovery_save_checkpoint(checkpoint)
+
+            if max_seconds and time.time() - start > max_seconds:
+                print_b(" REINDEX STOPPED ON THE BLOBS, CALL AGAIN TO CONTINUE ")
+                return checkpoint
+
+    checkpoint['state'] = 'finished'
+    recovery_save_checkpoint(checkpoint)
+    return checkpoint
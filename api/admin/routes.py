@@ -1,14 +1,11 @@
-import os
 from datetime import datetime
 
 import bcrypt
-import ffmpeg
 from api import (admin_login_required, api_key_or_login_required,
                  get_response_error_formatted, get_response_formatted)
 from api.admin import blueprint
-from api.media.models import File_Tracking
 from api.print_helper import *
-from flask import current_app, url_for
+from flask import Response, current_app, request, url_for
 
 
 def has_no_empty_params(rule):
@@ -100,64 +97,46 @@ def site_map():
     return get_response_formatted({'status': "success", 'site_map': links})
 
 
-def reindex_disk_file(username, checksum_md5, file_name, extension, relative_path, absolute_path):
-    from wand.image import Image
-
-    key = None
-    if File_Tracking.is_extension_image(extension):
-        key = "image"
-
-    if File_Tracking.is_extension_video(extension):
-        key = "video"
-
-    if not key:
-        return
-
-    size = os.path.getsize(absolute_path)
-    if size == 0:
-        return
+@blueprint.route('/blobs/migrate', methods=['POST'])
+@api_key_or_login_required
+@admin_login_required
+def api_admin_blobs_migrate():
+    """ Moves the legacy <username>/<md5><ext> files into the shared blob storage.
+        Processes a batch, call it again with after_id=<last_id> until nothing is left.
+    """
+    from api.media.storage import media_blob_migrate
 
-    info = {}
+    limit = int(request.args.get("limit", 1000))
+    after_id = request.args.get("after_id", None)
 
-    if key == "image":
-        image = Image(filename=absolute_path)
+    report = media_blob_migrate(limit=limit, after_id=after_id)
+    return get_response_formatted({'status': 'success', 'report': report})
 
-        print(" Image orientation " + str(image.orientation))
-        # Image is rotated internally, we have to invert our dimensions
-        if image.orientation in ['right_top', 'top_right', 'right_bottom', 'bottom_right']:
-            print(" Rotate Image ")
-            info['width'] = image.height
-            info['height'] = image.width
-        else:
-            info['width'] = image.width
-            info['height'] = image.height
 
-    if key == "video":
-        probe = ffmpeg.probe(absolute_path)
-        video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
-        info['width'] = int(video_stream['width'])
-        info['height'] = int(video_stream['height'])
-        info['duration'] = float(video_stream['duration'])
+@blueprint.route('/phash/rebuild', methods=['POST'])
+@api_key_or_login_required
+@admin_login_required
+def api_admin_phash_rebuild():
+    """ Computes the perceptual hashes of the images which don't have them yet, force=1 recomputes all of them.
+        Processes a batch, call it again with after_id=<last_id> until nothing is left.
+    """
+    from api.media.similarity import media_phash_rebuild
 
-    new_file = {
-        'info': info,
-        'file_name': file_name,
-        'file_path': relative_path,
-        'file_type': key,
-        'file_size': size,
-        'file_format': "." + extension,
-        'checksum_md5': checksum_md5,
-        'username': username,
-        'is_anon': False,
-        'is_public': True
-    }
+    limit = int(request.args.get("limit", 1000))
+    after_id = request.args.get("after_id", None)
+    force = request.args.get("force", "") in ["1", "true"]
 
-    my_file = File_Tracking(**new_file)
-    my_file.save()
+    report = media_phash_rebuild(limit=limit, after_id=after_id, force=force)
+    return get_response_formatted({'status': 'success', 'report': report})
 
 
 @blueprint.route('/reindex', methods=['GET', 'DELETE'])
 def api_disaster_recovery():
+    """ Indexes the media on disk which was lost from the database.
+        It resumes from the last checkpoint, use restart=1 to scan everything again
+        and max_seconds=<seconds> to process the tree in several calls.
+    """
+    from api.admin.recovery import recovery_reindex
     from flask_login import \
         current_user  # Required by pytest, otherwise client crashes on CI
 
@@ -167,54 +146,67 @@ def api_disaster_recovery():
     if current_user.username != "sergioamr":
         return get_response_error_formatted(403, {'error_msg': "This user is not allowed to perform this."})
 
-    path = current_app.config['MEDIA_PATH']
-    l = len(path)
+    restart = request.args.get("restart", "") in ["1", "true"]
 
-    last_check = ""
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            file_path = os.path.join(root, file)[l:]
-            arr = file_path.split("/")
+    max_seconds = request.args.get("max_seconds", None)
+    if max_seconds:
+        max_seconds = int(max_seconds)
 
-            if len(arr) == 1:
-                continue
+    report = recovery_reindex(restart=restart, max_seconds=max_seconds)
 
-            username = arr[0]
-            if username in ['oinktv']:
-                continue
+    ret = {'status': 'success', 'report': report}
+    return get_response_formatted(ret)
 
-            media_file = arr[1]
 
-            if ".PREVIEW" not in media_file:
-                continue
+@blueprint.route('/reindex/status', methods=['GET'])
+@api_key_or_login_required
+@admin_login_required
+def api_disaster_recovery_status():
+    """ Returns the progress of the last disaster recovery """
+    from api.admin.recovery import recovery_load_checkpoint
+
+    report = recovery_load_checkpoint()
+    if not report:
+        return get_response_error_formatted(404, {'error_msg': "No recovery has been run."})
+
+    return get_response_formatted({'status': 'success', 'report': report})
 
-            marr = media_file.split(".")
 
-            md5 = marr[0]
-            extension = marr[1]
-            file_name = md5 + "." + extension
+@blueprint.route('/query_plans', methods=['GET'])
+@api_key_or_login_required
+@admin_login_required
+def api_admin_query_plans():
+    """ Returns the query plans compiled by build_query_from_url, with how many times they were used """
+    from api.query_helper import query_plan_cache
 
-            relative_path = username + "/" + file_name
-            #print_b("MEDIA [" + relative_path + "] ")
+    plans = query_plan_cache.describe()
+    return get_response_formatted({'status': 'success', 'plans': plans, 'total': len(plans)})
 
-            if last_check == relative_path:
-                continue
 
-            last_check = relative_path
+@blueprint.route('/db_profile', methods=['GET', 'DELETE'])
+@api_key_or_login_required
+@admin_login_required
+def api_admin_db_profile():
+    """ Database commands per endpoint since the process started, sorted by the average queries per request.
+        Endpoints with N+1 list the shapes of the commands repeated on a single request.
+        DELETE or reset=1 clears the statistics.
+    """
+    from imgapi_profiler import database_profiler
 
-            media_file = File_Tracking.objects(file_path=relative_path).first()
+    if request.method == 'DELETE' or request.args.get("reset", "") in ["1", "true"]:
+        database_profiler.reset()
 
-            if media_file:
-                #print_b("FILE OK [" + username + "] " + relative_path)
-                continue
+    report = database_profiler.get_report()
+    return get_response_formatted({'status': 'success', 'endpoints': report, 'total': len(report)})
 
-            print_r("FILE LOST [" + username + "] " + relative_path)
 
-            abs_path = os.path.join(root, file_name)
-            try:
-                reindex_disk_file(username, md5, file_name, extension, relative_path, abs_path)
-            except Exception as e:
-                print_exception(e, "Crash")
+@blueprint.route('/metrics', methods=['GET'])
+@api_key_or_login_required
+@admin_login_required
+def api_admin_metrics():
+    """ Prometheus text format of the API, the pipelines and the workers.
+        With IMGAPI_METRICS_DIR (or METRICS_DIR on the config) the values of every process are added up.
+    """
+    from services.metrics import metrics_registry
 
-    ret = {'status': 'success'}
-    return get_response_formatted(ret)
+    return Response(metrics_registry.render(), mimetype="text/plain; version=0.0.4")
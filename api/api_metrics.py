@@ -0,0 +1,80 @@
+"""
+    Metrics of the API, rendered by /api/admin/metrics. The registry is in services/metrics.py
+"""
+
+import time
+from datetime import datetime
+
+from flask import g, request
+from services.metrics import (PIPELINE_BUCKETS, get_external_hooks,
+                              metrics_registry)
+
+REQUEST_SECONDS = metrics_registry.histogram("imgapi_http_request_duration_seconds",
+                                             "Latency of the API requests per blueprint",
+                                             ["blueprint", "method", "status"])
+
+PIPELINE_TRANSITIONS = metrics_registry.counter("imgapi_pipeline_transitions_total",
+                                                "State changes of the tickers and the news", ["kind", "state"])
+
+PIPELINE_STAGE_SECONDS = metrics_registry.histogram("imgapi_pipeline_stage_seconds",
+                                                    "Time an item spent on a state before moving to the next one",
+                                                    ["kind", "from_state", "to_state"],
+                                                    buckets=PIPELINE_BUCKETS)
+
+CACHE_REQUESTS = metrics_registry.counter("imgapi_cache_requests_total", "Hits and misses of our caches",
+                                          ["cache", "result"])
+
+
+def get_queue_depth():
+    from api.api_redis import api_rq
+
+    if not getattr(api_rq, 'queue', None):
+        return {}
+
+    return {
+        (api_rq.queue.name, 'queued'): api_rq.queue.count,
+        (api_rq.queue.name, 'started'): api_rq.queue.started_job_registry.count,
+        (api_rq.queue.name, 'failed'): api_rq.queue.failed_job_registry.count,
+    }
+
+
+metrics_registry.gauge("imgapi_rq_jobs", "Jobs on the RQ queue", ["queue", "state"], collect=get_queue_depth)
+
+
+def observe_state_change(kind, previous_state, state, since=None):
+    """ since is when the item entered previous_state """
+
+    PIPELINE_TRANSITIONS.inc(kind=kind, state=state)
+
+    if since and previous_state and previous_state != state:
+        PIPELINE_STAGE_SECONDS.observe((datetime.now() - since).total_seconds(),
+                                       kind=kind,
+                                       from_state=previous_state,
+                                       to_state=state)
+
+
+def observe_cache(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def init_metrics(app):
+    if not app.config.get("METRICS", True):
+        return
+
+    metrics_registry.enable_multiprocess("api", app.config.get("METRICS_DIR"))
+
+    @app.before_request
+    def metrics_before_request():
+        g.metrics_start = time.time()
+
+    @app.after_request
+    def metrics_after_request(response):
+        start = g.get('metrics_start')
+        if start:
+            # The status class, we don't want a series per status code
+            REQUEST_SECONDS.observe(time.time() - start,
+                                    blueprint=request.blueprint or "app",
+                                    method=request.method,
+                                    status=str(response.status_code)[0] + "xx")
+
+        return response
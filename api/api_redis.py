@@ -1,9 +1,33 @@
 import os
+import threading
+import time
+import uuid
 from datetime import datetime
 
 import redis
 from rq import Queue
+from rq.exceptions import NoSuchJobError
 from rq.job import Job
+from services.job_events import get_job_state_key
+
+# Jobs which are still waiting or running, a new request for them will attach to them
+JOB_IN_FLIGHT = ['queued', 'started', 'deferred', 'scheduled']
+
+# Seconds we wait for another request that is enqueueing the same job
+ENQUEUE_WAIT_SECONDS = 5
+
+# Deletes the lock only if it is still ours, it might have expired and belong to somebody else
+UNLOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class JobEnqueueBusy(Exception):
+    """ Another request is enqueueing the same job and it didn't finish in time """
+    pass
 
 
 class Remote_Task():
@@ -13,19 +37,69 @@ class Remote_Task():
 
         redis_url = os.getenv('REDISTOGO_URL', 'redis://localhost:6379')
 
+        # The client connects on the first command, nothing here waits for redis
         self.conn = redis.from_url(redis_url)
         self.queue = Queue(connection=self.conn)
 
-        job = self.call("worker.is_worker_alive", "IMG-API " + str(datetime.now()))
+        if app.config.get("REDIS_LIVENESS_PROBE", True):
+            threading.Thread(target=self.probe_worker, name="redis_probe", daemon=True).start()
+
+    def probe_worker(self):
+        """ Lets the worker log that the API is up, redis might be down or slow so we don't wait for it """
+        try:
+            self.call("worker.is_worker_alive", "IMG-API " + str(datetime.now()))
+        except Exception as e:
+            print(" REDIS NOT AVAILABLE " + str(e))
 
     def call(self, transform_name, media_path):
         job = self.queue.enqueue(transform_name, media_path, result_ttl=5000)
         return job
 
+    def call_unique(self, transform_name, media_path, job_id):
+        """ Enqueues with a deterministic job id, if the same job is already waiting or running we return it instead """
+
+        job = self.get_job(job_id)
+        if job and job.get_status() in JOB_IN_FLIGHT:
+            return job
+
+        # Two requests could arrive at the same time, only one of them enqueues
+        lock = "imgapi:enqueue:" + job_id
+        token = uuid.uuid4().hex
+
+        if not self.conn.set(lock, token, nx=True, ex=30):
+            return self.wait_for_job(job_id)
+
+        try:
+            # The state of the previous run would look like the result of this one
+            self.conn.delete(get_job_state_key(job_id))
+            return self.queue.enqueue(transform_name, media_path, job_id=job_id, result_ttl=5000)
+        finally:
+            self.conn.eval(UNLOCK_SCRIPT, 1, lock, token)
+
+    def wait_for_job(self, job_id):
+        """ The request holding the lock enqueues the job, we return that one """
+
+        deadline = time.time() + ENQUEUE_WAIT_SECONDS
+        while time.time() < deadline:
+            job = self.get_job(job_id)
+            if job:
+                return job
+
+            time.sleep(0.05)
+
+        raise JobEnqueueBusy(job_id)
+
     def fetch_job(self, job_id):
         job = Job.fetch(job_id, connection=self.conn)
         return job
 
+    def get_job(self, job_id):
+        """ Returns the job or None if it doesn't exist or it expired """
+        try:
+            return Job.fetch(job_id, connection=self.conn)
+        except NoSuchJobError:
+            return None
+
 
 api_rq = Remote_Task()
 
@@ -2,7 +2,6 @@ import io
 import socket
 from datetime import datetime
 
-import qrcode
 import requests
 from api import get_response_error_formatted, get_response_formatted
 from api.company import blueprint
@@ -11,8 +10,6 @@ from api.config import get_api_AI_service, get_api_entry
 from api.print_helper import *
 from api.query_helper import (build_query_from_request, get_timestamp_verbose,
                               is_mongo_id)
-from api.ticker.batch.yfinance.ytickers_pipeline import \
-    ticker_update_financials
 from flask import request, send_file
 from mongoengine.queryset.visitor import Q
 
@@ -28,9 +25,10 @@ def api_company_get_query():
 
     companies = build_query_from_request(DB_Company, global_api=True)
 
-    if len(companies) == 0:
+    # The result is fetched once here and reused on the loop
+    if not companies:
         # Patch to fix issue with tickers that refer to the same company.
-        query = request.args.get("exchange_tickers", None).upper()
+        query = request.args.get("exchange_tickers", "").upper()
         if '-' in query:
             arr = query.split('-')
             companies = DB_Company.objects(exchange_tickers=arr[0])
@@ -173,6 +171,8 @@ def api_get_new_stamp(biz_name):
 
     print(content)
 
+    import qrcode
+
     img = qrcode.make(content)
     buf = io.BytesIO()
     img.save(buf)
@@ -670,6 +670,7 @@ def api_get_ticker_financials(ticker_id):
     """
         Returns a list of tickers that the user is watching.
     """
+    from api.ticker.batch.yfinance.ytickers_pipeline import ticker_update_financials
     from api.ticker.tickers_helpers import ticker_exchanges_cleanup_dups
 
     db_company = DB_Company.objects(exchange_tickers=ticker_id).first()
@@ -12,6 +12,7 @@ from flask import json, request
 from flask_login import current_user
 
 from api import get_response_formatted
+from api.api_metrics import observe_cache
 from api.tools import ensure_dir
 
 from .print_helper import *
@@ -121,6 +122,7 @@ def api_file_cache(func):
     def decorated_view(*args, **kwargs):
 
         output = force_disk_read_cache()
+        observe_cache("file_cache", output)
         if output:
             return get_response_formatted(output)
 
@@ -1,15 +1,50 @@
-import random
 from datetime import datetime
 
 from api.print_helper import *
 from api.query_helper import *
 from api.query_helper import get_value_type_helper, mongo_to_dict_helper
 from api.user.user_check import DB_UserCheck
-from flask import abort
+from bson import ObjectId
+from flask import abort, g, has_app_context
 from flask_login import current_user
 from imgapi_launcher import db
 from mongoengine import *
 
+# Items of a gallery we check at once when we look for the next media
+NEIGHBOUR_WINDOW = 20
+
+
+def get_membership_cache():
+    """ Membership sets for this request, every request starts with an empty cache """
+    if not has_app_context():
+        return {}
+
+    if 'media_list_membership' not in g:
+        g.media_list_membership = {}
+
+    return g.media_list_membership
+
+
+def media_list_membership_get(list_ids):
+    """ Returns list_id => set of media ids, the lists we didn't load yet are fetched with a single $in query """
+
+    cache = get_membership_cache()
+
+    missing = [list_id for list_id in list_ids if list_id not in cache and ObjectId.is_valid(list_id)]
+    if missing:
+        for list_id in missing:
+            cache[list_id] = set()
+
+        query = {'_id': {'$in': [ObjectId(list_id) for list_id in missing]}}
+        for raw in DB_MediaList._get_collection().find(query, {'media_list.media_id': 1}):
+            cache[str(raw['_id'])] = {item.get('media_id') for item in raw.get('media_list', [])}
+
+    return {list_id: cache.get(list_id, set()) for list_id in list_ids}
+
+
+def media_list_membership_invalidate(list_id):
+    get_membership_cache().pop(str(list_id), None)
+
 
 class DB_ItemMedia(db.DynamicEmbeddedDocument):
     media_id = db.StringField()
@@ -44,35 +79,66 @@ class DB_MediaList(db.DynamicDocument, DB_UserCheck):
 
     private_keys = []
 
-    def find_media_pos(self, media_id, position):
+    def get_position_map(self):
+        """ media_id => index on the list, built once per document so every lookup is O(1).
+            Every method that changes media_list has to call invalidate_positions()
+        """
+
+        position_map = getattr(self, '_position_map', None)
+        if position_map is not None:
+            return position_map
+
+        # Old lists might have duplicates, we keep the first position like a linear search would
+        position_map = {}
         for idx, item in enumerate(self.media_list):
-            if item.media_id == media_id:
-                pos = (idx + position) % len(self.media_list)
-                return pos
+            position_map.setdefault(item.media_id, idx)
+
+        self._position_map = position_map
+        return position_map
 
-        return 0
+    def invalidate_positions(self):
+        self._position_map = None
+
+    def reload(self, *fields, **kwargs):
+        self.invalidate_positions()
+        return super(DB_MediaList, self).reload(*fields, **kwargs)
+
+    def find_media_pos(self, media_id, position):
+        idx = self.get_position_map().get(media_id)
+        if idx is None:
+            return 0
+
+        return (idx + position) % len(self.media_list)
 
     def get_media_position(self, media_id, position):
+        """ Returns the media at position from media_id, skipping the media that was deleted.
+            We fetch the candidates in windows with a single query instead of one query per item.
+        """
         from api.media.models import File_Tracking
 
-        media_file = None
+        count = len(self.media_list)
+        if count == 0:
+            return None
 
-        remove_cleanup = []
+        start = self.find_media_pos(media_id, position)
+        step = -1 if position < 0 else 1
 
-        pos = self.find_media_pos(media_id, position)
+        remove_cleanup = []
 
         try:
-            while position < len(self.media_list):
-                item = self.media_list[pos]
-                media_file = File_Tracking.objects(id=item.media_id).first()
+            for offset in range(0, count, NEIGHBOUR_WINDOW):
+                window = []
+                for i in range(offset, min(offset + NEIGHBOUR_WINDOW, count)):
+                    window.append(self.media_list[(start + i * step) % count].media_id)
 
-                if not media_file:
-                    remove_cleanup.append(item.media_id)
+                valid_ids = [mid for mid in window if ObjectId.is_valid(mid)]
+                found = {str(media_file.id): media_file for media_file in File_Tracking.objects(id__in=valid_ids)}
 
-                if media_file: return media_file
+                for mid in window:
+                    if mid in found:
+                        return found[mid]
 
-                position += 1
-                pos = (pos + position) % len(self.media_list)
+                    remove_cleanup.append(mid)
 
             return None
         finally:
@@ -81,19 +147,14 @@ class DB_MediaList(db.DynamicDocument, DB_UserCheck):
                 self.remove_from_list(mid)
 
     def get_position(self, media_id, position):
-        for idx, item in enumerate(self.media_list):
-            if item.media_id == media_id:
-                pos = (idx + position) % len(self.media_list)
-                return self.media_list[pos]
+        idx = self.get_position_map().get(media_id)
+        if idx is None:
+            return self.media_list[0]
 
-        return self.media_list[0]
+        return self.media_list[(idx + position) % len(self.media_list)]
 
     def find_on_list(self, media_id):
-        for idx, item in enumerate(self.media_list):
-            if item.media_id == media_id:
-                return idx
-
-        return -1
+        return self.get_position_map().get(media_id, -1)
 
     def is_on_list(self, media_id):
         return self.find_on_list(media_id) != -1
@@ -111,14 +172,22 @@ class DB_MediaList(db.DynamicDocument, DB_UserCheck):
         return ret
 
     def add_to_list(self, media_id):
-        """ Adds to a list if it doesn't have the media """
+        """ Adds to a list if it doesn't have the media.
+            We push only the new item with a single atomic update, so concurrent writers don't lose items
+            and we don't rewrite the whole list.
+        """
+
+        item = DB_ItemMedia(**{"media_id": media_id, "update_date": datetime.now()})
+
+        res = DB_MediaList._get_collection().update_one({
+            '_id': self.pk,
+            'media_list.media_id': {'$ne': media_id}
+        }, {'$push': {'media_list': item.to_mongo()}})
 
-        if self.find_on_list(media_id) != -1:
+        if res.modified_count == 0:
             print_r(" Duplicated ")
             return False
 
-        item = DB_ItemMedia(**{"media_id": media_id, "update_date": datetime.now()})
-
         # First item on the list will be the media cover
         if len(self.media_list) == 0 or not self.cover_id:
             self.set_cover(media_id)
@@ -127,12 +196,65 @@ class DB_MediaList(db.DynamicDocument, DB_UserCheck):
         if len(self.media_list) == 1:
             self.set_background(media_id)
 
+        # Keep our copy in sync without saving it
         self.media_list.append(item)
-        self.save()
+        self.invalidate_positions()
+        self._clear_changed_fields()
+
+        media_list_membership_invalidate(self.id)
+        return True
+
+    def add_many_to_list(self, media_ids):
+        """ Appends the media which is not on the list yet with a single $push $each, instead of a save per item """
+
+        on_list = set(self.get_as_list())
+
+        new_ids = []
+        for media_id in media_ids:
+            if media_id in on_list:
+                continue
+
+            on_list.add(media_id)
+            new_ids.append(media_id)
+
+        if not new_ids:
+            print_r(" Duplicated ")
+            return False
+
+        now = datetime.now()
+        items = [DB_ItemMedia(media_id=media_id, update_date=now) for media_id in new_ids]
+
+        update = {'$push': {'media_list': {'$each': [item.to_mongo() for item in items]}}}
+
+        # Same rules as add_to_list, first item is the cover and the second one the background
+        set_update = {}
+        if len(self.media_list) == 0 or not self.cover_id:
+            set_update['cover_id'] = new_ids[0]
+
+        all_ids = self.get_as_list() + new_ids
+        if len(self.media_list) <= 1 and len(all_ids) >= 2:
+            set_update['background_id'] = all_ids[1]
+
+        if set_update:
+            update['$set'] = set_update
+
+        res = DB_MediaList._get_collection().update_one({
+            '_id': self.pk,
+            'media_list.media_id': {'$nin': new_ids}
+        }, update)
+
+        if res.modified_count == 0:
+            # Someone added some of this media in the meanwhile, we add them one by one
+            self.reload()
+            return any([self.add_to_list(media_id) for media_id in new_ids])
+
+        self.reload()
+
+        media_list_membership_invalidate(self.id)
         return True
 
     def remove_from_list(self, media_id):
-        """ Remove from a list of media """
+        """ Remove from a list of media with an atomic $pull """
 
         if self.cover_id == media_id:
             self.set_cover(None)
@@ -140,14 +262,41 @@ class DB_MediaList(db.DynamicDocument, DB_UserCheck):
         if self.background_id == media_id:
             self.set_background(None)
 
-        res = self.find_on_list(media_id)
-        if res == -1:
+        res = DB_MediaList._get_collection().update_one({'_id': self.pk},
+                                                        {'$pull': {
+                                                            'media_list': {
+                                                                'media_id': media_id
+                                                            }
+                                                        }})
+
+        idx = self.find_on_list(media_id)
+        if idx != -1:
+            self.media_list.pop(idx)
+            self.invalidate_positions()
+            self._clear_changed_fields()
+
+        if res.modified_count == 0:
             return False
 
-        self.media_list.pop(res)
-        self.save()
+        media_list_membership_invalidate(self.id)
         return True
 
+    def get_random_items(self, size=1):
+        """ Picks random items on the database with $sample, so we don't load and convert the whole list """
+
+        pipeline = [
+            {'$match': {'_id': self.pk}},
+            {'$unwind': '$media_list'},
+            {'$sample': {'size': size}},
+            {'$replaceRoot': {'newRoot': '$media_list'}},
+        ]
+
+        items = []
+        for raw in DB_MediaList._get_collection().aggregate(pipeline):
+            items.append(DB_ItemMedia(media_id=raw.get('media_id'), update_date=raw.get('update_date')))
+
+        return items
+
     def check_permissions(self):
         pass
 
@@ -249,11 +398,11 @@ class DB_UserGalleries(db.DynamicEmbeddedDocument):
         if media_list_name not in self:
             return False
 
-        media_list = self.get_media_list(self[media_list_name])
-        if not media_list:
+        list_id = self[media_list_name]
+        if not list_id:
             return False
 
-        return media_list.is_on_list(media_id)
+        return media_id in media_list_membership_get([list_id])[list_id]
 
     def get_media_list_by_name_or_id(self, media_list_id):
         if len(media_list_id) == 24:
@@ -389,6 +538,7 @@ class DB_UserGalleries(db.DynamicEmbeddedDocument):
             return abort(404, "Media list not found")
 
         self.remove_list_entry(list_id)
+        media_list_membership_invalidate(list_id)
 
         my_list = DB_MediaList.objects(pk=list_id).first()
         if not my_list:
@@ -417,8 +567,15 @@ class DB_UserGalleries(db.DynamicEmbeddedDocument):
             if not my_list:
                 return {'is_empty': True, 'media_list': []}
 
+        is_random = image_type == "random" and not raw_db
+
         if not my_list:
-            my_list = DB_MediaList.objects(pk=list_id).first()
+            op = DB_MediaList.objects(pk=list_id)
+            if is_random:
+                # We pick the item on the database, no need to load the list
+                op = op.exclude('media_list')
+
+            my_list = op.first()
 
         if not my_list:
             return None
@@ -428,28 +585,37 @@ class DB_UserGalleries(db.DynamicEmbeddedDocument):
         if raw_db:
             return my_list
 
-        ret = mongo_to_dict_helper(my_list)
-
-        if image_type == "random":
-            ret['media_list'] = [random.choice(ret['media_list'])]
+        if is_random:
+            ret = mongo_to_dict_helper(my_list, filter_out=['media_list'])
+            ret['media_list'] = mongo_to_dict_helper(my_list.get_random_items(1))
+            return ret
 
+        ret = mongo_to_dict_helper(my_list)
         return ret
 
 
     def populate(self, media_list):
         """ Adds if the user liked or disliked the media """
 
-        for media in media_list:
-            m_id = media['media_id']
+        # Key on the media => list where we check the media
+        list_names = {'favs': 'list_favs_id', 'like': 'list_likes_id', 'dislike': 'list_dislikes_id'}
 
-            if self.is_on_list(m_id, 'list_favs_id'):
-                media['favs'] = True
+        list_ids = {}
+        for key, list_name in list_names.items():
+            if list_name in self and self[list_name]:
+                list_ids[key] = self[list_name]
 
-            if self.is_on_list(m_id, 'list_likes_id'):
-                media['like'] = True
+        if not list_ids:
+            return
+
+        membership = media_list_membership_get(list(list_ids.values()))
+
+        for media in media_list:
+            m_id = media['media_id']
 
-            if self.is_on_list(m_id, 'list_dislikes_id'):
-                media['dislike'] = True
+            for key, list_id in list_ids.items():
+                if m_id in membership[list_id]:
+                    media[key] = True
 
     @staticmethod
     def clean_dict(ret):
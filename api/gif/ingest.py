@@ -0,0 +1,193 @@
+"""
+    Ingestion of the GIFs we captured from Tenor.
+
+    Items are downloaded on a bounded pool of threads sharing a single pooled session.
+    Bodies are streamed into temporary files and hashed on the way, so we never hold a GIF in memory.
+    Every item ends in its own state, a failed download doesn't stop the rest of the batch.
+    Items are claimed as PROCESSING with the date of the claim. If the process dies with the item
+    claimed, the next batch claims it again once TENOR_CLAIM_SECONDS have passed.
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+
+import requests
+from api.api_metrics import get_external_hooks
+from api.config import get_config_value
+from api.print_helper import *
+from flask import current_app
+from mongoengine.queryset.visitor import Q
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .models import DB_TenorGif
+
+TENOR_BATCH_SIZE = 100
+TENOR_MAX_WORKERS = 8
+TENOR_TIMEOUT = (5, 30)
+TENOR_CHUNK_SIZE = 64 * 1024
+
+# A download takes seconds, a claim older than this one belongs to a process that died
+TENOR_CLAIM_SECONDS = 15 * 60
+
+tenor_session = None
+
+
+class TenorIngestError(Exception):
+    """ The item failed, the message is the status we store on the DB_TenorGif """
+    pass
+
+
+def get_tenor_session():
+    """ Keeps the connections alive between downloads, the pool is as big as the number of workers """
+
+    global tenor_session
+    if tenor_session:
+        return tenor_session
+
+    max_workers = get_config_value("TENOR_MAX_WORKERS", TENOR_MAX_WORKERS)
+
+    retry = Retry(total=2, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504], allowed_methods=["GET"])
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry)
+
+    session = requests.Session()
+    session.hooks = get_external_hooks("tenor")
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    tenor_session = session
+    return tenor_session
+
+
+def tenor_download(url):
+    """ Streams the url into a temporary file, returns (path, md5, size) or raises on failure """
+
+    response = get_tenor_session().get(url, stream=True, timeout=TENOR_TIMEOUT)
+    with response:
+        if response.status_code != 200:
+            raise TenorIngestError('FAILED_FETCHING_' + str(response.status_code))
+
+        md5 = hashlib.md5()
+        size = 0
+
+        fd, path = tempfile.mkstemp(suffix=".TENOR", dir=get_config_value("TENOR_TMP_PATH", None))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=TENOR_CHUNK_SIZE):
+                    md5.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except Exception as e:
+            os.remove(path)
+            raise e
+
+    return path, md5.hexdigest(), size
+
+
+def get_claimable_query():
+    """ Items waiting, or claimed by an ingest that never finished them """
+
+    stale_date = datetime.now() - timedelta(seconds=get_config_value("TENOR_CLAIM_SECONDS", TENOR_CLAIM_SECONDS))
+
+    stale = Q(status="PROCESSING") & (Q(processing_date__lt=stale_date) | Q(processing_date__exists=False))
+    return Q(status="WAITING_INDEX") | stale
+
+
+def tenor_ingest_item(tenor_id):
+    """ Downloads and indexes a single GIF, returns (status, media_info) """
+
+    from .routes import api_internal_gif_upload
+
+    # Claim it, a parallel queue_process call might be processing the same batch
+    claimed = DB_TenorGif.objects(Q(pk=tenor_id) & get_claimable_query()).update_one(
+        set__status="PROCESSING", set__processing_date=datetime.now())
+
+    if not claimed:
+        return None, None
+
+    tenor = DB_TenorGif.objects(pk=tenor_id).first()
+
+    status = 'INDEXED'
+    media_info = None
+    path = None
+
+    try:
+        raw = tenor['raw']
+        mp4_url = raw['media_formats']['mp4']['url']
+
+        # Extract the file name and extension
+        file_name_with_ext = os.path.basename(urlparse(mp4_url).path)
+        file_name, file_extension = os.path.splitext(file_name_with_ext)
+
+        media_info = {
+            'my_title': raw['title'],
+            'my_description': raw['content_description'],
+            'external_uuid': raw['id'],
+            'tags': tenor.tags,
+        }
+
+        path, md5, size = tenor_download(mp4_url)
+
+        if not api_internal_gif_upload(path, media_info, file_name, file_extension, md5=md5, size=size):
+            status = 'FAILED_PROCESSING'
+
+    except TenorIngestError as e:
+        status = str(e)
+
+    except Exception as e:
+        print_exception(e, " INGEST TENOR ")
+        status = 'CRASHED'
+        tenor.update(**{'exception': str(e)})
+
+    finally:
+        # The upload moves the file into the storage, it is still here if the content was already there
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    tenor.update(**{'status': status})
+    return status, media_info
+
+
+def tenor_ingest_queue(limit=TENOR_BATCH_SIZE):
+    """ Processes a batch of the GIFs waiting to be indexed, returns a report with the throughput """
+
+    tenor_ids = [tenor.id for tenor in DB_TenorGif.objects(get_claimable_query()).only('id').limit(limit)]
+
+    report = {'processed': 0, 'indexed': 0, 'failed': 0, 'status': {}, 'media': []}
+
+    start = time.time()
+    app = current_app._get_current_object()
+
+    def run(tenor_id):
+        with app.app_context():
+            return tenor_ingest_item(tenor_id)
+
+    max_workers = max(1, min(len(tenor_ids), get_config_value("TENOR_MAX_WORKERS", TENOR_MAX_WORKERS)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for status, media_info in executor.map(run, tenor_ids):
+            if not status:
+                continue
+
+            report['processed'] += 1
+            report['status'][status] = report['status'].get(status, 0) + 1
+
+            if status == 'INDEXED':
+                report['indexed'] += 1
+                report['media'].append(media_info)
+            else:
+                report['failed'] += 1
+
+    elapsed = time.time() - start
+    report['seconds'] = round(elapsed, 3)
+    report['items_per_second'] = round(report['processed'] / elapsed, 2) if elapsed > 0 else 0
+
+    if report['processed']:
+        print_b(" TENOR INGEST " + str(report['processed']) + " items " + str(report['items_per_second']) +
+                " items/s ")
+
+    return report
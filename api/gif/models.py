@@ -16,6 +16,9 @@ class DB_TenorGif(db.DynamicDocument):
     external_uuid = db.StringField()
     media_id = db.StringField()
 
+    # When an ingest claimed it, a PROCESSING item older than the claim timeout is retried
+    processing_date = db.DateTimeField()
+
     def __init__(self, *args, **kwargs):
         super(DB_TenorGif, self).__init__(*args, **kwargs)
 
@@ -1,12 +1,14 @@
+import shutil
 from io import BytesIO
-from urllib.parse import urlparse
 
-import ffmpeg
 import requests
 from api import get_response_formatted
+from api.api_metrics import get_external_hooks
 from api.gif import blueprint
 from api.gif.models import DB_TenorGif
+from api.gif.tag_index import MATCH_DEFAULT_LIMIT, MATCH_MAX_LIMIT, gif_tag_index
 from api.media.models import File_Tracking
+from api.media.storage import media_blob_acquire, media_blob_release
 from api.print_helper import *
 from api.query_helper import build_query_from_request
 from api.tools import ensure_dir, generate_file_md5
@@ -29,77 +31,55 @@ def api_gif_get_query():
 
 @blueprint.route('/match', methods=['GET', 'POST'])
 def api_gif_get_query_match_best():
+    """ Best GIFs for a list of keywords, ranked by how many keywords (or their synonyms) they have.
+
+    Example:
+        http://domain/api/gif/match?keywords=shocked,sadness&limit=10&all=1
+    """
     keywords = request.args.get("keywords", "sad")
     keywords = keywords.replace(" ", ",")
     tags_to_match = keywords.split(",")
 
-    pipeline = [{
-        "$match": {
-            "tags": {
-                "$in": tags_to_match
-            }
-        }
-    }, {
-        "$project": {
-            "_id": 1,
-            "external_uuid": 1,
-            "tags": 1,
-            "match_count": {
-                "$size": {
-                    "$filter": {
-                        "input": "$tags",
-                        "as": "tag",
-                        "cond": {
-                            "$in": ["$$tag", tags_to_match]
-                        }
-                    }
-                }
-            }
-        }
-    }, {
-        "$sort": {
-            "match_count": -1
-        }
-    }]
+    try:
+        limit = min(int(request.args.get("limit", MATCH_DEFAULT_LIMIT)), MATCH_MAX_LIMIT)
+    except ValueError:
+        limit = MATCH_DEFAULT_LIMIT
+
+    match_all = request.args.get("all", "0").lower() in ["1", "true"]
 
     result = []
-    res = File_Tracking.objects.aggregate(pipeline)
-    for r in res:
-        result.append({'id': str(r['_id']), 'tags': list(r['tags']), 'match_count': r['match_count']})
+    for match_count, media_id in gif_tag_index.match(tags_to_match, limit, match_all):
+        result.append({'id': media_id, 'tags': gif_tag_index.get_tags(media_id), 'match_count': match_count})
 
     # Return Redirect to URL -  http://domain/api/media/get/674cbbd8b5301d1a588aaceb
 
     return get_response_formatted({'gifs': [result]})
 
 
-def api_internal_gif_upload(f_request, media_info, file_name, file_extension, file_type="video", gif_username="GIF"):
+def api_internal_gif_upload(f_request,
+                            media_info,
+                            file_name,
+                            file_extension,
+                            file_type="video",
+                            gif_username="GIF",
+                            md5=None,
+                            size=None):
+    """ f_request is a file in memory, or the path of a temporary file that we move into the storage.
+        Pass md5 and size if they were computed while downloading it.
+    """
     media_path = File_Tracking.get_media_path()
 
     #print(" User to upload files " + gif_username)
 
-    user_space_path = gif_username + "/"
-    full_path = media_path + user_space_path
-    #print(" Save at " + full_path)
-    ensure_dir(full_path)
+    if not md5:
+        md5, size = generate_file_md5(f_request)
 
-    md5, size = generate_file_md5(f_request)
-    if size == 0:
+    if not size:
         return False
 
-    relative_file_path = user_space_path + md5 + file_extension
-    final_absolute_path = media_path + relative_file_path
+    my_file = File_Tracking.objects(username=gif_username, checksum_md5=md5).first()
 
-    #if os.path.exists(final_absolute_path):
-    # File already exists on disk, we just ignore it
-    #return True
-
-    my_file = File_Tracking.objects(file_path=relative_file_path).first()
-
-    # A path is defined by the MD5, if there is a duplicate, it is either a collision or someone playing with
-    # this file / user. We could check if the user has changed, but the plan is to let users upgrade from
-    # anonymous into real users, and we might not want to move the final file.
-
-    # Eventually if the project grows, files in folders like this are not ideal and all this code should get revamped
+    # The content is stored once on the blob storage, other users might have uploaded this GIF already
 
     if my_file:
         #print(" FILE ALREADY UPLOADED WITH ID " + str(my_file.id))
@@ -108,14 +88,22 @@ def api_internal_gif_upload(f_request, media_info, file_name, file_extension, fi
     if file_type != "video":
         return
 
-    info = {}
-    try:
-        thumb_time = 1
+    def write_gif(target_path):
+        if isinstance(f_request, str):
+            shutil.move(f_request, target_path)
+            return
 
-        with open(final_absolute_path, 'wb') as f:
+        with open(target_path, 'wb') as f:
             f_request.seek(0)
             f.write(f_request.getvalue())
 
+    blob = media_blob_acquire(md5, file_extension, size, write_gif)
+    final_absolute_path = media_path + blob.file_path
+
+    import ffmpeg
+
+    info = {}
+    try:
         probe = ffmpeg.probe(final_absolute_path)
 
         video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
@@ -125,22 +113,22 @@ def api_internal_gif_upload(f_request, media_info, file_name, file_extension, fi
 
         target_path = final_absolute_path + ".PREVIEW.PNG"
 
-        thumb_time = duration / 3
-
-        if os.path.exists(target_path):
-            os.remove(target_path)
-
-        ffmpeg.input(final_absolute_path, ss=thumb_time).filter('scale', width, -1).output(target_path, vframes=1).run()
+        # Previews are shared with every upload of the same content
+        if not os.path.exists(target_path):
+            thumb_time = duration / 3
+            ffmpeg.input(final_absolute_path, ss=thumb_time).filter('scale', width,
+                                                                    -1).output(target_path, vframes=1).run()
 
     except Exception as e:
         print(" CRASH on loading image " + str(e))
-        #os.remove(final_absolute_path)
+        media_blob_release(md5)
         return False
 
     file_metadata = {
         'info': info,
         'file_name': file_name,
-        'file_path': relative_file_path,
+        'file_path': blob.file_path,
+        'has_preview': True,
         'file_type': file_type,
         'file_size': size,
         'file_format': file_extension,
@@ -158,6 +146,9 @@ def api_internal_gif_upload(f_request, media_info, file_name, file_extension, fi
         my_file = File_Tracking(**file_metadata)
         my_file.save()
 
+    # An existing GIF might come with new tags
+    gif_tag_index.update(str(my_file.id), file_metadata.get('tags', my_file.tags))
+
     return file_metadata
 
 
@@ -166,14 +157,21 @@ def api_capture_tenor_data(raw_data):
         return
 
     results = raw_data['results']
+
+    # A cached search returns the same results again, we check all of them in a single query
+    uuids = [raw_gif['id'] for raw_gif in results if 'id' in raw_gif]
+    known = set(DB_TenorGif.objects(external_uuid__in=uuids).distinct('external_uuid'))
+
+    # Older captures only have the id inside the raw data
+    known.update(DB_TenorGif.objects(__raw__={'raw.id': {'$in': uuids}}).distinct('raw.id'))
+
     for raw_gif in results:
         try:
-            tenor = DB_TenorGif.objects(external_uuid=raw_gif['id']).first()
-            if tenor:
+            if raw_gif.get('id') in known:
                 # Already indexed
                 continue
 
-            data = {'status': "WAITING_INDEX", 'tags': raw_gif['tags']}
+            data = {'status': "WAITING_INDEX", 'tags': raw_gif['tags'], 'external_uuid': raw_gif['id']}
 
             # Deduplicate, we move the tags out of the raw data
             del raw_gif['tags']
@@ -187,73 +185,56 @@ def api_capture_tenor_data(raw_data):
 
 @blueprint.route('/queue_process', methods=['GET', 'POST'])
 def api_gif_process_queue():
+    """ Downloads and indexes a batch of the GIFs we captured from Tenor.
 
-    try:
-        tenor_process = DB_TenorGif.objects(status="WAITING_INDEX").limit(100)
-
-        media_list = []
-        for tenor in tenor_process:
-
-            raw = tenor['raw']
-            mp4_url = raw['media_formats']['mp4']['url']
-
-            response = requests.get(mp4_url)
-            if response.status_code != 200:
-                tenor.update(**{'status': 'FAILED FETCHING' + str(response.status_code)})
-                return
-
-            parsed_url = urlparse(mp4_url)
-
-            # Extract the file name and extension
-            file_name_with_ext = os.path.basename(parsed_url.path)
-            file_name, file_extension = os.path.splitext(file_name_with_ext)
-
-            # Create a temporary file to store the gif data
-            gif_data = BytesIO(response.content)
-
-            media_info = {
-                'my_title': raw['title'],
-                'my_description': raw['content_description'],
-                'external_uuid': raw['id'],
-                'tags': tenor.tags,
-            }
-
-            media_list.append(media_info)
-
-            gif_obj = api_internal_gif_upload(gif_data, media_info, file_name, file_extension)
-
-            if not gif_obj:
-                tenor.update(**{'status': 'FAILED_PROCESSING'})
-            else:
-                tenor.update(**{'status': 'INDEXED'})
+    Example:
+        http://domain/api/gif/queue_process?limit=100
+    """
+    from .ingest import TENOR_BATCH_SIZE, tenor_ingest_queue
 
-        return get_response_formatted({'media': [media_list]})
+    try:
+        limit = int(request.args.get("limit", TENOR_BATCH_SIZE))
+    except ValueError:
+        limit = TENOR_BATCH_SIZE
 
-    except Exception as e:
-        print_exception(e, " CAPTURE TENOR ")
-        tenor.update(**{'status': 'CRASHED', 'exception': e})
+    report = tenor_ingest_queue(limit)
 
-        return get_response_formatted({'tenor': tenor, 'error': 'FAILED', 'exception': e})
+    # Legacy format, a list with the list of media
+    report['media'] = [report['media']]
+    return get_response_formatted(report)
 
 
 @blueprint.route('/gif', methods=['GET', 'POST'])
 def api_gif_get_from_request():
     """ """
-    from .sentiment import get_gif_for_sentiment
+    from .sentiment import get_gif_for_sentiment, get_local_gif_for_sentiment
 
     keywords = request.args.get("keywords", "SAD")
+    raw = request.args.get("raw", None)
+
+    # We only go to Tenor if we didn't index any GIF for this sentiment
+    my_file = get_local_gif_for_sentiment(keywords)
+    if my_file:
+        format = "mp4" if my_file.file_format.lower() == ".mp4" else "gif"
+
+        if raw:
+            ret = {"keywords": keywords, 'url': "/api/media/get/" + str(my_file.id), 'media_id': str(my_file.id),
+                   'format': format}
+            return get_response_formatted(ret)
+
+        abs_path = File_Tracking.get_media_path() + my_file.file_path
+        mimetype = 'video/mp4' if format == "mp4" else 'image/gif'
+        return send_file(abs_path, mimetype=mimetype, as_attachment=False, download_name='sentiment.' + format)
 
     raw_data, gif, format = get_gif_for_sentiment(keywords)
 
     api_capture_tenor_data(raw_data)
 
-    raw = request.args.get("raw", None)
-
     if raw:
         ret = {"keywords": keywords, 'url': gif, 'raw': raw_data, 'format': format}
         return get_response_formatted(ret)
 
-    response = requests.get(gif)
+    response = requests.get(gif, hooks=get_external_hooks("tenor"))
     if response.status_code != 200:
         return {"error": "Failed to download the gif"}, 500
 
@@ -1,6 +1,8 @@
 import re
+from bisect import bisect_right
 
 import requests
+from api.api_metrics import get_external_hooks
 from api.print_helper import *
 
 # Predefined lists of good and bad sentiment words
@@ -27,13 +29,23 @@ SENTIMENT_SCORES = {
 }
 
 
-# Giphy API key (you need to replace this with your own Giphy API key)
-def extract_sentiments(text):
-    # Split the text into words and filter out the sentiment-related words
-    words = re.findall(r'\b\w+\b', text.lower())  # Extract words, ignoring punctuation
-    sentiments = [word for word in words if word in SENTIMENT_SCORES]
-    return sentiments
+# The lexicon is compiled once, a single scan finds every sentiment word of a text
+SENTIMENT_MIN = min(SENTIMENT_SCORES.values())
+SENTIMENT_MAX = max(SENTIMENT_SCORES.values())
+
+SENTIMENT_REGEX = re.compile(r'\b(' + '|'.join(sorted(SENTIMENT_SCORES, key=len, reverse=True)) + r')\b',
+                             re.IGNORECASE)
+
+GOOD_SENTIMENTS_SET = frozenset(GOOD_SENTIMENTS)
+BAD_SENTIMENTS_SET = frozenset(BAD_SENTIMENTS)
 
+# Seconds we keep the GIF we picked for a sentiment
+SENTIMENT_CACHE_TTL = 600
+
+
+def extract_sentiments(text):
+    # Sentiment-related words in the text, ignoring punctuation and case
+    return [word.lower() for word in SENTIMENT_REGEX.findall(text)]
 
 
 # Function to compute the total sentiment score
@@ -41,37 +53,102 @@ def compute_sentiment_score(sentiment_words):
     if len(sentiment_words) == 0:
         return 0
 
-    min_score = 10
-    max_score = -10
-    for word in SENTIMENT_SCORES:
-        score = SENTIMENT_SCORES[word]
-        min_score = min(score, min_score)
-        max_score = max(score, max_score)
-
     score = sum(SENTIMENT_SCORES[word] for word in sentiment_words) / len(sentiment_words)
-    return score, min_score, max_score
+    return score, SENTIMENT_MIN, SENTIMENT_MAX
+
+
+def score_sentiment_texts(texts):
+    """ Scores a batch of texts in a single scan, returns [{'words': [...], 'score': ...}] in the same order """
+
+    # We join the texts and map every match back to its text by offset
+    offsets = []
+    position = 0
+    for text in texts:
+        offsets.append(position)
+        position += len(text) + 1
+
+    words = [[] for _ in texts]
+    for match in SENTIMENT_REGEX.finditer("\n".join(texts)):
+        words[bisect_right(offsets, match.start()) - 1].append(match.group(1).lower())
+
+    results = []
+    for text_words in words:
+        score = sum(SENTIMENT_SCORES[word] for word in text_words) / len(text_words) if text_words else 0
+        results.append({'words': text_words, 'score': score})
+
+    return results
 
 
 # Function to classify sentiment
 def classify_sentiment(sentiment_text):
     words = sentiment_text.lower().split()
     for word in words:
-        if word in GOOD_SENTIMENTS:
+        if word in GOOD_SENTIMENTS_SET:
             return "good"
-        elif word in BAD_SENTIMENTS:
+        elif word in BAD_SENTIMENTS_SET:
             return "bad"
     return "neutral"
 
 
-# Function to fetch GIF from Giphy based on sentiment
+def get_sentiment_query(sentiment):
+    if sentiment == "good":
+        return "happy"
+
+    if sentiment == "bad":
+        return "sad"
+
+    return sentiment
+
+
+def get_local_gif_for_sentiment(sentiment):
+    """ Best GIF we have indexed already for this sentiment, so we don't call the external APIs """
+    from api import cache
+    from api.media.models import File_Tracking
+
+    from .tag_index import gif_tag_index
+
+    query = get_sentiment_query(sentiment.lower())
+
+    key = "sentiment_local/" + query
+    media_id = cache.get(key)
+    if media_id is None:
+        matches = gif_tag_index.match(re.split(r"[\s,]+", query), 1)
+        media_id = matches[0][1] if matches else ""
+
+        # We also remember that we don't have anything, until the index gets new GIFs
+        cache.set(key, media_id, timeout=SENTIMENT_CACHE_TTL)
+
+    if not media_id:
+        return None
+
+    return File_Tracking.objects(pk=media_id).first()
+
+
 def get_gif_for_sentiment(sentiment):
+    """ Returns (raw_data, url, format) from Tenor or Giphy, the results are cached for a while """
+    from api import cache
+
+    key = "sentiment_gif/" + sentiment.lower()
+    cached = cache.get(key)
+    if cached:
+        return cached
+
+    ret = get_remote_gif_for_sentiment(sentiment)
+    if ret[2]:
+        cache.set(key, ret, timeout=SENTIMENT_CACHE_TTL)
+
+    return ret
+
+
+# Function to fetch GIF from Giphy based on sentiment
+def get_remote_gif_for_sentiment(sentiment):
     from flask import current_app
 
     TENOR_API_KEY = current_app.config.get("TENOR_API_KEY", None)
     if TENOR_API_KEY:
         try:
             url = f"https://tenor.googleapis.com/v2/search?q={sentiment}&key={TENOR_API_KEY}&client_key=TOTHEMOON&limit=8"
-            response = requests.get(url)
+            response = requests.get(url, timeout=10, hooks=get_external_hooks("tenor"))
             data = response.json()
 
             if not 'results' in data or len(data['results']) == 0:
@@ -97,15 +174,10 @@ def get_gif_for_sentiment(sentiment):
         print_r(" MISSING GIPHY KEY ")
         return None, None, None
 
-    if sentiment == "good":
-        query = "happy"
-    elif sentiment == "bad":
-        query = "sad"
-    else:
-        query = sentiment
+    query = get_sentiment_query(sentiment)
 
     url = f"https://api.giphy.com/v1/gifs/search?api_key={GIPHY_API_KEY}&q={query}&limit=1"
-    response = requests.get(url)
+    response = requests.get(url, timeout=10, hooks=get_external_hooks("giphy"))
     data = response.json()
 
     if data['data']:
@@ -0,0 +1,247 @@
+"""
+    Inverted index of the GIF tags.
+
+    Each process keeps tag => sorted list of the GIF media ids (posting lists), so a match
+    only reads the lists of the keywords we are looking for instead of scanning every media.
+
+    Synonyms come from the tag dictionary (DB_Tags.related), a keyword matches its related tags too.
+    New GIFs are added on ingest, other processes load them incrementally on the next refresh.
+    Deleted and retagged GIFs are updated on the process that changed them, the rest of the processes
+    build the whole index again every INDEX_REBUILD_SECONDS.
+
+    The database is read without the lock, the lock is only held to swap or update the lists.
+"""
+
+import heapq
+import threading
+import time
+from bisect import bisect_left, insort
+
+from api.media.models import File_Tracking
+from api.print_helper import *
+from api.tags.models import DB_Tags
+from bson import ObjectId
+
+GIF_USERNAME = "GIF"
+
+# Seconds between checks for new GIFs on the database
+INDEX_REFRESH_SECONDS = 5
+
+# Seconds between full rebuilds, they drop the GIFs that other processes deleted or retagged
+INDEX_REBUILD_SECONDS = 600
+
+# The dictionary barely changes
+SYNONYMS_REFRESH_SECONDS = 300
+
+MATCH_DEFAULT_LIMIT = 25
+MATCH_MAX_LIMIT = 500
+
+
+def normalize_tag(tag):
+    return tag.strip().lower()
+
+
+class GifTagIndex():
+    """ Posting lists tag => [media_id] sorted by id, and media_id => tags to return them without a query """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.postings = {}
+        self.media_tags = {}
+        self.synonyms = {}
+
+        self.last_id = None
+        self.last_refresh = 0
+        self.last_rebuild = 0
+        self.last_synonyms = 0
+
+    def add(self, media_id, tags):
+        """ Adds a media to the posting lists of its tags, ids are ObjectId strings so they sort by creation """
+
+        if media_id in self.media_tags:
+            return
+
+        tags = list(dict.fromkeys(normalize_tag(tag) for tag in tags or [] if tag))
+        self.media_tags[media_id] = tags
+
+        for tag in tags:
+            posting = self.postings.setdefault(tag, [])
+            if not posting or posting[-1] < media_id:
+                posting.append(media_id)
+            else:
+                insort(posting, media_id)
+
+    def remove(self, media_id):
+        tags = self.media_tags.pop(media_id, None)
+        if not tags:
+            return
+
+        for tag in tags:
+            posting = self.postings.get(tag)
+            if not posting:
+                continue
+
+            idx = bisect_left(posting, media_id)
+            if idx < len(posting) and posting[idx] == media_id:
+                posting.pop(idx)
+
+    def update(self, media_id, tags):
+        """ Replaces the tags of a media, tags=None removes it from the index """
+
+        with self.lock:
+            self.remove(media_id)
+            if tags is not None:
+                self.add(media_id, tags)
+
+    @staticmethod
+    def fetch_synonyms():
+        synonyms = {}
+        fields = {'_id': 0, 'tag': 1, 'related': 1}
+        for raw in DB_Tags._get_collection().find({'related.0': {'$exists': True}}, fields):
+            if not raw.get('tag'):
+                continue
+
+            tag = normalize_tag(raw['tag'])
+            for related in raw['related']:
+                related = normalize_tag(related)
+                if not related or related == tag:
+                    continue
+
+                # Synonyms work both ways
+                synonyms.setdefault(tag, set()).add(related)
+                synonyms.setdefault(related, set()).add(tag)
+
+        return synonyms
+
+    @staticmethod
+    def fetch_media(last_id=None):
+        """ [(media_id, tags)] of the GIFs after last_id, sorted by id """
+
+        query = {'username': GIF_USERNAME}
+        if last_id:
+            query['_id'] = {'$gt': ObjectId(last_id)}
+
+        cursor = File_Tracking._get_collection().find(query, {'tags': 1}).sort('_id', 1)
+        return [(str(raw['_id']), raw.get('tags')) for raw in cursor]
+
+    def refresh(self, force=False):
+        """ Loads what changed on the database. Only one thread refreshes, the rest keep using the index """
+
+        now = time.time()
+        with self.lock:
+            load_synonyms = force or now - self.last_synonyms >= SYNONYMS_REFRESH_SECONDS
+            rebuild = force or now - self.last_rebuild >= INDEX_REBUILD_SECONDS
+            load_media = rebuild or now - self.last_refresh >= INDEX_REFRESH_SECONDS
+
+            if load_synonyms:
+                self.last_synonyms = now
+
+            if rebuild:
+                self.last_rebuild = now
+
+            if load_media:
+                self.last_refresh = now
+
+            last_id = self.last_id
+
+        if load_synonyms:
+            synonyms = self.fetch_synonyms()
+            with self.lock:
+                self.synonyms = synonyms
+
+        if rebuild:
+            fresh = GifTagIndex()
+            for media_id, tags in self.fetch_media():
+                fresh.add(media_id, tags)
+                fresh.last_id = media_id
+
+            with self.lock:
+                # GIFs added while we were reading have newer ids, the next refresh loads them again
+                self.postings = fresh.postings
+                self.media_tags = fresh.media_tags
+                self.last_id = fresh.last_id
+
+            print_b(" GIF TAG INDEX " + str(len(self.media_tags)) + " media " + str(len(self.postings)) + " tags ")
+            return
+
+        if not load_media:
+            return
+
+        media = self.fetch_media(last_id)
+        with self.lock:
+            for media_id, tags in media:
+                self.add(media_id, tags)
+                if not self.last_id or self.last_id < media_id:
+                    self.last_id = media_id
+
+    def get_keyword_groups(self, keywords):
+        """ Every keyword becomes the set of tags that match it, itself and its synonyms """
+
+        groups = []
+        for keyword in keywords:
+            keyword = normalize_tag(keyword)
+            if not keyword:
+                continue
+
+            group = {keyword} | self.synonyms.get(keyword, set())
+            if group not in groups:
+                groups.append(group)
+
+        return groups
+
+    def get_group_media(self, group):
+        """ Media ids with any tag of the group """
+
+        if len(group) == 1:
+            return self.postings.get(next(iter(group)), [])
+
+        media = set()
+        for tag in group:
+            media.update(self.postings.get(tag, []))
+
+        return media
+
+    def match(self, keywords, limit=MATCH_DEFAULT_LIMIT, match_all=False):
+        """ Returns [(match_count, media_id)] of the best N media.
+            match_count is how many keywords (or one of its synonyms) the media has.
+            match_all returns only the media that matches every keyword.
+        """
+
+        self.refresh()
+
+        with self.lock:
+            groups = self.get_keyword_groups(keywords)
+            if not groups:
+                return []
+
+            group_media = [self.get_group_media(group) for group in groups]
+
+            if match_all:
+                # Start from the shortest list, the intersection can only get smaller
+                group_media.sort(key=len)
+                candidates = set(group_media[0])
+                for media in group_media[1:]:
+                    candidates.intersection_update(media)
+                    if not candidates:
+                        return []
+
+                scores = ((len(groups), media_id) for media_id in candidates)
+            else:
+                counts = {}
+                for media in group_media:
+                    for media_id in media:
+                        counts[media_id] = counts.get(media_id, 0) + 1
+
+                scores = ((count, media_id) for media_id, count in counts.items())
+
+            # Ties go to the newest media, the ids sort by creation
+            return heapq.nlargest(limit, scores)
+
+    def get_tags(self, media_id):
+        return self.media_tags.get(media_id, [])
+
+
+gif_tag_index = GifTagIndex()
@@ -1,10 +1,28 @@
+import hashlib
+import json
+import os
+import time
+
 import validators
 from api import get_response_error_formatted, get_response_formatted
-from api.api_redis import api_rq
+from api.api_redis import JobEnqueueBusy, api_rq
 from api.jobs import blueprint
 from api.media.models import File_Tracking
-from flask import abort, send_file
+from api.query_helper import is_mongo_id
+from api.tools import is_api_call
+from flask import (Response, abort, redirect, request, send_file,
+                   stream_with_context)
 from flask_login import current_user
+from services.imaging import OPERATIONS
+from services.job_events import get_job_channel, get_job_state_key
+
+# Limits for the clients waiting on jobs
+WAIT_MAX_JOBS = 100
+WAIT_MAX_TIMEOUT = 300
+WAIT_DEFAULT_TIMEOUT = 30
+
+# Seconds between SSE comments, so proxies don't close an idle stream
+SSE_KEEP_ALIVE = 15
 
 
 def get_postfix(operation, transformation):
@@ -81,6 +99,21 @@ def api_convert_image_to_format(operation, transformation, media_id):
     post_fix = get_postfix(operation, transformation)
     abs_path = File_Tracking.get_media_path() + my_file.file_path
 
+    job_id = get_job_id(my_file, operation, transformation)
+
+    result = {
+        'state': 'success',
+        'operation': operation,
+        'transformation': transformation,
+        'media_id': media_id,
+        'checksum_md5': my_file.checksum_md5
+    }
+
+    # Somebody already generated this file, we don't have to bother the workers
+    if os.path.exists(abs_path + post_fix):
+        ret = {'status': 'success', 'job_id': job_id, 'job_status': 'finished', 'result': result}
+        return get_response_formatted(ret)
+
     data = {
         'media_id': media_id,
         'media_path': abs_path,
@@ -88,10 +121,14 @@ def api_convert_image_to_format(operation, transformation, media_id):
         'target_path': abs_path + post_fix,
         'transformation': transformation,
         'post_fix': post_fix,
-        'media_id': media_id
+        'checksum_md5': my_file.checksum_md5
     }
 
-    job = api_rq.call("worker.convert_image", data)
+    # If the same job is already waiting or running we get that one
+    try:
+        job = api_rq.call_unique("worker.convert_image", data, job_id)
+    except JobEnqueueBusy:
+        return get_response_error_formatted(409, {'error_msg': "This job is being queued, try again."})
     if not job:
         return get_response_error_formatted(401, {'error_msg': "Failed reaching the services."})
 
@@ -99,6 +136,219 @@ def api_convert_image_to_format(operation, transformation, media_id):
     return get_response_formatted(ret)
 
 
+def get_job_id(my_file, operation, transformation):
+    """ The same conversion of the same content is always the same job <md5>.<operation>.<transformation>
+        Legacy media without a checksum uses its media id instead, the job is only shared by that media.
+    """
+    return (my_file.checksum_md5 or str(my_file.id)) + "." + operation + "." + transformation
+
+
+def get_finished_job_from_disk(job_id):
+    """ Jobs expire on redis but their outputs stay on disk.
+        Returns the result of a conversion job from its id if the file exists, or None.
+    """
+
+    arr = job_id.split(".")
+    if len(arr) != 3 or arr[1] == "pipeline":
+        return None
+
+    content_id, operation, transformation = arr
+    if operation not in OPERATIONS or transformation not in OPERATIONS[operation]:
+        return None
+
+    # Media without a checksum use their id
+    if is_mongo_id(content_id):
+        my_file = get_job_media_file({'media_id': content_id})
+    else:
+        my_file = get_job_media_file({'checksum_md5': content_id})
+
+    if not my_file:
+        return None
+
+    abs_path = File_Tracking.get_media_path() + my_file.file_path + get_postfix(operation, transformation)
+    if not os.path.exists(abs_path):
+        return None
+
+    return {
+        'state': 'success',
+        'operation': operation,
+        'transformation': transformation,
+        'media_id': str(my_file.id),
+        'checksum_md5': my_file.checksum_md5
+    }
+
+
+def get_job_media_file(result):
+    """ Jobs are shared by everyone with the same content, so we look for the media of this user first.
+        Then a public one, and finally the one that requested the job.
+    """
+
+    checksum_md5 = result.get('checksum_md5')
+    if checksum_md5:
+        if current_user.is_authenticated:
+            my_file = File_Tracking.objects(checksum_md5=checksum_md5, username=current_user.username).first()
+            if my_file:
+                return my_file
+
+        my_file = File_Tracking.objects(checksum_md5=checksum_md5, is_public=True).first()
+        if my_file:
+            return my_file
+
+    if not result.get('media_id'):
+        return None
+
+    return File_Tracking.objects(pk=result['media_id']).first()
+
+
+def get_pipeline_postfix(steps, image_format):
+    """ Every step adds its operation to the name .transform_rotate_right.filter_blur.PNG
+        With a single step it is the same file that /api/jobs/<operation>/<transformation> generates.
+    """
+
+    postfix = ""
+    for step in steps:
+        postfix += get_postfix(step['operation'], step['transformation'])[:-len(".PNG")]
+
+    return postfix + "." + image_format
+
+
+def get_pipeline_steps(my_json):
+    """ Steps can come as [{'operation': 'filter', 'transformation': 'blur'}] or as ['filter/blur'] """
+
+    steps = []
+    for step in my_json.get('steps', []):
+        if isinstance(step, str):
+            if "/" not in step:
+                return None
+
+            operation, transformation = step.split("/", 1)
+            step = {'operation': operation, 'transformation': transformation}
+
+        operation = step.get('operation')
+        transformation = step.get('transformation')
+
+        if operation not in OPERATIONS or transformation not in OPERATIONS[operation]:
+            return None
+
+        steps.append({'operation': operation, 'transformation': transformation})
+
+    return steps
+
+
+def get_pipeline_outputs(my_json, steps, abs_path):
+    """ Outputs can be formats ['PNG', 'JPG'] which are saved after the last step,
+        or {'format': 'PNG', 'step': 0} to save after a particular step (-1 is the original).
+    """
+
+    outputs = []
+    for output in my_json.get('outputs', ['PNG']):
+        if isinstance(output, str):
+            output = {'format': output}
+
+        image_format = str(output.get('format', 'PNG')).upper()
+        if image_format not in OPERATIONS['convert']:
+            return None
+
+        step = int(output.get('step', len(steps) - 1))
+        if step < -1 or step >= len(steps):
+            return None
+
+        post_fix = get_pipeline_postfix(steps[:step + 1], image_format)
+        outputs.append({'format': image_format, 'step': step, 'post_fix': post_fix, 'target_path': abs_path + post_fix})
+
+    return outputs
+
+
+@blueprint.route('/pipeline/<string:media_id>', methods=['POST'])
+def api_process_image_pipeline(media_id):
+    """Returns a JOB ID for a chain of operations on a media. The image is decoded once and every output is encoded from it.
+    ---
+    tags:
+      - jobs
+    schemes: ['http', 'https']
+    deprecated: false
+    definitions:
+      job_id:
+        type: object
+    parameters:
+        - in: query
+          name: media_id
+          schema:
+            type: string
+          description: A valid media_id which belongs to this user or is PUBLIC
+        - in: body
+          name: steps
+          schema:
+            type: array
+          description: Ordered operations, ["transform/rotate_right", "filter/blur", "generate/thumbnail_256"]
+        - in: body
+          name: outputs
+          schema:
+            type: array
+          description: Formats to encode after the last step ["PNG", "JPG"] or {"format":"PNG", "step":0} after a step
+
+    responses:
+      200:
+        description: Returns a job ID and the outputs it will generate. You have to call /api/jobs/job/{ job_id } to get when it is ready.
+      400:
+        description: The steps or the outputs are not valid
+      401:
+        description: Internal failure reaching our services
+      404:
+        description: File not found
+    """
+
+    my_json = request.json or {}
+
+    steps = get_pipeline_steps(my_json)
+    if not steps:
+        return get_response_error_formatted(400, {"error_msg": "SERVER CANNOT UNDERSTAND THESE STEPS!"})
+
+    my_file = File_Tracking.objects(pk=media_id).first()
+    if not my_file:
+        return get_response_error_formatted(404, {"error_msg": "FILE NOT FOUND"})
+
+    abs_path = File_Tracking.get_media_path() + my_file.file_path
+
+    outputs = get_pipeline_outputs(my_json, steps, abs_path)
+    if not outputs:
+        return get_response_error_formatted(400, {"error_msg": "SERVER CANNOT UNDERSTAND THESE OUTPUTS!"})
+
+    post_fixes = [output['post_fix'] for output in outputs]
+    job_id = get_job_id(my_file, "pipeline", hashlib.sha1("|".join(post_fixes).encode()).hexdigest())
+
+    # Every output is already on disk, we don't have to bother the workers
+    if all([os.path.exists(output['target_path']) for output in outputs]):
+        result = {
+            'state': 'success',
+            'media_id': media_id,
+            'checksum_md5': my_file.checksum_md5,
+            'steps': steps,
+            'outputs': [{key: value for key, value in output.items() if key != 'target_path'} for output in outputs]
+        }
+
+        ret = {'status': 'success', 'job_id': job_id, 'job_status': 'finished', 'result': result, 'outputs': post_fixes}
+        return get_response_formatted(ret)
+
+    data = {
+        'media_id': media_id,
+        'media_path': abs_path,
+        'checksum_md5': my_file.checksum_md5,
+        'steps': steps,
+        'outputs': outputs,
+    }
+
+    try:
+        job = api_rq.call_unique("worker.process_pipeline", data, job_id)
+    except JobEnqueueBusy:
+        return get_response_error_formatted(409, {'error_msg': "This job is being queued, try again."})
+    if not job:
+        return get_response_error_formatted(401, {'error_msg': "Failed reaching the services."})
+
+    ret = {'status': 'success', 'job_id': job.id, 'outputs': post_fixes}
+    return get_response_formatted(ret)
+
+
 @blueprint.route('/job/<string:job_id>', methods=['GET'])
 def api_get_media_from_job(job_id):
     """Returns the state of a job_id and it's result
@@ -133,7 +383,13 @@ def api_get_media_from_job(job_id):
       500:
         description: There was some problem performing this task
     """
-    job = api_rq.fetch_job(job_id)
+    job = api_rq.get_job(job_id)
+    if not job:
+        result = get_finished_job_from_disk(job_id)
+        if not result:
+            return get_response_error_formatted(404, {'error_msg': "Job not found."})
+
+        return get_response_formatted({'status': 'success', 'job_id': job_id, 'job_status': 'finished', 'result': result})
 
     status = job.get_status()
     if status == "failed":
@@ -145,6 +401,10 @@ def api_get_media_from_job(job_id):
         return get_response_formatted(ret)
 
     ret['result'] = job.result
+
+    if 'timings' in job.meta:
+        ret['timings'] = job.meta['timings']
+
     return get_response_formatted(ret)
 
 
@@ -187,9 +447,20 @@ def api_get_result_job(job_id):
         description: There was some problem performing this task
 
     """
-    job = api_rq.fetch_job(job_id)
+    job = api_rq.get_job(job_id)
+    if not job:
+        res = get_finished_job_from_disk(job_id)
+        if not res:
+            if is_api_call():
+                return get_response_error_formatted(404, {'error_msg': "Job not found."})
+            else:
+                return redirect("/static/img-api/images/placeholder.jpg")
+
+        status = "finished"
+    else:
+        status = job.get_status()
+        res = job.result
 
-    status = job.get_status()
     if status == "failed":
         if is_api_call():
             return get_response_error_formatted(
@@ -205,9 +476,7 @@ def api_get_result_job(job_id):
 
         return (ret)
 
-    res = job.result
-
-    my_file = File_Tracking.objects(pk=res['media_id']).first()
+    my_file = get_job_media_file(res)
     if not my_file:
         if is_api_call():
             return get_response_error_formatted(404, {"error_msg": "FILE NOT FOUND"})
@@ -220,6 +489,203 @@ def api_get_result_job(job_id):
         else:
             return redirect("/static/img-api/images/placeholder_private.jpg")
 
-    post_fix = get_postfix(res['operation'], res['transformation'])
+    if 'outputs' in res:
+        # Pipelines have several outputs, we return the last one unless the client asks for another
+        try:
+            output = res['outputs'][int(request.args.get('output', -1))]
+        except (ValueError, IndexError):
+            return get_response_error_formatted(400, {
+                "error_msg": "Wrong output, this pipeline has " + str(len(res['outputs'])) + " outputs"
+            })
+
+        post_fix = output['post_fix']
+    else:
+        post_fix = get_postfix(res['operation'], res['transformation'])
+
     abs_path = File_Tracking.get_media_path() + my_file.file_path + post_fix
+
+    # Media which is not on the blob storage yet has its own copy, the output is next to the one that requested it
+    if not os.path.exists(abs_path) and res.get('media_id') and res['media_id'] != str(my_file.id):
+        source_file = File_Tracking.objects(pk=res['media_id']).first()
+        if source_file:
+            abs_path = File_Tracking.get_media_path() + source_file.file_path + post_fix
+
     return send_file(abs_path, download_name=my_file.file_name + post_fix)
+
+
+def get_wait_job_ids():
+    """ Job ids can come as ?job_id=a&job_id=b or ?job_id=a,b """
+
+    job_ids = []
+    for value in request.args.getlist('job_id'):
+        job_ids.extend([job_id for job_id in value.split(",") if job_id])
+
+    return list(dict.fromkeys(job_ids))[:WAIT_MAX_JOBS]
+
+
+def get_wait_timeout():
+    try:
+        timeout = int(request.args.get('timeout', WAIT_DEFAULT_TIMEOUT))
+    except ValueError:
+        timeout = WAIT_DEFAULT_TIMEOUT
+
+    return max(0, min(timeout, WAIT_MAX_TIMEOUT))
+
+
+def get_ended_job_states(job_ids):
+    """ Returns the states of the jobs that already ended, with a single MGET on the states the worker publishes """
+
+    states = []
+    values = api_rq.conn.mget([get_job_state_key(job_id) for job_id in job_ids])
+
+    for job_id, value in zip(job_ids, values):
+        if value:
+            states.append(json.loads(value))
+            continue
+
+        # Jobs that expired or that ended before the worker published its states
+        job = api_rq.get_job(job_id)
+        if not job:
+            result = get_finished_job_from_disk(job_id)
+            if result:
+                states.append({'job_id': job_id, 'job_status': 'finished', 'result': result})
+            else:
+                states.append({'job_id': job_id, 'job_status': 'not_found'})
+
+            continue
+
+        status = job.get_status()
+        if status == 'finished':
+            states.append({'job_id': job_id, 'job_status': status, 'result': job.result})
+
+        elif status == 'failed':
+            states.append({'job_id': job_id, 'job_status': status})
+
+    return states
+
+
+def iterate_job_states(job_ids, timeout):
+    """ Yields the job transitions as the workers publish them, until every job ended or the timeout.
+        Yields None every second without news, so the caller can keep alive the connection.
+    """
+
+    pending = set(job_ids)
+
+    # Subscribe before we check, a job that ends in the meanwhile will be on the channel
+    pubsub = api_rq.conn.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(*[get_job_channel(job_id) for job_id in job_ids])
+
+    try:
+        for state in get_ended_job_states(job_ids):
+            pending.discard(state['job_id'])
+            yield state
+
+        deadline = time.time() + timeout
+        while pending and time.time() < deadline:
+            message = pubsub.get_message(timeout=min(1.0, max(deadline - time.time(), 0.01)))
+            if not message:
+                yield None
+                continue
+
+            state = json.loads(message['data'])
+            if state['job_id'] not in pending:
+                continue
+
+            if state['job_status'] in ['finished', 'failed']:
+                pending.discard(state['job_id'])
+
+            yield state
+    finally:
+        pubsub.close()
+
+
+@blueprint.route('/wait', methods=['GET'])
+def api_wait_for_jobs():
+    """Waits until the jobs end (long poll) and returns their states and results
+    ---
+    tags:
+      - jobs
+    schemes: ['http', 'https']
+    deprecated: false
+    parameters:
+        - in: query
+          name: job_id
+          schema:
+            type: string
+          description: One or more job ids, ?job_id=a&job_id=b or ?job_id=a,b
+        - in: query
+          name: timeout
+          schema:
+            type: integer
+          description: Seconds to wait before we return the jobs that are still pending
+    responses:
+      200:
+        description: The state of the jobs that ended and the list of the ones still pending
+      400:
+        description: No jobs to wait for
+    """
+
+    job_ids = get_wait_job_ids()
+    if not job_ids:
+        return get_response_error_formatted(400, {'error_msg': "No jobs to wait for."})
+
+    jobs = {}
+    for state in iterate_job_states(job_ids, get_wait_timeout()):
+        if state and state['job_status'] not in ['started']:
+            jobs[state['job_id']] = state
+
+    pending = [job_id for job_id in job_ids if job_id not in jobs]
+
+    ret = {'status': 'success', 'jobs': jobs, 'pending': pending}
+    return get_response_formatted(ret)
+
+
+@blueprint.route('/events', methods=['GET'])
+def api_job_events():
+    """Server sent events with the transitions of the jobs (started, finished, failed) and their results
+    ---
+    tags:
+      - jobs
+    schemes: ['http', 'https']
+    deprecated: false
+    parameters:
+        - in: query
+          name: job_id
+          schema:
+            type: string
+          description: One or more job ids, ?job_id=a&job_id=b or ?job_id=a,b
+        - in: query
+          name: timeout
+          schema:
+            type: integer
+          description: Seconds to keep the stream open
+    responses:
+      200:
+        description: A text/event-stream, every event is a json with job_id, job_status and result
+      400:
+        description: No jobs to wait for
+    """
+
+    job_ids = get_wait_job_ids()
+    if not job_ids:
+        return get_response_error_formatted(400, {'error_msg': "No jobs to wait for."})
+
+    timeout = get_wait_timeout()
+
+    def generate():
+        idle = 0
+        for state in iterate_job_states(job_ids, timeout):
+            if not state:
+                idle += 1
+                if idle >= SSE_KEEP_ALIVE:
+                    idle = 0
+                    yield ": keep-alive\n\n"
+                continue
+
+            idle = 0
+            yield "event: job\ndata: " + json.dumps(state, default=str) + "\n\n"
+
+        yield "event: done\ndata: {}\n\n"
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=headers)
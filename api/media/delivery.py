@@ -0,0 +1,109 @@
+import os
+from datetime import datetime, timezone
+
+from api.print_helper import *
+from flask import Response, current_app, redirect, request, send_file
+
+# Content addressed URLs never change, browsers and CDNs can keep them for a year
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+DEFAULT_MAX_AGE = 48 * 60 * 60
+
+
+def get_media_version(my_file):
+    """ Short version of the checksum, it changes if the content changes """
+    if not my_file.checksum_md5:
+        return None
+
+    return my_file.checksum_md5[:12]
+
+
+def get_media_etag(my_file, rendition=None):
+    """ Strong ETag from the file content and the rendition we are serving, example .v256.PNG """
+    etag = my_file.checksum_md5 or str(my_file.id)
+    if rendition:
+        etag += "-" + rendition.strip(".").replace(".", "-")
+
+    return etag
+
+
+def get_media_immutable_url(my_file, rendition=""):
+    """ Returns an URL we can cache forever, the version parameter changes with the content """
+    url = "/api/media/get/" + str(my_file.id) + rendition
+
+    version = get_media_version(my_file)
+    if version:
+        url += "?v=" + version
+
+    return url
+
+
+def is_immutable_request(my_file):
+    version = request.args.get("v")
+    return version is not None and version == get_media_version(my_file)
+
+
+def set_media_cache_headers(response, my_file):
+    """ Private media should never be stored by shared caches """
+
+    cache_control = "public" if my_file.is_public else "private"
+
+    if is_immutable_request(my_file):
+        cache_control += ", max-age=%d, immutable" % IMMUTABLE_MAX_AGE
+    else:
+        cache_control += ", max-age=%d" % DEFAULT_MAX_AGE
+
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
+def redirect_media_static(my_file, relative_path):
+    response = redirect("/static/MEDIA_FILES/" + relative_path)
+    return set_media_cache_headers(response, my_file)
+
+
+def send_media_file(my_file, abs_path, relative_path, download_name, rendition=None, mimetype=None):
+    """ Sends a file from our media folder with ETag, Last-Modified and Range support.
+
+        If MEDIA_ACCEL_REDIRECT is configured (example "/protected/MEDIA_FILES/") we only return the headers
+        and nginx streams the bytes from an internal location.
+        USE_X_SENDFILE is the flask setting for apache / lighttpd.
+    """
+
+    etag = get_media_etag(my_file, rendition)
+    last_modified = datetime.fromtimestamp(os.path.getmtime(abs_path), tz=timezone.utc)
+
+    accel_redirect = current_app.config.get("MEDIA_ACCEL_REDIRECT")
+    if accel_redirect:
+        response = Response(mimetype=mimetype)
+        if not mimetype:
+            # Nginx will find the type from the extension of the internal location
+            del response.headers['Content-Type']
+
+        response.headers['X-Accel-Redirect'] = accel_redirect + relative_path
+        response.headers['Content-Disposition'] = "inline; filename=\"%s\"" % download_name
+        response.set_etag(etag)
+        response.last_modified = last_modified
+
+        set_media_cache_headers(response, my_file)
+        return response.make_conditional(request)
+
+    response = send_file(abs_path,
+                         mimetype=mimetype,
+                         download_name=download_name,
+                         conditional=True,
+                         etag=etag,
+                         last_modified=last_modified)
+
+    return set_media_cache_headers(response, my_file)
+
+
+def get_media_not_modified(my_file, rendition=None):
+    """ Returns a 304 if the client already has this version, so we don't even touch the disk """
+
+    etag = get_media_etag(my_file, rendition)
+    if not request.if_none_match or not request.if_none_match.contains(etag):
+        return None
+
+    response = Response(status=304)
+    response.set_etag(etag)
+    return set_media_cache_headers(response, my_file)
@@ -9,12 +9,41 @@ from imgapi_launcher import db
 from mongoengine import *
 
 
+class DB_MediaBlob(db.DynamicDocument):
+    """ Content addressed file on disk, shared by every File_Tracking with the same checksum.
+        The file and its renditions are removed when the last reference is released.
+    """
+    meta = {
+        'strict': False,
+        'indexes': ['checksum_md5'],
+    }
+
+    BLOB_FOLDER = "BLOBS/"
+
+    checksum_md5 = db.StringField(unique=True)
+    file_format = db.StringField()
+    file_path = db.StringField()
+    file_size = db.LongField()
+    ref_count = db.IntField(default=0)
+
+    creation_date = db.DateTimeField()
+
+    @staticmethod
+    def get_blob_path(checksum_md5, extension):
+        """ Sharded as ab/cd/<md5> so we don't end with millions of files in a single folder """
+        return DB_MediaBlob.BLOB_FOLDER + checksum_md5[0:2] + "/" + checksum_md5[2:4] + "/" + checksum_md5 + extension
+
+    @staticmethod
+    def is_blob_path(file_path):
+        return file_path and file_path.startswith(DB_MediaBlob.BLOB_FOLDER)
+
+
 class File_Tracking(DB_UserCheck, db.DynamicDocument):
     meta = {
         'strict': False,
         "auto_create_index": False,
         "index_background": True,
-        'indexes': ['username', 'tags', 'creation_date']
+        'indexes': ['username', 'tags', 'creation_date', 'checksum_md5', 'phash_date', ('username', 'creation_date', 'id')]
     }
 
     file_format = db.StringField()
@@ -41,6 +70,16 @@ class File_Tracking(DB_UserCheck, db.DynamicDocument):
     # Did we process this file with our services
     processed = db.BooleanField(default=False)
 
+    # Worker job that generates the info and previews after the upload (videos)
+    processing_job_id = db.StringField()
+    processing_state = db.StringField()
+
+    # Perceptual hashes to find near duplicates, check api/media/similarity.py
+    ahash = db.StringField()
+    dhash = db.StringField()
+    phash = db.StringField()
+    phash_date = db.DateTimeField()
+
     is_NSFW = db.BooleanField(default=False)
     is_anon = db.BooleanField(default=False)
     is_cover = db.BooleanField(default=False)
@@ -98,13 +137,70 @@ class File_Tracking(DB_UserCheck, db.DynamicDocument):
         ret.reload()
         return ret
 
+    def get_stream_neighbour(self, position, only_public=True):
+        """ Returns the media of the same user next (position > 0) or previous to this one on the photostream.
+            It is a range query on (username, creation_date, _id), so it costs the same for any stream size.
+            The stream wraps around when we reach the end.
+        """
+
+        query = Q(username=self.username) & Q(info__exists=True)
+        if only_public:
+            query &= Q(is_public=True) & (Q(is_unlisted=False) | Q(is_unlisted=None))
+
+        if position >= 0:
+            order = ('+creation_date', '+id')
+            after = Q(creation_date__gt=self.creation_date) | (Q(creation_date=self.creation_date) & Q(id__gt=self.id))
+        else:
+            order = ('-creation_date', '-id')
+            after = Q(creation_date__lt=self.creation_date) | (Q(creation_date=self.creation_date) & Q(id__lt=self.id))
+
+        # Legacy media without a creation date can only start the stream again
+        if self.creation_date:
+            skip = max(abs(position) - 1, 0)
+
+            media = File_Tracking.objects(query & after).order_by(*order).skip(skip).first()
+            if media:
+                return media
+
+        return File_Tracking.objects(query).order_by(*order).first()
+
+    def get_legacy_path(self):
+        """ Path where we used to store the files before the blob storage <username>/<md5><ext> """
+        return self.username + "/" + self.checksum_md5 + self.file_format
+
     def delete(self, *args, **kwargs):
-        abs_path = self.get_media_path() + self.file_path
+        from api.media.storage import media_blob_release
+
+        if DB_MediaBlob.is_blob_path(self.file_path):
+            media_blob_release(self.checksum_md5)
+
+            # The migration leaves a hard link on the old location
+            abs_path = self.get_media_path() + self.get_legacy_path()
+        else:
+            abs_path = self.get_media_path() + self.file_path
+
         if os.path.exists(abs_path):
             os.remove(abs_path)
 
         print(" FILE DELETED ")
-        return super(File_Tracking, self).delete(*args, **kwargs)
+        ret = super(File_Tracking, self).delete(*args, **kwargs)
+
+        if self.phash:
+            from api.media.similarity import media_hash_index
+            media_hash_index.remove(self.phash, str(self.id))
+
+        self.update_gif_index(deleted=True)
+        return ret
+
+    def update_gif_index(self, deleted=False):
+        """ GIFs are on the tag index of this process, check api/gif/tag_index.py """
+
+        from api.gif.tag_index import GIF_USERNAME, gif_tag_index
+
+        if self.username != GIF_USERNAME:
+            return
+
+        gif_tag_index.update(str(self.id), None if deleted else self.tags)
 
     def exists(self):
         abs_path = self.get_media_path() + self.file_path
@@ -145,6 +241,10 @@ class File_Tracking(DB_UserCheck, db.DynamicDocument):
         if update:
             self.update(**update, validate=False)
 
+        if key == 'tags':
+            self.tags = value
+            self.update_gif_index()
+
         return True
 
     def update_with_checks(self, json):
@@ -168,10 +268,15 @@ class File_Tracking(DB_UserCheck, db.DynamicDocument):
             self.update(**update, validate=False)
             self.reload()
 
+            if 'tags' in update:
+                self.update_gif_index()
+
         return self.serialize()
 
     def serialize(self):
         """ Cleanup version of the media file so don't release confidential information """
+        from api.media.delivery import get_media_immutable_url
+
         serialized_file = {
             'is_public': self.is_public,
             'is_anon': self.is_anon,
@@ -190,6 +295,10 @@ class File_Tracking(DB_UserCheck, db.DynamicDocument):
             'auto_tags': self.auto_tags,
         }
 
+        if self.is_public:
+            # Content addressed URL, it can be cached forever
+            serialized_file['url'] = get_media_immutable_url(self)
+
         for key in self:
             if key.startswith('my_') and self[key]:
                 serialized_file[key] = self[key]
@@ -197,6 +306,11 @@ class File_Tracking(DB_UserCheck, db.DynamicDocument):
         if 'info' in self:
             serialized_file['info'] = self['info']
 
+        if self.processing_state:
+            serialized_file['has_preview'] = self.has_preview
+            serialized_file['processing_state'] = self.processing_state
+            serialized_file['job_id'] = self.processing_job_id
+
         if self.is_current_user():
             serialized_file.update({
                 'file_name': self.file_name,
@@ -1,22 +1,32 @@
 import io
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
-import ffmpeg
 import validators
 from api import (api_key_login_or_anonymous, api_key_or_login_required,
                  get_response_error_formatted, get_response_formatted)
+from api.api_metrics import observe_cache
 from api.api_redis import api_rq
+from api.config import get_config_value
 from api.media import blueprint
 from api.print_helper import *
 from api.tools import ensure_dir, generate_file_md5, is_api_call
 from api.user.routes import generate_random_user
-from flask import abort, redirect, request, send_file
+from flask import abort, current_app, redirect, request, send_file
 from flask_cachecontrol import ResponseIsSuccessfulOrRedirect, cache_for
 from mongoengine.queryset.visitor import Q
-from wand.image import Image
+from services.imaging import get_imaging_backend, get_thumbnail_size
 
+from .delivery import (get_media_not_modified, redirect_media_static,
+                       send_media_file)
 from .models import File_Tracking
+from .storage import (media_blob_acquire, media_blob_get_shared_many,
+                      media_blob_release)
+
+# Files of the same upload we hash, decode and write at the same time
+UPLOAD_MAX_WORKERS = 8
 
 
 def get_media_valid_extension(file_name):
@@ -31,10 +41,15 @@ def get_media_valid_extension(file_name):
     return extension
 
 
-def api_internal_add_to_media_list(media_list, my_file):
+def api_internal_add_to_media_list(media_list, files):
+    """ Appends a media or a list of media to the media list, the media takes the privacy of the list """
+
     if not media_list:
         return
 
+    if not isinstance(files, list):
+        files = [files]
+
     # Try to append this media to the media list
     try:
         update = {}
@@ -51,191 +66,415 @@ def api_internal_add_to_media_list(media_list, my_file):
             update['is_public'] = True
 
         if update:
-            my_file.update(**update)
-            my_file.reload()
+            File_Tracking.objects(id__in=[my_file.id for my_file in files]).update(**update)
+            for my_file in files:
+                for key, value in update.items():
+                    my_file[key] = value
 
-        media_list.add_to_list(str(my_file.id))
+        media_list.add_many_to_list([str(my_file.id) for my_file in files])
     except Exception as e:
         print_exception(e, "Failed adding to list, please continue")
 
 
-def api_internal_upload_media():
-    from flask_login import \
-        current_user  # Required by pytest, otherwise client crashes on CI
+def api_internal_queue_video_processing(my_file):
+    """ Sends the video to the worker to be probed and to generate the preview and sprite sheet """
 
-    if request.method != "POST":
-        return get_response_error_formatted(404, {"error_msg": "No files to upload!"})
+    data = {
+        'media_id': str(my_file.id),
+        'media_path': File_Tracking.get_media_path() + my_file.file_path,
+    }
 
-    media_path = File_Tracking.get_media_path()
+    job = None
+    try:
+        job = api_rq.call("worker.process_video", data)
+    except Exception as e:
+        print_exception(e, "Failed reaching the services")
 
-    # If we don't have an user, we generate a temporal one with random names
-    if not current_user.is_authenticated:
-        current_user = generate_random_user()
+    update = {
+        'processing_state': "QUEUED" if job else "QUEUE_FAILED",
+        'processing_job_id': job.id if job else None,
+    }
 
-    print(" User to upload files " + current_user.username)
+    my_file.force_update(**update)
+    my_file.reload()
+    return job
 
-    # Target gallery to upload this file on the user.
-    # Media can go to their photostream or to a target gallery.
-    # If the target gallery is public, the media will be public too.
-    # If the user is anonymous, we also check if the user created the library with "allow anonymous" permission.
-    # This should be handled by the media list itself.
-    gallery_id = request.args.get("gallery_id", '')
-    media_list = current_user.get_media_list(gallery_id, raw_db=True)
 
-    uploaded_ft = []
-    idx = 0
-    for file_key, f_request in request.files.items():
-        key = file_key
+def api_internal_check_media_processing(my_file):
+    """ Checks the worker job for this media and applies its result into File_Tracking once it has finished.
+        Returns True if the media is ready to be served.
+    """
+    if my_file.file_type != "video" or my_file.has_preview:
+        return True
 
-        print(" Upload multiple " + key)
+    if not my_file.processing_state:
+        # Uploaded before the previews were moved into the worker, they were generated on the upload.
+        return True
 
-        user_space_path = current_user.username + "/"
-        full_path = media_path + user_space_path
-        print(" Save at " + full_path)
-        ensure_dir(full_path)
+    if my_file.processing_state not in ["QUEUED", "QUEUE_FAILED"]:
+        return False
 
-        file_name = f_request.filename
-        extension = get_media_valid_extension(file_name)
+    job = None
+    if my_file.processing_job_id:
+        try:
+            job = api_rq.fetch_job(my_file.processing_job_id)
+        except Exception as e:
+            print_r(" Job lost for media " + str(my_file.id))
 
-        mime = f_request.mimetype.split('/')[0]
-        if mime in ['image', 'video']:
-            key = mime
-        else:
-            if extension:
-                if key.startswith('image') or File_Tracking.is_extension_image(extension):
-                    key = "image"
+    if not job:
+        # The job expired or never reached redis, we try again
+        api_internal_queue_video_processing(my_file)
+        return False
 
-                if key.startswith('video') or File_Tracking.is_extension_video(extension):
-                    key = "video"
+    status = job.get_status()
+    if status == "failed":
+        my_file.force_update(**{'processing_state': "FAILED"})
+        my_file.reload()
+        return False
 
-            else:
-                extension = ".JPG"
+    if status != "finished":
+        return False
+
+    res = job.result
+    if not res or res.get('state') != 'success':
+        my_file.force_update(**{'processing_state': "FAILED"})
+        my_file.reload()
+        return False
+
+    info = my_file.info if 'info' in my_file and my_file.info else {}
+    info.update(res['info'])
+
+    my_file.force_update(**{
+        'info': info,
+        'has_preview': res.get('has_preview', False),
+        'processed': True,
+        'processing_state': "READY",
+    })
+
+    my_file.reload()
+    return my_file.has_preview
+
+
+def api_internal_get_upload_type(file_key, f_request):
+    """ Returns the type of media (image, video) and the extension of an uploaded file """
+
+    key = file_key
+    extension = get_media_valid_extension(f_request.filename)
+
+    mime = f_request.mimetype.split('/')[0]
+    if mime in ['image', 'video']:
+        key = mime
+    else:
+        if extension:
+            if key.startswith('image') or File_Tracking.is_extension_image(extension):
                 key = "image"
 
-        if key in ["image", "video"]:
-            md5, size = generate_file_md5(f_request)
-            if size == 0:
-                return get_response_error_formatted(400, {"error_msg": "THERE WAS SOME PROBLEM WITH UPLOAD!"})
+            if key.startswith('video') or File_Tracking.is_extension_video(extension):
+                key = "video"
 
-            if not extension:
-                return get_response_error_formatted(400, {"error_msg": "FILE FORMAT NOT SUPPORTED YET!"})
+        else:
+            extension = ".JPG"
+            key = "image"
 
-            relative_file_path = user_space_path + md5 + extension
-            final_absolute_path = media_path + relative_file_path
+    return key, extension
 
-            if os.path.exists(final_absolute_path):
-                # File already exists on disk, we just ignore it
 
-                my_file = File_Tracking.objects(file_path=relative_file_path).first()
+def api_internal_upload_pool_map(function, items):
+    """ Runs function(item) on a bounded pool of threads and returns the results in order.
+        Every thread gets the application context, so it can reach the config and the database.
+    """
+    app = current_app._get_current_object()
 
-                # A path is defined by the MD5, if there is a duplicate, it is either a collision or someone playing with
-                # this file / user. We could check if the user has changed, but the plan is to let users upgrade from
-                # anonymous into real users, and we might not want to move the final file.
+    def run(item):
+        with app.app_context():
+            return function(item)
 
-                # Eventually if the project grows, files in folders like this are not ideal and all this code should get revamped
+    max_workers = min(len(items), get_config_value("UPLOAD_MAX_WORKERS", UPLOAD_MAX_WORKERS))
+    if max_workers <= 1:
+        return [run(item) for item in items]
 
-                if my_file:
-                    try:
-                        if request.form and file_key in request.form:
-                            my_json = json.loads(request.form[file_key])
-                            my_file.update_with_checks(my_json)
-                    except Exception as e:
-                        print_exception(e, "Failed loading json")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(run, items))
 
-                    print(" FILE ALREADY UPLOADED WITH ID " + str(my_file.id))
 
-                    ret = my_file.serialize()
-                    ret['is_duplicated'] = True
+def api_internal_upload_hash(upload):
+    upload['md5'], upload['size'] = generate_file_md5(upload['f_request'])
+    return upload
 
-                    uploaded_ft.append(ret)
-                    api_internal_add_to_media_list(media_list, my_file)
-                    continue
 
-                print(" FILE WAS LOST - CREATE NEW")
+def api_internal_upload_probe(upload):
+    """ Returns the info of the image, or None if we cannot decode it """
 
-            info = {}
+    try:
+        backend = get_imaging_backend(get_config_value("IMAGING_BACKEND"))
 
-            if key == "image":
-                try:
-                    image = Image(file=f_request)
+        # Image might be rotated internally, we get the dimensions the user will see
+        image = backend.open(file=upload['f_request'])
 
-                    print(" Image orientation " + str(image.orientation))
-                    # Image is rotated internally, we have to invert our dimensions
-                    if image.orientation in ['right_top', 'top_right', 'right_bottom', 'bottom_right']:
-                        print(" Rotate Image ")
-                        info['width'] = image.height
-                        info['height'] = image.width
-                    else:
-                        info['width'] = image.width
-                        info['height'] = image.height
+        info = {}
+        info['width'], info['height'] = backend.get_display_size(image)
 
-                    # Rest request seek pointer to start so we can save it after validation
-                    f_request.seek(0)
-                    f_request.save(final_absolute_path)
+        # We can still store the image if we fail hashing it, we will catch it on the rebuild
+        try:
+            from services.imaging.phash import get_image_hashes
+            upload['hashes'] = get_image_hashes(backend, image)
+        except Exception as e:
+            print(" FAILED HASHING IMAGE " + str(e))
+
+        backend.close(image)
+        return info
+
+    except Exception as e:
+        print(" CRASH on loading image " + str(e))
+
+    return None
+
+
+def api_internal_upload_store(upload):
+    """ Writes the content into the blob storage, returns None if it failed """
+
+    f_request = upload['f_request']
+
+    def write_upload(target_path):
+        # Rest request seek pointer to start so we can save it after validation
+        f_request.seek(0)
+        f_request.save(target_path)
+
+    try:
+        return media_blob_acquire(upload['md5'], upload['extension'], upload['size'], write_upload)
+    except Exception as e:
+        print(" CRASH on saving file " + str(e))
 
-                except Exception as e:
-                    print(" CRASH on loading image " + str(e))
-                    return get_response_error_formatted(400, {"error_msg": "Image is not in a valid format!"})
+    return None
 
-            if key == "video":
-                try:
-                    thumb_time = 1
 
-                    f_request.save(final_absolute_path)
-                    probe = ffmpeg.probe(final_absolute_path)
+def api_internal_upload_find_similar(uploads, username):
+    """ Returns md5 => [File_Tracking] of the media of this user which looks the same, the closest first """
+    from .similarity import DUPLICATE_DISTANCE, media_find_similar
 
-                    video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'),
-                                        None)
-                    width = info['width'] = int(video_stream['width'])
-                    height = info['height'] = int(video_stream['height'])
-                    duration = info['duration'] = float(video_stream['duration'])
+    similar = {}
+    for upload in uploads:
+        if 'hashes' not in upload:
+            continue
+
+        try:
+            distance = get_config_value("PHASH_DUPLICATE_DISTANCE", DUPLICATE_DISTANCE)
+            found = media_find_similar(upload['hashes']['phash'], distance, limit=10)
+        except Exception as e:
+            print_exception(e, "Failed looking for similar media")
+            continue
+
+        files = [my_file for _, my_file in found if my_file.username == username]
+        if files:
+            similar[upload['md5']] = files
+
+    return similar
+
+
+def api_internal_upload_update_from_form(my_file, file_key):
+    """ The form can carry a json per file with the user values (title, description...) """
+    try:
+        if request.form and file_key in request.form:
+            my_file.update_with_checks(json.loads(request.form[file_key]))
+    except Exception as e:
+        print_exception(e, "Failed loading json")
+
+
+def api_internal_upload_media():
+    """ Uploads every file on the request as a batch.
 
-                    target_path = final_absolute_path + ".PREVIEW.PNG"
+        Hashing, decoding and writing the files run on a bounded pool of threads,
+        the duplicates are resolved with a single query, the new media is inserted at once
+        and the gallery gets all of it in a single update.
+    """
+    from flask_login import \
+        current_user  # Required by pytest, otherwise client crashes on CI
 
-                    thumb_time = duration / 3
+    if request.method != "POST":
+        return get_response_error_formatted(404, {"error_msg": "No files to upload!"})
 
-                    if os.path.exists(target_path):
-                        os.remove(target_path)
+    # If we don't have an user, we generate a temporal one with random names
+    if not current_user.is_authenticated:
+        current_user = generate_random_user()
 
-                    ffmpeg.input(final_absolute_path, ss=thumb_time).filter('scale', width, -1).output(target_path,
-                                                                                                       vframes=1).run()
+    print(" User to upload files " + current_user.username)
 
-                except Exception as e:
-                    print(" CRASH on loading image " + str(e))
-                    os.remove(final_absolute_path)
-                    return get_response_error_formatted(400, {"error_msg": "Image is not in a valid format!"})
+    # Target gallery to upload this file on the user.
+    # Media can go to their photostream or to a target gallery.
+    # If the target gallery is public, the media will be public too.
+    # If the user is anonymous, we also check if the user created the library with "allow anonymous" permission.
+    # This should be handled by the media list itself.
+    gallery_id = request.args.get("gallery_id", '')
+    media_list = current_user.get_media_list(gallery_id, raw_db=True)
 
-            new_file = {
-                'info': info,
-                'file_name': file_name,
-                'file_path': relative_file_path,
-                'file_type': key,
-                'file_size': size,
-                'file_format': extension,
-                'checksum_md5': md5,
-                'username': current_user.username,
-                'is_anon': current_user.is_anon,
+    uploads = []
+    for file_key, f_request in request.files.items():
+        print(" Upload multiple " + file_key)
 
-                # An user file by default is not public, but if you are anonymous, the file is public
-                'is_public': current_user.is_anon or current_user.is_media_public
-            }
+        key, extension = api_internal_get_upload_type(file_key, f_request)
+        if key not in ["image", "video"]:
+            continue
 
-            my_file = File_Tracking(**new_file)
-            my_file.save()
+        uploads.append({
+            'file_key': file_key,
+            'f_request': f_request,
+            'file_name': f_request.filename,
+            'key': key,
+            'extension': extension
+        })
 
-            try:
-                if request.form:
-                    data = request.form[file_key]
-                    my_file.update_with_checks(json.loads(data))
-            except Exception as e:
-                print_exception(e, "Crashed updating info")
-
-            api_internal_add_to_media_list(media_list, my_file)
-            uploaded_ft.append(my_file.serialize())
-
-    if len(uploaded_ft) == 0:
+    if len(uploads) == 0:
         return get_response_error_formatted(500, {"error_msg": "No files found on upload"})
 
+    api_internal_upload_pool_map(api_internal_upload_hash, uploads)
+
+    for upload in uploads:
+        if upload['size'] == 0:
+            return get_response_error_formatted(400, {"error_msg": "THERE WAS SOME PROBLEM WITH UPLOAD!"})
+
+        if not upload['extension']:
+            return get_response_error_formatted(400, {"error_msg": "FILE FORMAT NOT SUPPORTED YET!"})
+
+    # Every user gets its own entry, but the content on disk is shared by everyone who uploaded it
+    checksum_list = list({upload['md5'] for upload in uploads})
+
+    existing = {}
+    for my_file in File_Tracking.objects(username=current_user.username, checksum_md5__in=checksum_list):
+        existing.setdefault(my_file.checksum_md5, my_file)
+
+    # The same content might come twice on the same request, we only store the first one
+    new_uploads = {}
+    for upload in uploads:
+        if upload['md5'] not in existing and upload['md5'] not in new_uploads:
+            new_uploads[upload['md5']] = upload
+
+    new_uploads = list(new_uploads.values())
+
+    # Someone else uploaded this content, we don't have to decode or process it again
+    shared = media_blob_get_shared_many([upload['md5'] for upload in new_uploads])
+
+    to_probe = []
+    for upload in new_uploads:
+        shared_file = shared.get(upload['md5'])
+        upload['shared_file'] = shared_file
+
+        upload['info'] = {}
+        if shared_file and 'info' in shared_file and shared_file.info:
+            upload['info'] = dict(shared_file.info)
+
+            if shared_file.phash:
+                upload['hashes'] = {
+                    'ahash': shared_file.ahash,
+                    'dhash': shared_file.dhash,
+                    'phash': shared_file.phash
+                }
+
+        elif upload['key'] == "image":
+            to_probe.append(upload)
+
+    for upload, info in zip(to_probe, api_internal_upload_pool_map(api_internal_upload_probe, to_probe)):
+        if info is None:
+            return get_response_error_formatted(400, {"error_msg": "Image is not in a valid format!"})
+
+        upload['info'] = info
+
+    # Recompressed or resized copies of media that the user already has
+    similar = api_internal_upload_find_similar(new_uploads, current_user.username)
+
+    if request.args.get("skip_similar"):
+        for upload in new_uploads:
+            if upload['md5'] in similar:
+                existing[upload['md5']] = similar[upload['md5']][0]
+
+        new_uploads = [upload for upload in new_uploads if upload['md5'] not in similar]
+
+    # Videos are probed and get their previews on the worker, we only store the file here.
+    blobs = api_internal_upload_pool_map(api_internal_upload_store, new_uploads)
+
+    if None in blobs:
+        for blob in blobs:
+            if blob: media_blob_release(blob.checksum_md5)
+
+        return get_response_error_formatted(400, {"error_msg": "File could not be stored!"})
+
+    now = datetime.now()
+    new_files = []
+    for upload, blob in zip(new_uploads, blobs):
+        new_file = {
+            'info': upload['info'],
+            'file_name': upload['file_name'],
+            'file_path': blob.file_path,
+            'file_type': upload['key'],
+            'file_size': upload['size'],
+            'file_format': upload['extension'],
+            'checksum_md5': upload['md5'],
+            'username': current_user.username,
+            'is_anon': current_user.is_anon,
+            'init_date': now,
+            'creation_date': now,
+
+            # An user file by default is not public, but if you are anonymous, the file is public
+            'is_public': current_user.is_anon or current_user.is_media_public
+        }
+
+        if 'hashes' in upload:
+            new_file.update(upload['hashes'])
+            new_file['phash_date'] = now
+
+        shared_file = upload['shared_file']
+        if upload['key'] == "video" and shared_file and shared_file.processing_state:
+            # Wait on the same job or reuse the previews which are shared
+            new_file.update({
+                'has_preview': shared_file.has_preview,
+                'processed': shared_file.processed,
+                'processing_state': shared_file.processing_state,
+                'processing_job_id': shared_file.processing_job_id,
+            })
+
+        new_files.append(File_Tracking(**new_file))
+
+    if new_files:
+        try:
+            new_files = File_Tracking.objects.insert(new_files)
+        except Exception as e:
+            print_exception(e, "Failed inserting media")
+
+            for blob in blobs:
+                media_blob_release(blob.checksum_md5)
+
+            return get_response_error_formatted(500, {"error_msg": "File could not be stored!"})
+
+    for upload, my_file in zip(new_uploads, new_files):
+        upload['my_file'] = my_file
+        existing[my_file.checksum_md5] = my_file
+
+        api_internal_upload_update_from_form(my_file, upload['file_key'])
+
+        if upload['key'] == "video" and not my_file.processing_state:
+            api_internal_queue_video_processing(my_file)
+
+    files = []
+    for upload in uploads:
+        my_file = existing[upload['md5']]
+        if 'my_file' not in upload:
+            api_internal_upload_update_from_form(my_file, upload['file_key'])
+            print(" FILE ALREADY UPLOADED WITH ID " + str(my_file.id))
+
+        files.append(my_file)
+
+    api_internal_add_to_media_list(media_list, files)
+
+    uploaded_ft = []
+    for upload, my_file in zip(uploads, files):
+        ret = my_file.serialize()
+        if 'my_file' not in upload:
+            ret['is_duplicated'] = True
+
+        if upload['md5'] in similar:
+            ret['similar_media'] = [str(similar_file.id) for similar_file in similar[upload['md5']]]
+
+        uploaded_ft.append(ret)
+
     ret = {'media_files': uploaded_ft, 'username': current_user.username, 'status': 'success'}
     return get_response_formatted(ret)
 
@@ -323,13 +562,22 @@ def api_upload_media():
     return api_internal_upload_media()
 
 
-def api_dynamic_conversion(my_file, abs_path, relative_path, extension, thumbnail, filename, cache_file=True):
+def api_dynamic_conversion(my_file,
+                           abs_path,
+                           relative_path,
+                           extension,
+                           thumbnail,
+                           filename,
+                           cache_file=True,
+                           rendition=None):
     """ Converts the file dynamically into an extension, and saves the file if it was requested
 
         The user can append an extension to convert into example .GIF
         The user can append also request it as a image resized thumbnail to be generated .v<PIXEL SIZE>
 
         The file can be cached or not.
+
+        The rendition is the requested postfix (.v256.PNG) so the ETag matches the one we check before converting.
     """
     attachment_filename = filename
 
@@ -356,45 +604,63 @@ def api_dynamic_conversion(my_file, abs_path, relative_path, extension, thumbnai
     if extension: extra += "." + extension
 
     final_path = abs_path + extra
-    if cache_file and os.path.exists(final_path):
+    cached = cache_file and os.path.exists(final_path)
+    if cache_file:
+        observe_cache("conversion", cached)
+
+    if cached:
         if request.args.get('no_redirect'):
-            return send_file(final_path, download_name=attachment_filename + extra)
+            return send_media_file(my_file,
+                                   final_path,
+                                   relative_path + extra,
+                                   attachment_filename + extra,
+                                   rendition=rendition or extra,
+                                   mimetype='image/' + extension)
+
+        return redirect_media_static(my_file, relative_path + extra)
 
-        return redirect("/static/MEDIA_FILES/" + relative_path + extra)
+    backend = get_imaging_backend(get_config_value("IMAGING_BACKEND"))
 
     try:
-        bit_image = io.BytesIO()
-        with Image(filename=abs_path) as img:
-            if thumbnail:
-                aspect_ratio = img.height / img.width
-                if orientation == 'v':
-                    img.resize(int(thumbnail / aspect_ratio), thumbnail)
-                else:
-                    img.resize(thumbnail, int(thumbnail * aspect_ratio))
+        image = backend.open(filename=abs_path)
 
-            img.format = extension
+        if cache_file:
+            # Crop the images to the first
+            image = backend.first_frame(image)
 
-            if cache_file:
-                # Crop the images to the first
-                if len(img.sequence) > 0:
-                    img = Image(image=img.sequence[0])
+        if thumbnail:
+            width, height = backend.get_size(image)
+            image = backend.resize(image, *get_thumbnail_size(width, height, thumbnail, orientation))
 
-                img.save(filename=final_path)
+        if cache_file:
+            backend.save(image, final_path, extension)
+
+        elif request.args.get('no_redirect'):
+            bit_image = io.BytesIO(backend.to_bytes(image, extension))
+            backend.close(image)
 
-        if request.args.get('no_redirect'):
-            img.save(file=bit_image)
-            bit_image.seek(0)
             return send_file(bit_image,
                              mimetype='image/' + extension,
                              as_attachment=True,
                              download_name=attachment_filename + extra)
 
+        backend.close(image)
+
     except Exception as exc:
         print_exception(exc, "CRASH")
         return get_response_error_formatted(500, {"error_msg": "Failed to convert to format " + extension})
 
+    if request.args.get('no_redirect'):
+        # Serve the rendition we just cached from disk instead of a copy in memory
+        return send_media_file(my_file,
+                               final_path,
+                               relative_path + extra,
+                               attachment_filename + extra,
+                               rendition=rendition or extra,
+                               mimetype='image/' + extension)
+
     print_b(" SERVE " + relative_path + extra)
-    return redirect("/static/MEDIA_FILES/" + relative_path + extra)
+    return redirect_media_static(my_file, relative_path + extra)
 
 
 @blueprint.route('/category/<string:media_category>', methods=['GET'])
@@ -445,9 +711,77 @@ def api_get_media_by_md5(md5):
     return get_response_error_formatted(404, {"error_msg": "URL Not found"})
 
 
+@blueprint.route('/similar/<string:media_id>', methods=['GET'])
+@api_key_login_or_anonymous
+def api_get_similar_media(media_id):
+    """ Returns the media that looks like this one, resized or recompressed copies and near duplicates
+    ---
+    tags:
+      - media
+    schemes: ['http', 'https']
+    parameters:
+        - in: query
+          name: distance
+          schema:
+            type: integer
+          description: Maximum hamming distance between the perceptual hashes (0 to 32), by default 10
+        - in: query
+          name: items
+          schema:
+            type: integer
+          description: Maximum number of results
+
+    responses:
+      200:
+        description: Returns the similar media, closest first, with their distance
+      404:
+        description: Media not found or it is not an image
+    """
+    from flask_login import current_user
+
+    from .similarity import (SIMILAR_DISTANCE, media_compute_hashes,
+                             media_find_similar)
+
+    my_file = File_Tracking.objects(pk=media_id).first()
+    if not my_file or not (my_file.is_public or my_file.is_current_user()):
+        return get_response_error_formatted(404, {"error_msg": "Media not found"})
+
+    if not my_file.is_image():
+        return get_response_error_formatted(404, {"error_msg": "Only images can be compared"})
+
+    if not my_file.phash:
+        try:
+            media_compute_hashes(my_file)
+        except Exception as e:
+            print_exception(e, "Failed hashing")
+            return get_response_error_formatted(500, {"error_msg": "We cannot compare this media"})
+
+    try:
+        max_distance = max(0, min(int(request.args.get('distance', SIMILAR_DISTANCE)), 32))
+    except ValueError:
+        max_distance = SIMILAR_DISTANCE
+
+    try:
+        items = max(1, min(int(request.args.get('items', 25)), 100))
+    except ValueError:
+        items = 25
+
+    username = current_user.username if current_user.is_authenticated else ""
+
+    media_files = []
+    for distance, similar_file in media_find_similar(my_file.phash, max_distance, username, str(my_file.id), items):
+        ret = similar_file.serialize()
+        ret['distance'] = distance
+        media_files.append(ret)
+
+    if current_user.is_authenticated:
+        current_user.populate_media(media_files)
+
+    return get_response_formatted({'status': 'success', 'media_id': media_id, 'media_files': media_files})
+
+
 @blueprint.route('/get/<string:media_id>', methods=['GET'])
 @api_key_login_or_anonymous
-@cache_for(hours=48, only_if=ResponseIsSuccessfulOrRedirect)
 def api_get_media(media_id, image_only=False):
     """Returns a media object given it's media_id.
         The user might be rejected if the media is private
@@ -520,27 +854,91 @@ def api_get_media(media_id, image_only=False):
     relative_path = my_file.file_path
     abs_path = File_Tracking.get_media_path()
 
+    # The ETag only depends on the content and the rendition, we can answer before converting anything
+    rendition = "." + ".".join(arr[1:]) if len(arr) > 1 else None
+
     if image_only and my_file.file_type == "video":
         extension = "PNG"
         thumbnail = "v512"
+        rendition = ".v512.PNG"
+
+    not_modified = get_media_not_modified(my_file, rendition)
+    if not_modified:
+        return not_modified
 
     if extension or thumbnail:
         # If it is a video we want to use the video preview
         if my_file.file_type == "video":
+            if not api_internal_check_media_processing(my_file):
+                response = get_response_error_formatted(503, {
+                    "error_msg": "MEDIA IS STILL PROCESSING",
+                    "processing_state": my_file.processing_state
+                })
+                response.headers['Retry-After'] = 5
+                return response
+
             relative_path += ".PREVIEW.PNG"
 
-        return api_dynamic_conversion(my_file, abs_path + relative_path, relative_path, extension, thumbnail,
-                                      my_file.file_name, True)
+        return api_dynamic_conversion(my_file,
+                                      abs_path + relative_path,
+                                      relative_path,
+                                      extension,
+                                      thumbnail,
+                                      my_file.file_name,
+                                      True,
+                                      rendition=rendition)
 
     if request.args.get('no_redirect'):
-        return send_file(abs_path + relative_path, download_name=my_file.file_name)
+        return send_media_file(my_file, abs_path + relative_path, relative_path, my_file.file_name)
+
+    return redirect_media_static(my_file, relative_path)
+
+
+@blueprint.route('/ready/<string:media_id>', methods=['GET'])
+@api_key_login_or_anonymous
+def api_get_media_ready(media_id):
+    """Returns if a media has finished processing, videos get their info and previews from a worker after the upload.
+        Poll this call with the media_id returned by the upload, or wait on the job_id.
+    ---
+    tags:
+      - media
+    schemes: ['http', 'https']
+    deprecated: false
+    definitions:
+      image_file:
+        type: object
+    parameters:
+        - in: query
+          name: media_id
+          schema:
+            type: string
+          description: A valid media_id which belongs to this user or is PUBLIC
+    responses:
+      200:
+        description: Returns the processing state and the media once it is ready
+      403:
+        description: Media is private
+      404:
+        description: File Media is missing
+    """
+
+    my_file = api_get_media_id(media_id)
+    is_ready = api_internal_check_media_processing(my_file)
+
+    ret = {
+        'status': 'success',
+        'media_id': media_id,
+        'is_ready': is_ready,
+        'processing_state': my_file.processing_state,
+        'job_id': my_file.processing_job_id,
+        'media_files': [my_file.serialize()]
+    }
 
-    return redirect("/static/MEDIA_FILES/" + relative_path)
+    return get_response_formatted(ret)
 
 
 @blueprint.route('/get_image/<string:media_id>', methods=['GET'])
 @api_key_login_or_anonymous
-@cache_for(hours=48, only_if=ResponseIsSuccessfulOrRedirect)
 def api_get_media_image(media_id):
     """Returns a media object given it's media_id, if it is a video, it will transform it into an image.
         Check /get for a full description
@@ -672,16 +1070,28 @@ def api_populate_media_list(user_id, media_list, is_order_asc=True):
     if user_id != username:
         query = query & Q(is_public=True)
 
-    op = File_Tracking.objects(query)
-
     ######### TODO: ORDER SHOULD BE THE DATE IT GOT ON THE LIBRARY ####################
 
     if is_order_asc:
-        op = op.order_by('-creation_date')
+        order = ('-creation_date', '-id')
     else:
-        op = op.order_by('+creation_date')
+        order = ('+creation_date', '+id')
 
-    file_list = op.skip(offset).limit(items)
+    # The client can send the last media of the previous page, we continue from it with a range query
+    # instead of skipping all the previous pages.
+    after_id = request.args.get('after', None)
+    after_file = File_Tracking.objects(pk=after_id).only('creation_date').first() if after_id else None
+
+    if after_file and after_file.creation_date:
+        cd = after_file.creation_date
+        if is_order_asc:
+            query = query & (Q(creation_date__lt=cd) | (Q(creation_date=cd) & Q(id__lt=after_file.id)))
+        else:
+            query = query & (Q(creation_date__gt=cd) | (Q(creation_date=cd) & Q(id__gt=after_file.id)))
+
+        offset = 0
+
+    file_list = File_Tracking.objects(query).order_by(*order).skip(offset).limit(items)
 
     return_list = [ft.serialize() for ft in file_list]
 
@@ -689,6 +1099,10 @@ def api_populate_media_list(user_id, media_list, is_order_asc=True):
         current_user.populate_media(return_list)
 
     ret = {'media_files': return_list, 'items': items, 'offset': offset, 'page': page}
+
+    if len(return_list) == items:
+        ret['next_after'] = return_list[-1]['media_id']
+
     return ret
 
 
@@ -0,0 +1,258 @@
+"""
+    Near duplicate search with perceptual hashes.
+
+    Every image stores its hashes on File_Tracking (check services/imaging/phash.py).
+    Each process keeps a BK-tree of the phashes, so a lookup only visits the branches
+    within the hamming distance we are looking for instead of every image we have.
+
+    A forced rebuild changes hashes which are already on the trees, it increments a version on redis
+    and every process starts its tree again on the next refresh.
+
+    Deleted media is removed from the tree of the process that deleted it. The trees of the other
+    processes keep it, so the results are always checked against the database.
+"""
+
+import threading
+import time
+from datetime import datetime
+
+from api.config import get_config_value
+from api.print_helper import *
+
+from .models import File_Tracking
+
+# Hamming distance on 64 bits in which we consider two images the same picture
+SIMILAR_DISTANCE = 10
+
+# Resized or recompressed copies stay very close
+DUPLICATE_DISTANCE = 4
+
+# Seconds between checks for new hashes on the database
+INDEX_REFRESH_SECONDS = 5
+
+INDEX_VERSION_KEY = "imgapi:phash:version"
+
+
+def hamming_distance(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count("1")
+
+
+class BKTree():
+    """ Metric tree on the hamming distance, every node is [hash, set of media ids, {distance: child}] """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+
+        if not self.root:
+            self.root = [value, {item}, {}]
+            return
+
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].add(item)
+                return
+
+            child = node[2].get(distance)
+            if not child:
+                node[2][distance] = [value, {item}, {}]
+                return
+
+            node = child
+
+    def remove(self, value, item):
+        """ The node stays on the tree with no items, its children are still reached through it """
+
+        node = self.root
+        while node:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                if item in node[1]:
+                    node[1].discard(item)
+                    self.size -= 1
+                return
+
+            node = node[2].get(distance)
+
+    def search(self, value, max_distance):
+        """ Returns [(distance, item)] of every item within max_distance """
+
+        results = []
+        if not self.root:
+            return results
+
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                results.extend([(distance, item) for item in node[1]])
+
+            # Triangle inequality, only children in this ring can be close enough
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+
+        return results
+
+
+class MediaHashIndex():
+    """ BK-tree of every phash on the database, it loads incrementally the hashes stored since the last refresh """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.tree = BKTree()
+        self.last_date = None
+        self.last_refresh = 0
+        self.version = None
+
+    def get_version(self):
+        from api.api_redis import api_rq
+
+        try:
+            return api_rq.conn.get(INDEX_VERSION_KEY)
+        except Exception as e:
+            # Without redis we only miss the rebuilds of other processes
+            print_r(" PHASH VERSION NOT AVAILABLE " + str(e))
+            return self.version
+
+    def refresh(self, force=False):
+        if not force and time.time() - self.last_refresh < INDEX_REFRESH_SECONDS:
+            return
+
+        version = self.get_version()
+        if version != self.version:
+            self.reset()
+            self.version = version
+
+        self.last_refresh = time.time()
+
+        query = {'phash': {'$nin': [None, ""]}}
+        if self.last_date:
+            # We might get again the ones on the same date, the tree keeps them in a set
+            query['phash_date'] = {'$gte': self.last_date}
+
+        fields = {'phash': 1, 'phash_date': 1}
+        for raw in File_Tracking._get_collection().find(query, fields).sort('phash_date', 1):
+            self.tree.add(int(raw['phash'], 16), str(raw['_id']))
+
+            if raw.get('phash_date'):
+                self.last_date = raw['phash_date']
+
+    def remove(self, phash, media_id):
+        with self.lock:
+            self.tree.remove(int(phash, 16), media_id)
+
+    def search(self, phash, max_distance):
+        """ Returns [(distance, media_id)] sorted by distance """
+
+        with self.lock:
+            self.refresh()
+            results = self.tree.search(int(phash, 16), max_distance)
+
+        return sorted(results)
+
+
+media_hash_index = MediaHashIndex()
+
+
+def media_compute_hashes(my_file):
+    """ Computes and stores the hashes of an image from disk """
+
+    from services.imaging import get_imaging_backend
+    from services.imaging.phash import get_image_hashes
+
+    backend = get_imaging_backend(get_config_value("IMAGING_BACKEND"))
+
+    image = backend.open(filename=File_Tracking.get_media_path() + my_file.file_path)
+    try:
+        hashes = get_image_hashes(backend, image)
+    finally:
+        backend.close(image)
+
+    hashes['phash_date'] = datetime.now()
+    my_file.force_update(**hashes)
+    my_file.reload()
+    return hashes
+
+
+def media_find_similar(phash, max_distance=SIMILAR_DISTANCE, username=None, exclude_id=None, limit=25):
+    """ Returns [(distance, File_Tracking)] of the media close to this hash, visible to this user """
+
+    results = [(distance, media_id) for distance, media_id in media_hash_index.search(phash, max_distance)
+               if media_id != exclude_id]
+
+    if not results:
+        return []
+
+    distances = {}
+    for distance, media_id in results:
+        distances.setdefault(media_id, distance)
+
+    # Media deleted on other processes is still on our tree, the query only returns the real ones
+    files = File_Tracking.objects(id__in=list(distances.keys()))
+
+    similar = []
+    for my_file in files:
+        if username is not None and my_file.username != username:
+            if not my_file.is_public or my_file.is_unlisted:
+                continue
+
+        similar.append((distances[str(my_file.id)], my_file))
+
+    similar.sort(key=lambda x: x[0])
+    return similar[:limit]
+
+
+def media_phash_rebuild(limit=1000, after_id=None, force=False):
+    """ Computes the hashes of the images on the media tree which don't have them.
+        Processes a batch, call it again with after_id=<last_id> until nothing is left.
+    """
+    from bson import ObjectId
+
+    query = {'file_type': 'image'}
+    if not force:
+        query['phash'] = {'$in': [None, ""]}
+
+    if after_id:
+        query['_id'] = {'$gt': ObjectId(after_id)}
+
+    report = {'hashed': 0, 'failed': 0, 'last_id': None}
+
+    cursor = File_Tracking._get_collection().find(query, {'_id': 1}).sort('_id', 1).limit(limit)
+    for raw in cursor:
+        report['last_id'] = str(raw['_id'])
+
+        my_file = File_Tracking.objects(pk=raw['_id']).first()
+        if not my_file:
+            continue
+
+        try:
+            media_compute_hashes(my_file)
+            report['hashed'] += 1
+        except Exception as e:
+            print_r(" FAILED HASHING " + str(my_file.file_path) + " " + str(e))
+            report['failed'] += 1
+
+    # A full rebuild might have changed hashes which are already on the trees of every process
+    if force:
+        from api.api_redis import api_rq
+
+        try:
+            api_rq.conn.incr(INDEX_VERSION_KEY)
+        except Exception as e:
+            print_r(" PHASH VERSION NOT UPDATED " + str(e))
+
+        with media_hash_index.lock:
+            media_hash_index.reset()
+
+    return report
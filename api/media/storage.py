@@ -0,0 +1,170 @@
+import glob
+import os
+import shutil
+import uuid
+from datetime import datetime
+
+from bson import ObjectId
+
+from api.print_helper import *
+from api.tools import ensure_dir
+
+from .models import DB_MediaBlob, File_Tracking
+
+
+def media_blob_acquire(checksum_md5, extension, file_size, write_file):
+    """ Adds a reference to the blob with this checksum and returns it.
+        write_file(absolute_path) is only called if the content is not on disk yet.
+    """
+
+    blob = DB_MediaBlob.objects(checksum_md5=checksum_md5).modify(
+        upsert=True,
+        new=True,
+        inc__ref_count=1,
+        set_on_insert__file_path=DB_MediaBlob.get_blob_path(checksum_md5, extension),
+        set_on_insert__file_format=extension,
+        set_on_insert__file_size=file_size,
+        set_on_insert__creation_date=datetime.now())
+
+    abs_path = File_Tracking.get_media_path() + blob.file_path
+
+    # First reference, the previous owner might be releasing the files right now so we always write it
+    if blob.ref_count == 1 or not os.path.exists(abs_path):
+        ensure_dir(abs_path)
+
+        # Write next to the blob and rename, so nobody can read half a file
+        tmp_path = abs_path + ".UPLOADING." + uuid.uuid4().hex
+        try:
+            write_file(tmp_path)
+            os.replace(tmp_path, abs_path)
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+            media_blob_release(checksum_md5)
+            raise e
+
+    return blob
+
+
+def media_blob_release(checksum_md5):
+    """ Removes a reference, the file and every rendition are deleted when nobody uses them anymore.
+
+        Someone can acquire the blob while we release it. We move the files to a tombstone first
+        and only delete them if we could also delete the document, otherwise we put them back.
+        The content is the same, so putting them back over a new copy is safe.
+    """
+
+    blob = DB_MediaBlob.objects(checksum_md5=checksum_md5).modify(new=True, dec__ref_count=1)
+    if not blob or blob.ref_count > 0:
+        return False
+
+    abs_path = File_Tracking.get_media_path() + blob.file_path
+    tombstone = ".RELEASED." + uuid.uuid4().hex
+
+    released = []
+    for path in glob.glob(glob.escape(abs_path) + "*"):
+        # Uploads in progress and other releases
+        if ".UPLOADING." in path or ".RELEASED." in path:
+            continue
+
+        try:
+            os.replace(path, path + tombstone)
+            released.append(path)
+        except FileNotFoundError:
+            pass
+
+    # Someone could have acquired it again in the meanwhile
+    if DB_MediaBlob.objects(pk=blob.pk, ref_count__lte=0).delete() == 0:
+        for path in released:
+            os.replace(path + tombstone, path)
+
+        return False
+
+    for path in released:
+        os.remove(path + tombstone)
+
+    print_b(" BLOB RELEASED " + blob.file_path)
+    return True
+
+
+def media_blob_get_shared(checksum_md5):
+    """ Returns a media from any user with this content, so we can reuse its info and previews """
+    return File_Tracking.objects(checksum_md5=checksum_md5, file_path__startswith=DB_MediaBlob.BLOB_FOLDER).first()
+
+
+def media_blob_get_shared_many(checksum_list):
+    """ Same as media_blob_get_shared for a batch of checksums in a single query, returns md5 => media """
+    if not checksum_list:
+        return {}
+
+    shared = {}
+    for my_file in File_Tracking.objects(checksum_md5__in=checksum_list,
+                                         file_path__startswith=DB_MediaBlob.BLOB_FOLDER):
+        shared.setdefault(my_file.checksum_md5, my_file)
+
+    return shared
+
+
+def media_blob_migrate_file(my_file):
+    """ Moves a legacy <username>/<md5><ext> file and its renditions into the blob storage.
+        The old path is replaced with a hard link to the blob, so the tree stays valid in place.
+    """
+    media_path = File_Tracking.get_media_path()
+    old_path = media_path + my_file.file_path
+
+    if not os.path.exists(old_path):
+        return "missing"
+
+    blob = media_blob_acquire(my_file.checksum_md5, my_file.file_format, my_file.file_size,
+                              lambda target: shutil.move(old_path, target))
+
+    blob_path = media_path + blob.file_path
+
+    state = "migrated"
+    if os.path.exists(old_path):
+        # The content was already on the blob storage
+        os.remove(old_path)
+        state = "deduplicated"
+
+    # Renditions .CACHE .PREVIEW.PNG and the job outputs are shared too
+    for rendition in glob.glob(glob.escape(old_path) + ".*"):
+        blob_rendition = blob_path + rendition[len(old_path):]
+        if os.path.exists(blob_rendition):
+            os.remove(rendition)
+        else:
+            os.replace(rendition, blob_rendition)
+
+    try:
+        os.link(blob_path, old_path)
+    except OSError as e:
+        print_r(" Cannot link " + my_file.file_path + " " + str(e))
+
+    my_file.force_update(**{'file_path': blob.file_path})
+    return state
+
+
+def media_blob_migrate(limit=1000, after_id=None):
+    """ Migrates a batch of files into the blob storage, call it again with the last_id until it is done """
+
+    query = {'file_path': {'$not': {'$regex': '^' + DB_MediaBlob.BLOB_FOLDER}}}
+    if after_id:
+        query['_id'] = {'$gt': ObjectId(after_id)}
+
+    report = {'migrated': 0, 'deduplicated': 0, 'missing': 0, 'failed': 0, 'last_id': None}
+
+    for my_file in File_Tracking.objects(__raw__=query).order_by('id').limit(limit):
+        report['last_id'] = str(my_file.id)
+
+        if not my_file.checksum_md5 or not my_file.file_format:
+            report['failed'] += 1
+            continue
+
+        try:
+            state = media_blob_migrate_file(my_file)
+            report[state] += 1
+        except Exception as e:
+            print_exception(e, "Failed migrating " + str(my_file.file_path))
+            report['failed'] += 1
+
+    return report
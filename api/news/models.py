@@ -171,6 +171,9 @@ class DB_News(db.DynamicDocument):
 
         print_b(self.link + " " + self.status + " => " + state_msg)
 
+        from api.api_metrics import observe_state_change
+        observe_state_change("news", self.status, state_msg, self.last_visited_date)
+
         self.update(**{
             'force_reindex': False,
             'status': state_msg,
@@ -5,6 +5,7 @@ from datetime import datetime
 import requests
 from api import (admin_login_required, api_key_or_login_required,
                  get_response_error_formatted, get_response_formatted)
+from api.api_metrics import get_external_hooks
 from api.config import get_api_AI_service, get_api_entry
 from api.news import blueprint
 from api.news.models import DB_News
@@ -78,7 +79,7 @@ def api_news_get_query():
     for article in news:
         article.precalculate_cache()
 
-    ret = {'news': news}
+    ret = {'news': news, 'has_more': news.has_more}
     return get_response_formatted(ret)
 
 
@@ -224,7 +225,7 @@ def api_create_article_ai_summary(article, priority=False, force_summary=False):
     if 'source' in article:
         data['source'] = article['source']
 
-    response = requests.post(get_api_AI_service(), json=data)
+    response = requests.post(get_api_AI_service(), json=data, hooks=get_external_hooks("ai"))
     response.raise_for_status()
 
     try:
@@ -255,7 +256,7 @@ def api_create_news_translation(id, text, field, language):
         'hostname': socket.gethostname(),
     }
 
-    response = requests.post(get_api_AI_service(), json=data)
+    response = requests.post(get_api_AI_service(), json=data, hooks=get_external_hooks("ai"))
     response.raise_for_status()
 
     try:
@@ -5,6 +5,7 @@ from datetime import datetime
 import requests
 from api import (admin_login_required, api_key_or_login_required,
                  get_response_error_formatted, get_response_formatted)
+from api.api_metrics import get_external_hooks
 from api.config import (get_api_AI_default_service, get_api_AI_service,
                         get_api_entry)
 from api.print_helper import *
@@ -314,7 +315,7 @@ def api_create_prompt_ai_summary(db_prompt, priority=False, force_summary=False)
     if priority:
         data['priority'] = priority
 
-    response = requests.post(get_api_AI_service(), json=data)
+    response = requests.post(get_api_AI_service(), json=data, hooks=get_external_hooks("ai"))
     response.raise_for_status()
 
     try:
@@ -338,7 +339,7 @@ def api_create_prompt_ai_summary(db_prompt, priority=False, force_summary=False)
 @api_key_or_login_required
 @admin_login_required
 def api_llama_get_state():
-    response = requests.get(get_api_AI_default_service())
+    response = requests.get(get_api_AI_default_service(), hooks=get_external_hooks("ai"))
     response.raise_for_status()
 
     try:
@@ -417,7 +418,7 @@ def api_let_AI_search_for_information(db_prompt, priority=False):
     if priority:
         data['priority'] = priority
 
-    response = requests.post(get_api_AI_service(), json=data)
+    response = requests.post(get_api_AI_service(), json=data, hooks=get_external_hooks("ai"))
     response.raise_for_status()
 
     try:
@@ -1,6 +1,8 @@
 import math
 import re
+import threading
 import time
+from collections import OrderedDict
 from datetime import datetime
 
 import dateutil
@@ -21,7 +23,6 @@ def is_mongo_id(string):
 def get_adaptive_value(key, value):
     # Just check if true or false and change accordingly
     if key.find("date") != -1:
-        print_h1(" DATE " + key)
         date_t = get_timestamp_verbose(value)
         ds = datetime.fromtimestamp(int(date_t))
         return ds
@@ -49,8 +50,10 @@ class DB_DateTimeFieldTimestamp(db.DateTimeField):
         return super().to_python(value)
 
 
-def get_timestamp():
-    d = datetime.now()
+def get_timestamp(d=None):
+    if not d:
+        d = datetime.now()
+
     unixtime = time.mktime(d.timetuple())
     return int(unixtime)
 
@@ -132,6 +135,26 @@ def get_datetime_from_text(str):
     return str
 
 
+# Relative dates, "month" or "3 months" ago
+VERBOSE_DATE_SECONDS = {
+    'now': 0,
+    'month': 31 * 24 * 60 * 60,
+    'week': 7 * 24 * 60 * 60,
+    'day': 24 * 60 * 60,
+    'hour': 60 * 60,
+    'minute': 60,
+}
+
+VERBOSE_DATE_REGEX = [
+    (re.compile(r"(\d+) year"), 365 * 24 * 60 * 60),
+    (re.compile(r"(\d+) month"), 31 * 24 * 60 * 60),
+    (re.compile(r"(\d+) week"), 7 * 24 * 60 * 60),
+    (re.compile(r"(\d+) day"), 24 * 60 * 60),
+    (re.compile(r"(\d+) hour?"), 60 * 60),
+    (re.compile(r"(\d+) min"), 60),
+]
+
+
 def get_timestamp_verbose(str):
     if not str:
         return get_timestamp()
@@ -159,53 +182,13 @@ def get_timestamp_verbose(str):
         pass
 
     now = get_timestamp()
-    if str == "now":
-        return now
-
-    if str == "month":
-        return now - 31 * 24 * 60 * 60
-
-    regex = re.compile(r"(\d+) year")
-    year = regex.search(str)
-    if year:
-        return now - 365 * 24 * 60 * 60 * int(year.group(1))
-
-    regex = re.compile(r"(\d+) month")
-    months = regex.search(str)
-    if months:
-        return now - 31 * 24 * 60 * 60 * int(months.group(1))
-
-    if str == "week":
-        return now - 7 * 24 * 60 * 60
+    if str in VERBOSE_DATE_SECONDS:
+        return now - VERBOSE_DATE_SECONDS[str]
 
-    regex = re.compile(r"(\d+) week")
-    weeks = regex.search(str)
-    if weeks:
-        return now - 7 * 24 * 60 * 60 * int(weeks.group(1))
-
-    if str == "day":
-        return now - 24 * 60 * 60
-
-    regex = re.compile(r"(\d+) day")
-    days = regex.search(str)
-    if days:
-        return now - 24 * 60 * 60 * int(days.group(1))
-
-    if str == "hour":
-        return now - 60 * 60
-
-    regex = re.compile(r"(\d+) hour?")
-    hours = regex.search(str)
-    if hours:
-        return now - 60 * 60 * int(hours.group(1))
-
-    if str == "minute":
-        return now - 60
-
-    regex = re.compile(r"(\d+) min")
-    mins = regex.search(str)
-    if mins:
-        return now - 60 * int(mins.group(1))
+    for regex, seconds in VERBOSE_DATE_REGEX:
+        found = regex.search(str)
+        if found:
+            return now - seconds * int(found.group(1))
 
     print("Didn't understand " + str)
     return now
@@ -385,7 +368,7 @@ def mongo_get_value(return_data, field, field_name, data, filter_out, add_empty_
             pass
 
     else:
-        print("+ Ignored " + field_name)
+        print_debug_line("+ Ignored " + field_name)
         # You can define your logic for returning elements
 
     return return_data
@@ -505,14 +488,14 @@ def mongo_to_dict_helper(obj, filter_out=None, add_empty_lists=True):
                 continue
 
             if field_name[0:1] == "_":
-                print("Ignore field " + field_name)
+                print_debug_line("Ignore field " + field_name)
                 continue
 
             if field_name in obj._data:
                 data = obj._data[field_name]
                 field = obj._fields[field_name]
                 if field_name == "start_date":
-                    print(" TEST ")
+                    print_debug_line(" TEST ")
 
                 mongo_get_value(return_data, field, field_name, data, filter_out, add_empty_lists)
 
@@ -567,13 +550,71 @@ def validate_and_convert_dates(data_obj):
         print_exception(e, "FAILED PARSING DATE")
 
 
+class QueryResult():
+    """ Result of build_query_from_request, the query runs the first time we read it and the page is kept.
+        We fetch one more document than the limit, so has_more doesn't need a count.
+        Anything else (delete, update, count...) goes to the QuerySet with the limit applied.
+    """
+
+    def __init__(self, queryset, limit=None, reverse=False):
+        self.queryset = queryset
+        self.limit = limit
+        self.reverse = reverse
+
+        # The same QuerySet the callers got before we had this class
+        self.limited_queryset = queryset.limit(limit) if limit else queryset
+
+        # mongo_to_dict_helper serializes anything with a _result_cache as a list
+        self._result_cache = None
+        self._has_more = False
+
+    def evaluate(self):
+        if self._result_cache is not None:
+            return self._result_cache
+
+        if self.limit:
+            items = list(self.queryset.limit(self.limit + 1))
+            self._has_more = len(items) > self.limit
+            items = items[:self.limit]
+        else:
+            items = list(self.queryset)
+
+        if self.reverse:
+            items.reverse()
+
+        self._result_cache = items
+        return items
+
+    @property
+    def has_more(self):
+        self.evaluate()
+        return self._has_more
+
+    def __iter__(self):
+        return iter(self.evaluate())
+
+    def __len__(self):
+        return len(self.evaluate())
+
+    def __bool__(self):
+        return len(self.evaluate()) > 0
+
+    def __getitem__(self, key):
+        return self.evaluate()[key]
+
+    def __getattr__(self, key):
+        return getattr(self.limited_queryset, key)
+
+
 def build_query_from_request(MyClass, args=None, get_all=False, global_api=False, append_public=True, extra_args=None):
     """ Global API means that the data doesn't belong to a particular user """
 
     order_by = None
 
+    arguments = None
     if not args:
-        args = request.args.to_dict()
+        arguments = request.args.to_dict(flat=False)
+        args = {key: values[0] for key, values in arguments.items()}
 
     fields = args.get("fields", None)
     get_all = args.get("get_all")
@@ -595,9 +636,6 @@ def build_query_from_request(MyClass, args=None, get_all=False, global_api=False
 
     query_set = QuerySet(MyClass, MyClass()._get_collection())
 
-    for key, value in args.items():
-        print(key, ":", value)
-
     # Limit the query to only some fields using projection
     if fields:
         projection = {field: 1 for field in fields.split(",")}
@@ -611,54 +649,288 @@ def build_query_from_request(MyClass, args=None, get_all=False, global_api=False
         if (len(args) > 5 or len(args) == 0):
             return abort(400, 'Range too wide or narrow')
 
-        query = build_query_from_url(args)
+        query = build_query_from_url(args, MyClass, arguments)
 
         if not global_api:
             if not current_user.is_authenticated:
-                query = Q(is_public=True) & query
+                visibility = {'is_public': True}
             elif append_public:
                 # Do we want to add public data? we only have this method and it might break production
                 # We should refactor this and think about the logic, we might introduce security vulnerabilities here too.
-                query = (Q(username=current_user.username) | Q(is_public=True)) & query
+                visibility = {'$or': [{'username': current_user.username}, {'is_public': True}]}
             else:
                 # Just lock to our user because we are looking at only data that belongs to this user.
-                query = (Q(username=current_user.username)) & query
-
-        data = query_set.filter(query)
+                visibility = {'username': current_user.username}
 
-    # Add - or + in front of the field to order. Example "&order_by=-creation_date"
-    if data:
-        if order_by:
-            data = data.order_by(order_by)
+            query = {'$and': [visibility, query]} if query else visibility
 
-        if skip:
-            data = data.skip(int(skip))
+        data = query_set.filter(__raw__=query)
 
-        if limit:
-            data = data.limit(int(limit))
+    # Add - or + in front of the field to order. Example "&order_by=-creation_date"
+    if order_by:
+        data = data.order_by(order_by)
 
-        if exclude:
-            data = data.exclude(*exclude.split(","))
+    if skip:
+        data = data.skip(int(skip))
 
-        if only:
-            data = data.only(*only.split(","))
+    if exclude:
+        data = data.exclude(*exclude.split(","))
 
-    if not data:
-        print_r("Data not found")
+    if only:
+        data = data.only(*only.split(","))
 
-    if reversed:
-        return list(data)[::-1]
+    # Nothing runs until somebody reads the result
+    result = QueryResult(data, int(limit) if limit else None, reverse=bool(reversed))
 
     if verbose:
-        for ts in data:
+        for ts in result:
             ts['creation_date_verbose'] = ts.creation_date.strftime("%Y/%m/%d, %H:%M:%S")
 
-    return data
+    return result
+
+
+# Mongoengine operators we translate into the mongo ones
+QUERY_OPERATORS = ['ne', 'lt', 'lte', 'gt', 'gte', 'in', 'nin', 'all', 'size', 'exists', 'mod', 'not']
+QUERY_STRING_OPERATORS = [
+    'contains', 'icontains', 'startswith', 'istartswith', 'endswith', 'iendswith', 'exact', 'iexact', 'regex',
+    'iregex', 'wholeword', 'iwholeword'
+]
+
+# We don't support equal number... :(
+QUERY_NUMBER_OPERATORS = ['gte', 'lte', 'lt', 'gt', 'ne', 'not']
+QUERY_LIST_OPERATORS = ['in', 'nin', 'all']
+
+# Words we never use as a filter
+QUERY_RESERVED_WORDS = ["key", "database", "value", "k"]
+
+QUERY_PLAN_CACHE_SIZE = 256
+
+# The string operators become a regex, whatever the type of the field is
+query_string_field = db.StringField()
+
+
+def get_query_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+class QueryTerm():
+    """ A parameter of the url compiled into its mongo field and operator, only the value changes between calls """
+
+    def __init__(self, doc_class, key, kind, join="and"):
+        self.key = key
+        self.kind = kind
+        self.join = join
+
+        field_key = key.split("--")[1] if kind == "raw" else key
+        parts = field_key.split("__")
+
+        self.op = None
+        if len(parts) > 1 and (parts[-1] in QUERY_OPERATORS or parts[-1] in QUERY_STRING_OPERATORS):
+            self.op = parts.pop()
+
+        # field__not__in=... negates the operator
+        self.negate = False
+        if self.op and self.op != 'not' and len(parts) > 1 and parts[-1] == 'not':
+            self.negate = True
+            parts.pop()
+
+        self.path, self.field = self.get_field(doc_class, parts)
+
+    @staticmethod
+    def get_field(doc_class, parts):
+        """ Returns the path on the database and the field, so we can convert the values the same way mongoengine does """
+
+        if not doc_class:
+            return ".".join(parts), None
+
+        path = []
+        fields = doc_class._lookup_field(parts)
+        for field in fields:
+            path.append(field if isinstance(field, str) else field.db_field)
+
+        field = fields[-1] if fields and not isinstance(fields[-1], str) else None
+        return ".".join(path), field
+
+    def get_value(self, value):
+        """ Converts the value from the url the same way build_query_from_url always did """
+
+        if self.kind == "date":
+            return datetime.fromtimestamp(get_timestamp_verbose(value))
+
+        if self.kind == "raw":
+            return value
+
+        if value == "NULL":
+            value = None
+
+        if self.op == "ne" and value is None:
+            pass
+
+        elif self.op == "size":
+            value = int(value)
+
+        elif self.op in QUERY_NUMBER_OPERATORS:
+            value = get_query_number(value)
+
+        elif self.op in QUERY_LIST_OPERATORS:
+            value = value.split(",")
+
+        return get_adaptive_value(self.key, value)
+
+    def prepare(self, value):
+        if self.op in QUERY_STRING_OPERATORS:
+            return query_string_field.prepare_query_value(self.op, value)
+
+        if not self.field or self.op in ['size', 'exists', 'mod']:
+            return value
+
+        if self.op in QUERY_LIST_OPERATORS and isinstance(value, list):
+            return [self.field.prepare_query_value(self.op, v) for v in value]
+
+        return self.field.prepare_query_value(self.op, value)
+
+    def get_condition(self, value):
+        value = self.prepare(value)
+
+        if not self.op or self.op in QUERY_STRING_OPERATORS:
+            condition = value
+        else:
+            condition = {'$' + self.op: value}
+
+        if self.negate:
+            condition = {'$not': condition}
+
+        return {self.path: condition}
+
+    def build(self, args, arguments):
+        if self.kind == "multi":
+            # Duplicated arguments are OR
+            conditions = [self.get_condition(get_adaptive_value(self.key, v)) for v in arguments[self.key]]
+            return {'$or': conditions}
+
+        return self.get_condition(self.get_value(args[self.key]))
+
+    def describe(self):
+        return {
+            'key': self.key,
+            'kind': self.kind,
+            'join': self.join,
+            'path': self.path,
+            'op': self.op,
+            'negate': self.negate,
+            'field': type(self.field).__name__ if self.field else None,
+        }
+
+
+def query_combine(query, condition, join):
+    """ query & condition or query | condition, flattening the chains of the same operator """
+
+    if query is None:
+        return condition
+
+    op = '$' + join
+    if len(query) == 1 and op in query:
+        return {op: query[op] + [condition]}
+
+    return {op: [query, condition]}
+
+
+class QueryPlan():
+    """ The compiled shape of a query, the parameter names and operators. Values are applied on build() """
+
+    def __init__(self, doc_class, args, arguments):
+        self.doc_class = doc_class.__name__ if doc_class else None
+        self.terms = []
+        self.hits = 0
+        self.creation_date = datetime.now()
+
+        for key in args:
+            if key[0] == "_":
+                continue
+
+            if "_date" in key:
+                self.terms.append(QueryTerm(doc_class, key, "date"))
+                continue
+
+            if key in QUERY_RESERVED_WORDS:
+                continue
+
+            x = key.split("--")
+            if len(x) > 1:
+                if x[0] in ["and", "or"]:
+                    self.terms.append(QueryTerm(doc_class, key, "raw", join=x[0]))
+
+                continue
+
+            if key in arguments and len(arguments[key]) > 1:
+                self.terms.append(QueryTerm(doc_class, key, "multi"))
+            else:
+                self.terms.append(QueryTerm(doc_class, key, "value"))
+
+    def build(self, args, arguments):
+        """ Returns the raw mongo filter for these values """
+        self.hits += 1
+
+        query = None
+        for term in self.terms:
+            query = query_combine(query, term.build(args, arguments), term.join)
+
+        return query or {}
+
+    def describe(self):
+        return {
+            'doc_class': self.doc_class,
+            'hits': self.hits,
+            'creation_date': self.creation_date,
+            'terms': [term.describe() for term in self.terms],
+        }
+
+
+class QueryPlanCache():
+    """ LRU of the plans by query shape, dashboards repeat the same queries with different values """
+
+    def __init__(self, size=QUERY_PLAN_CACHE_SIZE):
+        self.lock = threading.Lock()
+        self.size = size
+        self.plans = OrderedDict()
+
+    @staticmethod
+    def get_shape(doc_class, args, arguments):
+        keys = tuple((key, key in arguments and len(arguments[key]) > 1) for key in args)
+        return (doc_class.__name__ if doc_class else None, keys)
+
+    def get(self, doc_class, args, arguments):
+        shape = self.get_shape(doc_class, args, arguments)
+
+        with self.lock:
+            plan = self.plans.get(shape)
+            if plan:
+                self.plans.move_to_end(shape)
+                return plan
+
+        plan = QueryPlan(doc_class, args, arguments)
+
+        with self.lock:
+            self.plans[shape] = plan
+            if len(self.plans) > self.size:
+                self.plans.popitem(last=False)
+
+        return plan
 
+    def describe(self):
+        with self.lock:
+            return [plan.describe() for plan in self.plans.values()]
 
-def build_query_from_url(args=None):
+
+query_plan_cache = QueryPlanCache()
+
+
+def build_query_from_url(args=None, MyClass=None, arguments=None):
     """
-        This function converts the URL into a valid mongoengine/mongo format.
+        This function converts the URL into a raw mongo filter.
 
         We support a list functions __nin, __in and __all usign comma separated values
         example:
@@ -676,79 +948,21 @@ def build_query_from_url(args=None):
         example:
             /api/news/query?ai_summary__ne=NULL&order_by=-creation_date&creation_date__gte=1+day
 
+        The parameter names are compiled once into a plan (check query_plan_cache),
+        calls with the same names only convert the values.
+        MyClass is the document we query, its fields convert the values as mongoengine does.
     """
     if not args:
         args = request.args.to_dict()
 
     args = query_clean_reserved(args)
 
-    clean_args = {}
-    q_and = []
-    q_or = []
-
     # Duplicated arguments are OR
-    arguments = request.args.to_dict(flat=False)
-
-    # First we find unique arguments.
-    query = None
-    for key, value in args.items():
-        print(key, ":", value)
-        if key[0] == "_":
-            continue
-
-        if "_date" in key:
-            value = get_timestamp_verbose(value)
-            newkey = {key: datetime.fromtimestamp(value)}
-            myq = Q(**newkey)
-            query = query & myq if query else myq
-            continue
-
-        if key in ["key", "database", "value", "k"]:
-            print(" Rerverved words ")
-            continue
-
-        x = key.split("--")
-        if len(x) > 1:
-            newkey = {x[1]: value}
-            if x[0] == "and":
-                query = query & Q(**newkey) if query else Q(**newkey)
-
-            elif x[0] == "or":
-                query = query | Q(**newkey) if query else Q(**newkey)
-
-        else:
-            if value == "NULL":
-                value = None
-
-            if key in arguments and len(arguments[key]) > 1:
-                query_or = None
-                for v in arguments[key]:
-                    newkey = {key: get_adaptive_value(key, v)}
-                    query_or = query_or | Q(**newkey) if query_or else Q(**newkey)
-
-                query = query & query_or if query else query_or
-            else:
-
-                parms = key.split("__")
-                if len(parms) > 1:
-                    # We don't support equal number... :(
-                    if parms[-1] == "ne" and value == None:
-                        pass
-
-                    # Looking for an specific size
-                    elif 'size' in parms[1:]:
-                        value = int(value)
-
-                    elif parms[-1] in ['gte', 'lte', 'lt', 'gt', 'ne', 'not']:
-                        value = float(value)
-
-                    elif parms[1] in ['in', 'nin', 'all']:
-                        value = value.split(",")
-
-                newkey = {key: get_adaptive_value(key, value)}
-                query = query & Q(**newkey) if query else Q(**newkey)
+    if arguments is None:
+        arguments = request.args.to_dict(flat=False)
 
-    return query
+    plan = query_plan_cache.get(MyClass, args, arguments)
+    return plan.build(args, arguments)
 
 
 def mongo_prevalidate_fields(object, values):
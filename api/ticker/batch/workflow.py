@@ -41,6 +41,73 @@ from .yfinance.ytickers_pipeline import (yticker_check_tickers,
 # https://learn.temporal.io/getting_started/python/first_program_in_python/
 
 
+def ticker_get_news_batch(BATCH_SIZE=5):
+    """ Returns the next news to index, in a single query ordered by priority:
+        0. News we want to reindex.
+        1. News waiting to be indexed.
+        2. Indexed news without an AI summary, something failed.
+        3. Any news without an AI summary, we process a bigger batch of those.
+    """
+
+    pipeline = [{
+        "$match": {
+            "$or": [{
+                "force_reindex": True
+            }, {
+                "status": "WAITING_INDEX"
+            }, {
+                "ai_summary": None
+            }]
+        }
+    }, {
+        "$project": {
+            "_id": 1,
+            "priority": {
+                "$switch": {
+                    "branches": [{
+                        "case": {
+                            "$eq": ["$force_reindex", True]
+                        },
+                        "then": 0
+                    }, {
+                        "case": {
+                            "$eq": ["$status", "WAITING_INDEX"]
+                        },
+                        "then": 1
+                    }, {
+                        "case": {
+                            "$eq": ["$status", "INDEXED"]
+                        },
+                        "then": 2
+                    }],
+                    "default": 3
+                }
+            }
+        }
+    }, {
+        "$sort": {
+            "priority": 1
+        }
+    }, {
+        "$limit": BATCH_SIZE * 10
+    }]
+
+    candidates = list(DB_News.objects.aggregate(pipeline))
+    if not candidates:
+        return []
+
+    # We only process the most important group
+    priority = candidates[0]['priority']
+    if priority == 2:
+        print_r(" PROCESSING INDEXED NEWS THAT FAILED FOR SOME REASON ")
+
+    batch_size = BATCH_SIZE * 10 if priority == 3 else BATCH_SIZE
+    ids = [item['_id'] for item in candidates if item['priority'] == priority][:batch_size]
+
+    news = {item.id: item for item in DB_News.objects(id__in=ids)}
+    return [news[news_id] for news_id in ids if news_id in news]
+
+
 def ticker_process_news_sites(BATCH_SIZE=5):
     """ Fetches all the news to be indexed and calls the API to fetch them
         We don't have yet a self-registering plugin api so we will just call manually depending on the source.
@@ -62,21 +129,7 @@ def ticker_process_news_sites(BATCH_SIZE=5):
             print_exception(e, "CRASHED")
             pass
 
-    query = Q(force_reindex=True)
-    news = DB_News.objects(query)[:BATCH_SIZE]
-    if news.count() == 0:
-        query = Q(status='WAITING_INDEX')
-        news = DB_News.objects(query)[:BATCH_SIZE]
-
-    if news.count() == 0:
-        print_r(" PROCESSING INDEXED NEWS THAT FAILED FOR SOME REASON ")
-        query = Q(status='INDEXED') & Q(ai_summary=None)
-        news = DB_News.objects(query)[:BATCH_SIZE]
-
-    if news.count() == 0:
-        print_r(" PROCESSING INDEXED NEWS THAT FAILED FOR SOME REASON ")
-        query = Q(ai_summary=None)
-        news = DB_News.objects(query)[:BATCH_SIZE * 10]
+    news = ticker_get_news_batch(BATCH_SIZE)
 
     for item in news:
         try:
@@ -1,4 +1,5 @@
 import yfinance as yf
+from api.api_metrics import get_external_hooks
 from pyrate_limiter import Duration, Limiter, RequestRate
 from requests import Session
 from requests_cache import CacheMixin, SQLiteCache
@@ -17,6 +18,7 @@ request_session = CachedLimiterSession(
     bucket_class=MemoryQueueBucket,
     backend=SQLiteCache("yfinance.cache"),
 )
+request_session.hooks = get_external_hooks("yfinance")
 
 def fetch_tickers_info(ticker, no_cache=False):
     global request_session
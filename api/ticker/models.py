@@ -92,21 +92,6 @@ class DB_Ticker(db.DynamicDocument):
     def serialize(self):
         return mongo_to_dict_helper(self)
 
-    def set_state(self, state_msg, dry_run=False):
-        """ Update a processing state """
-        if dry_run:
-            return self
-
-        self.update(**{
-            'force_reindex': False,
-            'status': state_msg,
-            'last_processed_date': datetime.now()
-        },
-                    validate=False)
-
-        self.reload()
-        return self
-
     def query_exchange_ticker(full_symbol):
         from api.ticker.tickers_helpers import standardize_ticker_format
 
@@ -167,9 +152,21 @@ class DB_Ticker(db.DynamicDocument):
         ret = super(DB_Ticker, self).save(*args, **kwargs)
         return ret
 
-    def set_state(self, state_msg):
+    def set_state(self, state_msg, dry_run=False):
         """ Update a processing state """
-        self.update(**{'status': state_msg, 'last_processed_date': datetime.now()}, validate=False)
+        if dry_run:
+            return self
+
+        from api.api_metrics import observe_state_change
+        observe_state_change("ticker", self.status, state_msg, self.last_processed_date)
+
+        now = datetime.now()
+        self.update(**{'status': state_msg, 'last_processed_date': now}, validate=False)
+
+        # Keep our copy in sync, the next transition is measured from here
+        self.status = state_msg
+        self.last_processed_date = now
+        self._clear_changed_fields()
         return self
 
 
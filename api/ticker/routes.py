@@ -1,17 +1,11 @@
 from datetime import datetime
 
-import pandas as pd
 from api import (admin_login_required, api_key_or_login_required,
                  get_response_error_formatted, get_response_formatted)
 from api.print_helper import *
 from api.query_helper import (build_query_from_request, get_timestamp_verbose,
                               mongo_to_dict_helper)
 from api.ticker import blueprint
-from api.ticker.batch.workflow import (ticker_process_batch,
-                                       ticker_process_invalidate,
-                                       ticker_process_news_sites)
-from api.ticker.batch.yfinance.ytickers_pipeline import \
-    ticker_update_financials
 from api.ticker.tickers_helpers import standardize_ticker_format
 from flask import request
 from mongoengine.queryset.visitor import Q
@@ -58,6 +52,8 @@ def api_batch_dry_run():
         the configured date and download news, information, process videos, etc.
     """
 
+    from api.ticker.batch.workflow import ticker_process_batch
+
     processed = ticker_process_batch(dry_run=True)
     return get_response_formatted({'processed': processed})
 
@@ -108,6 +104,8 @@ def api_batch_process():
     ts = get_timestamp_verbose(lte)
     print_b(" PROCESS => " + str(ts))
 
+    from api.ticker.batch.workflow import ticker_process_batch
+
     end = datetime.fromtimestamp(ts)
 
     print_b(" PROCESS REAL DATE " + str(end))
@@ -128,6 +126,8 @@ def api_batch_news_process():
         Processes the links on the news folder, it will search for a batch of unprocess data and launch fetches
     """
 
+    from api.ticker.batch.workflow import ticker_process_news_sites
+
     processed = ticker_process_news_sites()
     return get_response_formatted({'processed': processed})
 
@@ -137,6 +137,7 @@ def api_batch_news_process():
 def api_update_ticker(full_symbol):
     """ We invalidate a ticker so we load everything.
     """
+    from api.ticker.batch.workflow import ticker_process_invalidate
     from flask_login import current_user
 
     from .tickers_helpers import extract_ticker_from_symbol
@@ -351,6 +352,8 @@ def api_get_exchange_verbose_long_name(name):
 @blueprint.route('/index/test', methods=['POST', 'GET'])
 #@api_key_or_login_required
 def api_index_test_tickers():
+    import pandas as pd
+
     from .connector_yfinance import fetch_tickers_list
 
     tickers = ['NVO', 'QCOM']
@@ -490,6 +493,8 @@ def api_user_watchlist(name):
     ret = {'list_name': name, 'exchange_tickers': watchlist.exchange_tickers}
 
     if request.args.get("add_financials", None) == "1":
+        from api.ticker.batch.yfinance.ytickers_pipeline import ticker_update_financials
+
         fin = {}
         for full_symbol in watchlist.exchange_tickers:
             try:
@@ -2,7 +2,6 @@ import re
 from textwrap import fill
 
 import six
-from bs4 import BeautifulSoup, Comment, Doctype, NavigableString
 
 convert_heading_re = re.compile(r'convert_h(\d+)')
 line_beginning_re = re.compile(r'^', re.MULTILINE)
@@ -103,6 +102,9 @@ class MarkdownConverter(object):
                              ' convert, but not both.')
 
     def convert(self, html):
+        # bs4 is only loaded when we convert something
+        from bs4 import BeautifulSoup
+
         soup = BeautifulSoup(html, 'html.parser')
         return self.convert_soup(soup)
 
@@ -110,6 +112,8 @@ class MarkdownConverter(object):
         return self.process_tag(soup, convert_as_inline=False, children_only=True)
 
     def process_tag(self, node, convert_as_inline, children_only=False):
+        from bs4 import Comment, Doctype, NavigableString
+
         text = ''
 
         # markdown headings or cells can't include
@@ -3,14 +3,18 @@ import shutil
 import time
 from datetime import datetime, timedelta
 
+from api.config import get_config_value
 from api.galleries.models import DB_UserGalleries
-from api.media.models import File_Tracking
+from api.media.models import DB_MediaBlob, File_Tracking
 from api.print_helper import *
 from api.query_helper import *
 from api.query_helper import mongo_to_dict_helper
 from api.tools.signature_serializer import BadSignature, SignatureExpired
 from api.tools.signature_serializer import \
     TimedJSONWebSignatureSerializer as Serializer
+from api.user.token_cache import (AUTH_TOKEN_CACHE_TTL, UserPrincipal,
+                                  verified_token_cache)
+from api.user.usage import USAGE_MIN_INTERVAL, usage_flusher
 from flask import current_app, json
 from flask_login import UserMixin, current_user
 from imgapi_launcher import db, login_manager
@@ -154,17 +158,12 @@ class User(UserMixin, db.DynamicDocument):
         return True
 
     def check_in_usage(self):
+        """ The access is written by the usage flusher in the background """
         try:
             elapsed = datetime.utcnow() - self.last_access_date if self.last_access_date else None
-            if not elapsed or elapsed.total_seconds() > 1200:
-                if elapsed:
-                    print_h1("SAVE USER UPDATE - ELAPSED " + str(elapsed.total_seconds()))
-
-                if not self.creation_date:
-                    self.creation_date = datetime.utcnow()
-
+            if not elapsed or elapsed.total_seconds() > USAGE_MIN_INTERVAL:
+                usage_flusher.touch(self.username)
                 self.last_access_date = datetime.utcnow()
-                self.save(validate=False)
 
         except Exception as err:
             print_e(" CRASH saving last access " + str(err))
@@ -278,9 +277,32 @@ class User(UserMixin, db.DynamicDocument):
 
         return get_response_error_formatted(403, {'error_msg': 'User is not active!'})
 
+    @staticmethod
+    def verify_auth_token_cached(token):
+        """ Same as verify_auth_token but returns an UserPrincipal, keys we verified recently don't hit the database """
+
+        data = verified_token_cache.get(token)
+        if data:
+            return UserPrincipal(data)
+
+        user = User.verify_auth_token(token)
+        if not isinstance(user, User):
+            return user
+
+        data = UserPrincipal.get_principal_data(user)
+        verified_token_cache.set(token, data, get_config_value("AUTH_TOKEN_CACHE_TTL", AUTH_TOKEN_CACHE_TTL))
+        return UserPrincipal(data, user)
+
     def delete_media(self):
+        from api.media.storage import media_blob_release
+
         print(" FULL USER CLEAN UP - REMOVE FILES AND DATABASE ENTRIES ")
 
+        # Release our references to the shared content, the blob is removed if nobody else uses it
+        blob_files = File_Tracking.objects(username=self.username, file_path__startswith=DB_MediaBlob.BLOB_FOLDER)
+        for my_file in blob_files.only('checksum_md5'):
+            media_blob_release(my_file.checksum_md5)
+
         # Delete every file that contains me
         File_Tracking.objects(username=self.username).delete()
 
@@ -298,6 +320,7 @@ class User(UserMixin, db.DynamicDocument):
         self.delete_media()
         self.galleries.clear_all(self.username)
 
+        verified_token_cache.invalidate(self.username)
         return super(User, self).delete(*args, **kwargs)
 
     def populate_media(self, media_list):
@@ -311,37 +334,19 @@ class User(UserMixin, db.DynamicDocument):
         return {"deleted": True}
 
     def get_photostream_position(self, media_id, position):
-        stream_list = File_Tracking.objects(username=self.username)
+        """ Returns the media next or previous to media_id on the user photostream """
 
+        media_file = File_Tracking.objects(pk=media_id).first()
+        if not media_file:
+            print_r(" Media not found on photostream " + str(media_id))
+            return None
+
+        # We navigate on the stream of the owner of the media
         only_public = True
-        if current_user.is_authenticated and self.username == current_user.username:
+        if current_user.is_authenticated and media_file.username == current_user.username:
             only_public = False
 
-        # Convert cursor into list
-        found = -1
-        for idx, item in enumerate(stream_list):
-            if str(item.id) == media_id:
-                found = idx
-                break
-
-        if found == -1:
-            print_r(" Media not found on photostream wtf " + str(media_id))
-            found = 0
-
-        while position < len(stream_list):
-            new_media = stream_list[(found + position) % len(stream_list)]
-            if 'info' not in new_media:
-                # We don't have info?... what?
-                new_media.delete()
-                position += 1
-                continue
-
-            if only_public and not new_media.is_public:
-                position += 1
-            else:
-                return new_media
-
-        return media_id
+        return media_file.get_stream_neighbour(position, only_public=only_public)
 
     def get_media_list(self, gallery_id, raw_db=False):
         """ Returns a dictionary with the media list """
@@ -359,6 +364,13 @@ class User(UserMixin, db.DynamicDocument):
     def save(self, *args, **kwargs):
         ret = super(User, self).save(*args, **kwargs)
         ret.reload()
+
+        verified_token_cache.invalidate(self.username)
+        return ret
+
+    def update(self, *args, **kwargs):
+        ret = super(User, self).update(*args, **kwargs)
+        verified_token_cache.invalidate(self.username)
         return ret
 
     def action_on_list(self, media_id, action, media_list_short_name):
@@ -14,6 +14,7 @@ from api.tools import is_api_call
 from api.tools.validators import is_valid_username
 from api.user import blueprint
 from api.user.models import User
+from api.user.token_cache import verified_token_cache
 from flask import Response, abort, redirect, request
 from flask_login import current_user, login_user, logout_user
 from flask_mail import Message
@@ -686,6 +687,8 @@ def api_user_remove_user(username):
     users = User.objects(username=username)
     ret = {'users': users}
     users.delete()
+
+    verified_token_cache.invalidate(username)
     return get_response_formatted(ret)
 
 
@@ -898,7 +901,12 @@ def api_get_by_list_id(list_id, image_type=None):
     """
     from api.media.routes import api_populate_media_list
 
-    the_list = DB_MediaList.objects(pk=list_id).first()
+    op = DB_MediaList.objects(pk=list_id)
+    if image_type == "random":
+        # We pick the item on the database, no need to load the list
+        op = op.exclude('media_list')
+
+    the_list = op.first()
     if not the_list:
         return abort(404, "Missing Gallery")
 
@@ -906,11 +914,16 @@ def api_get_by_list_id(list_id, image_type=None):
         if not the_list.is_public:
             return abort(401, "Unauthorized")
 
-    ret = mongo_to_dict_helper(the_list)
-
-    arr = the_list.get_as_list()
     if image_type == "random":
-        arr = [random.choice(arr)]
+        items = the_list.get_random_items(1)
+
+        ret = mongo_to_dict_helper(the_list, filter_out=['media_list'])
+        ret['media_list'] = mongo_to_dict_helper(items)
+
+        arr = [item.media_id for item in items]
+    else:
+        ret = mongo_to_dict_helper(the_list)
+        arr = the_list.get_as_list()
 
     if request.args.get("populate", False):
         ret.update(api_populate_media_list(the_list.username, arr, the_list.is_order_asc))
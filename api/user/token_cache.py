@@ -0,0 +1,150 @@
+"""
+    Cache of the API keys we verified already.
+
+    Verifying a key means checking its signature and loading the user from the database,
+    API clients send the same key thousands of times so we keep a lightweight principal
+    (the fields the decorators need) for a short time. The full User is only loaded if a view needs it.
+
+    Every update or delete of an User invalidates its keys on this process,
+    the other processes get the change when the entry expires.
+"""
+
+import threading
+import time
+
+from flask import abort
+from flask_login import UserMixin
+
+# Seconds a verified key is trusted without checking the database
+AUTH_TOKEN_CACHE_TTL = 60
+
+# We drop the expired entries when the cache gets this big
+AUTH_TOKEN_CACHE_SIZE = 10000
+
+PRINCIPAL_FIELDS = ['id', 'username', 'is_admin', 'active', 'is_anon', 'current_subscription']
+
+
+class UserPrincipal(UserMixin):
+    """ Identity of a verified key, it is the current_user of the request.
+        It behaves as the User and loads it from the database on first use.
+    """
+
+    def __init__(self, data, user=None):
+        self.__dict__['_data'] = data
+        self.__dict__['_user'] = user
+
+    @staticmethod
+    def get_principal_data(user):
+        data = {key: user[key] for key in PRINCIPAL_FIELDS}
+        data['id'] = str(user.id)
+        return data
+
+    def get_id(self):
+        return self._data['id']
+
+    def is_active(self):
+        return self._data['active']
+
+    def check_in_usage(self):
+        from .usage import usage_flusher
+
+        usage_flusher.touch(self._data['username'])
+        return True
+
+    def get_user(self):
+        """ The user might have been deleted on another process while its key was on our cache,
+            the key is not valid anymore so the request ends with a 401.
+        """
+        if self._user is None:
+            from .models import User
+
+            user = User.objects(username=self._data['username']).first()
+            if not user:
+                verified_token_cache.invalidate(self._data['username'])
+                abort(401, "User not found, please login again.")
+
+            self.__dict__['_user'] = user
+
+        return self._user
+
+    def __getattr__(self, key):
+        if key in self._data:
+            return self._data[key]
+
+        return getattr(self.get_user(), key)
+
+    def __setattr__(self, key, value):
+        # Changes go to the real user, so a save() stores them
+        self._data.pop(key, None)
+        setattr(self.get_user(), key, value)
+
+    def __getitem__(self, key):
+        return self.get_user()[key]
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self.get_user()[key] = value
+
+    def __contains__(self, key):
+        return key in self.get_user()
+
+    def __iter__(self):
+        return iter(self.get_user())
+
+
+class VerifiedTokenCache():
+    """ key => (expiration, principal data), and username => keys so we can invalidate an user """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.entries = {}
+        self.user_tokens = {}
+
+    def get(self, token):
+        entry = self.entries.get(token)
+        if not entry:
+            return None
+
+        expiration, data = entry
+        if expiration < time.time():
+            return None
+
+        return data
+
+    def set(self, token, data, ttl=AUTH_TOKEN_CACHE_TTL):
+        with self.lock:
+            if len(self.entries) >= AUTH_TOKEN_CACHE_SIZE:
+                self.prune()
+
+            self.entries[token] = (time.time() + ttl, data)
+            self.user_tokens.setdefault(data['username'], set()).add(token)
+
+    def prune(self):
+        now = time.time()
+        for token, (expiration, data) in list(self.entries.items()):
+            if expiration < now:
+                self.remove(token, data['username'])
+
+        # Everything is fresh, we just start again
+        if len(self.entries) >= AUTH_TOKEN_CACHE_SIZE:
+            self.clear()
+
+    def remove(self, token, username):
+        self.entries.pop(token, None)
+
+        tokens = self.user_tokens.get(username)
+        if tokens:
+            tokens.discard(token)
+            if not tokens:
+                del self.user_tokens[username]
+
+    def invalidate(self, username):
+        with self.lock:
+            for token in self.user_tokens.pop(username, set()):
+                self.entries.pop(token, None)
+
+
+verified_token_cache = VerifiedTokenCache()
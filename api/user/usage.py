@@ -0,0 +1,80 @@
+"""
+    Last access of the users.
+
+    Requests only mark the user as seen, a background thread writes the accesses
+    of every user in a single bulk operation, so the request never waits for the database.
+"""
+
+import threading
+import time
+from datetime import datetime
+
+from api.print_helper import *
+from pymongo import UpdateOne
+
+# Seconds between writes of the pending accesses
+USAGE_FLUSH_SECONDS = 30
+
+# We don't store a new access for the same user before this
+USAGE_MIN_INTERVAL = 1200
+
+
+class UsageFlusher():
+    """ username => last access not written yet, flushed every USAGE_FLUSH_SECONDS """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.touched = {}
+        self.thread = None
+
+    def touch(self, username):
+        now = time.time()
+        if now - self.touched.get(username, 0) < USAGE_MIN_INTERVAL:
+            return
+
+        with self.lock:
+            self.touched[username] = now
+            self.pending[username] = datetime.utcnow()
+
+            if not self.thread or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="usage_flusher", daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(USAGE_FLUSH_SECONDS)
+
+            try:
+                self.flush()
+            except Exception as e:
+                print_exception(e, " CRASH saving last access ")
+
+    def flush(self):
+        from .models import User
+
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+
+        if not pending:
+            return 0
+
+        operations = []
+        for username, access_date in pending.items():
+            operations.append(UpdateOne({'username': username}, {'$set': {'last_access_date': access_date}}))
+
+            # Old accounts didn't store when they were created
+            operations.append(
+                UpdateOne({
+                    'username': username,
+                    'creation_date': None
+                }, {'$set': {
+                    'creation_date': access_date
+                }}))
+
+        User._get_collection().bulk_write(operations, ordered=False)
+        return len(pending)
+
+
+usage_flusher = UsageFlusher()
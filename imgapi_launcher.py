@@ -8,19 +8,21 @@ from flask import Flask, json, jsonify, request
 from flask_cors import CORS
 from flask_login import LoginManager, current_user
 from flask_mongoengine import MongoEngine, MongoEngineSessionInterface
+from imgapi_profiler import init_profiler, register_profiler
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
 
 # Enable CORS on the entire application
 
-if os.environ.get('IMGAPI_SETTINGS', False):
-    app.config.from_envvar('IMGAPI_SETTINGS')
-
 MONGODB_SETTINGS = {'host': 'mongodb://localhost/demo', 'port': 27017}
 
 app.config.update(DEBUG=True, MONGODB_SETTINGS=MONGODB_SETTINGS, SECRET_KEY="mysecret_key_loaded_from_the_system")
 
+# Defaults first, the settings file of IMGAPI_SETTINGS overrides them
+if os.environ.get('IMGAPI_SETTINGS', False):
+    app.config.from_envvar('IMGAPI_SETTINGS')
+
 # Path to the configuration file
 config_path = os.path.expanduser('~/.imgapi.json')
 
@@ -32,11 +34,15 @@ if os.path.exists(config_path):
 else:
     print("Config file not found")
 
-# Database initialization
+# Database initialization, the profiler has to listen before we connect
+
+register_profiler()
 
 db = MongoEngine()
 db.init_app(app)
 
+init_profiler(app)
+
 # Login manager to handle users
 
 login_manager = LoginManager()
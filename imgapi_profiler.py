@@ -0,0 +1,257 @@
+"""
+    Database profiler, it records every mongo command of a request.
+
+    We listen to the pymongo command monitoring, so every query counts, mongoengine or raw.
+    The listener has to be registered before the connection is created, that is why it lives
+    outside of the api package and imgapi_launcher loads it before the database.
+
+    Commands are grouped by shape, the command and the collection with the values of the filter removed.
+    The same shape repeated many times on a single request is usually a query inside a loop (N+1).
+
+    With DB_PROFILER_HEADER the summary of the request goes into the X-DB-Profile header of the admins,
+    it shows our collections so it is off by default. The totals per endpoint are returned by /api/admin/db_profile
+"""
+
+import json
+import threading
+import time
+
+from flask import request
+from pymongo import monitoring
+
+# The same shape this many times on a request is flagged as N+1
+N_PLUS_ONE_THRESHOLD = 5
+
+# We keep a few examples of the N+1 shapes of every endpoint
+N_PLUS_ONE_EXAMPLES = 5
+
+# Commands which are not queries
+IGNORED_COMMANDS = ['isMaster', 'ismaster', 'hello', 'ping', 'saslStart', 'saslContinue', 'endSessions', 'buildInfo']
+
+
+def get_value_shape(value):
+    """ The structure of a filter without the values.
+        {'username': 'a', 'age': {'$gt': 5}} => {'username': '?', 'age': {'$gt': '?'}}
+    """
+
+    if isinstance(value, dict):
+        return {key: get_value_shape(item) for key, item in value.items()}
+
+    if isinstance(value, (list, tuple)):
+        # $in: [1, 2, 3] is the same query than $in: [4]
+        if value and isinstance(value[0], dict):
+            return [get_value_shape(item) for item in value]
+
+        return ['?']
+
+    return '?'
+
+
+def get_command_shape(command_name, command):
+    collection = command.get(command_name)
+    if command_name == 'getMore':
+        collection = command.get('collection')
+
+    if not isinstance(collection, str):
+        collection = ""
+
+    shape = None
+    if command_name in ['find', 'count', 'distinct']:
+        shape = command.get('filter', command.get('query'))
+
+    elif command_name == 'aggregate':
+        shape = [list(stage.keys())[0] for stage in command.get('pipeline', []) if stage]
+
+    elif command_name in ['update', 'delete']:
+        statements = command.get('updates', command.get('deletes', []))
+        if statements:
+            shape = statements[0].get('q')
+
+    elif command_name == 'findAndModify':
+        shape = command.get('query')
+
+    text = command_name + " " + collection
+    if shape:
+        text += " " + json.dumps(get_value_shape(shape), sort_keys=True, default=str)
+
+    return text
+
+
+class RequestProfile():
+    """ Commands of a single request, shape => [count, milliseconds] """
+
+    def __init__(self):
+        self.start = time.time()
+        self.count = 0
+        self.duration_ms = 0
+        self.shapes = {}
+        self.pending = {}
+
+    def started(self, event):
+        self.pending[event.request_id] = get_command_shape(event.command_name, event.command)
+
+    def finished(self, event):
+        shape = self.pending.pop(event.request_id, None)
+        if not shape:
+            return
+
+        duration_ms = event.duration_micros / 1000
+
+        self.count += 1
+        self.duration_ms += duration_ms
+
+        entry = self.shapes.setdefault(shape, [0, 0])
+        entry[0] += 1
+        entry[1] += duration_ms
+
+    def get_n_plus_one(self):
+        # Iterating a big cursor fetches many batches, that is not a query per item
+        return {
+            shape: entry[0]
+            for shape, entry in self.shapes.items()
+            if entry[0] >= N_PLUS_ONE_THRESHOLD and not shape.startswith("getMore")
+        }
+
+    def get_header(self):
+        header = "queries=%d; db_ms=%.1f; request_ms=%.1f" % (self.count, self.duration_ms,
+                                                              (time.time() - self.start) * 1000)
+
+        n_plus_one = self.get_n_plus_one()
+        if n_plus_one:
+            # The command and collection is enough to find it
+            worst = max(n_plus_one.items(), key=lambda x: x[1])
+            header += "; n_plus_one=%d; worst=%s x%d" % (len(n_plus_one), " ".join(worst[0].split(" ")[0:2]),
+                                                         worst[1])
+
+        return header
+
+
+class DatabaseProfiler(monitoring.CommandListener):
+    """ Sends the commands to the profile of the request running on this thread """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def get_profile(self):
+        return getattr(self.local, 'profile', None)
+
+    def started(self, event):
+        profile = self.get_profile()
+        if profile and event.command_name not in IGNORED_COMMANDS:
+            profile.started(event)
+
+    def succeeded(self, event):
+        profile = self.get_profile()
+        if profile:
+            profile.finished(event)
+
+    def failed(self, event):
+        profile = self.get_profile()
+        if profile:
+            profile.finished(event)
+
+    def begin(self):
+        self.local.profile = RequestProfile()
+
+    def end(self):
+        profile = self.get_profile()
+        self.local.profile = None
+        return profile
+
+    def add_to_endpoint(self, endpoint, profile):
+        n_plus_one = profile.get_n_plus_one()
+
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if not stats:
+                stats = self.endpoints[endpoint] = {
+                    'requests': 0,
+                    'queries': 0,
+                    'db_ms': 0,
+                    'max_queries': 0,
+                    'n_plus_one_requests': 0,
+                    'n_plus_one_shapes': {},
+                }
+
+            stats['requests'] += 1
+            stats['queries'] += profile.count
+            stats['db_ms'] += profile.duration_ms
+            stats['max_queries'] = max(stats['max_queries'], profile.count)
+
+            if n_plus_one:
+                stats['n_plus_one_requests'] += 1
+
+                shapes = stats['n_plus_one_shapes']
+                for shape, count in n_plus_one.items():
+                    if shape in shapes or len(shapes) < N_PLUS_ONE_EXAMPLES:
+                        shapes[shape] = max(shapes.get(shape, 0), count)
+
+    def get_report(self):
+        report = []
+        with self.lock:
+            for endpoint, stats in self.endpoints.items():
+                entry = dict(stats)
+                entry['endpoint'] = endpoint
+                entry['n_plus_one_shapes'] = dict(stats['n_plus_one_shapes'])
+                entry['avg_queries'] = round(stats['queries'] / stats['requests'], 2)
+                entry['avg_db_ms'] = round(stats['db_ms'] / stats['requests'], 2)
+                entry['db_ms'] = round(stats['db_ms'], 2)
+                report.append(entry)
+
+        report.sort(key=lambda x: x['avg_queries'], reverse=True)
+        return report
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+
+
+database_profiler = DatabaseProfiler()
+
+
+def register_profiler():
+    """ Call it before we connect to the database, pymongo only adds listeners to new clients """
+    monitoring.register(database_profiler)
+
+
+def is_admin_request():
+    from flask_login import current_user
+
+    try:
+        if not current_user or not current_user.is_authenticated:
+            return False
+
+        return current_user.is_admin or current_user.username == "admin"
+    except Exception:
+        # The user might not exist anymore
+        return False
+
+
+def init_profiler(app):
+    if not app.config.get("DB_PROFILER", True):
+        return
+
+    show_header = app.config.get("DB_PROFILER_HEADER", False)
+
+    @app.before_request
+    def db_profiler_before_request():
+        database_profiler.begin()
+
+    @app.after_request
+    def db_profiler_after_request(response):
+        profile = database_profiler.end()
+        if not profile:
+            return response
+
+        database_profiler.add_to_endpoint(request.endpoint or request.path, profile)
+
+        if show_header and is_admin_request():
+            response.headers['X-DB-Profile'] = profile.get_header()
+
+        return response
+
+    @app.teardown_request
+    def db_profiler_teardown_request(exception=None):
+        database_profiler.end()
@@ -0,0 +1,31 @@
+#!/usr/bin/env bash
+
+# Benchmarks of the API hot paths, compared against the last baseline on test/benchmark/baselines
+# A median slower than the baseline by more than BENCHMARK_MAX_REGRESSION fails.
+#
+#   ./run_benchmarks.sh          Compare against the last baseline
+#   ./run_benchmarks.sh --save   Compare and store this run as the new baseline
+
+cd "${BASH_SOURCE%/*}"
+
+export LC_ALL=C.UTF-8
+export LANG=C.UTF-8
+export IMGAPI_BENCHMARK=1
+
+if [ -d .venv ]; then
+    . .venv/bin/activate
+fi
+
+BENCHMARK_MAX_REGRESSION="${BENCHMARK_MAX_REGRESSION:-25%}"
+ARGS="--benchmark-storage=file://test/benchmark/baselines"
+
+# Without a baseline we only measure
+if ls test/benchmark/baselines/*/*.json > /dev/null 2>&1; then
+    ARGS="$ARGS --benchmark-compare --benchmark-compare-fail=median:${BENCHMARK_MAX_REGRESSION}"
+fi
+
+if [ "$1" == "--save" ]; then
+    ARGS="$ARGS --benchmark-autosave"
+fi
+
+python -m pytest test/benchmark --benchmark-only $ARGS
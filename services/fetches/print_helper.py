@@ -3,21 +3,20 @@
     Proprietary and confidential
 """
 
+import atexit
 import io
+import logging
 import os
+import queue
+import re
 import sys
-
-import traceback
-
 import threading
 import time
-
-import logging
-import re
+import traceback
+from logging.handlers import QueueHandler, QueueListener
 
 import bleach
 
-from prompt_toolkit import print_formatted_text, ANSI
 """ Pretty colours library by Sergio """
 
 
@@ -29,7 +28,25 @@ def header_function(header_line):
     print("Not adding header_line")
 
 
-vt_lock = threading.Lock()
+""" Logging
+
+    The print_* helpers go through the "imgapi" logger. Records are put on a queue and a single
+    listener thread writes them, so the request threads never wait on stdout or on each other.
+
+    IMGAPI_LOG_LEVEL filters the messages before we format anything, debug messages cost nothing in production.
+    The same call site can only write IMGAPI_LOG_RATE_LIMIT messages every LOG_RATE_WINDOW seconds,
+    the rest are counted and reported with the next message. Errors are never sampled.
+"""
+
+LOG_LEVEL = os.environ.get("IMGAPI_LOG_LEVEL", "INFO").upper()
+
+LOG_RATE_LIMIT = int(os.environ.get("IMGAPI_LOG_RATE_LIMIT", 20))
+LOG_RATE_WINDOW = 10
+
+logger = logging.getLogger("imgapi")
+
+log_queue = None
+log_listener = None
 
 
 class bcolors:
@@ -51,6 +68,123 @@ class bcolors:
     ERROR = BKG_RED + WHITE
 
 
+class ColorFormatter(logging.Formatter):
+    """ Colours only on a terminal, log files get the plain text """
+
+    def __init__(self, use_color):
+        super().__init__()
+        self.use_color = use_color
+
+    def format(self, record):
+        out = record.getMessage()
+        color = getattr(record, 'color', None)
+        if self.use_color and color:
+            return color + out + bcolors.ENDC
+
+        return out
+
+
+class LogSampler():
+    """ call site => [window start, messages, suppressed]
+        We don't lock, a miscount under contention is fine for a log.
+    """
+
+    def __init__(self):
+        self.windows = {}
+
+    def allow(self, key):
+        """ Returns (allowed, messages suppressed on the previous window) """
+
+        now = time.time()
+
+        window = self.windows.get(key)
+        if not window or now - window[0] > LOG_RATE_WINDOW:
+            self.windows[key] = [now, 1, 0]
+            return True, window[2] if window else 0
+
+        window[1] += 1
+        if window[1] <= LOG_RATE_LIMIT:
+            return True, 0
+
+        window[2] += 1
+        return False, 0
+
+
+log_sampler = LogSampler()
+
+
+def start_log_listener():
+    global log_queue, log_listener
+
+    log_queue = queue.SimpleQueue()
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(ColorFormatter(sys.stdout.isatty()))
+
+    log_listener = QueueListener(log_queue, handler)
+    log_listener.start()
+
+    for queue_handler in logger.handlers:
+        if isinstance(queue_handler, QueueHandler):
+            queue_handler.queue = log_queue
+
+
+def stop_log_listener():
+    if log_listener:
+        log_listener.stop()
+
+
+def init_logger():
+    """ Only once per process, api and services share the logger """
+
+    if logger.handlers:
+        return
+
+    logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    logger.propagate = False
+
+    logger.addHandler(QueueHandler(queue.SimpleQueue()))
+    start_log_listener()
+
+    # Flush what is on the queue when we exit
+    atexit.register(stop_log_listener)
+
+    # Gunicorn forks after loading the app, the listener thread doesn't exist on the child
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=start_log_listener)
+
+
+init_logger()
+
+
+def get_call_site():
+    """ The first frame outside of this file """
+
+    frame = sys._getframe(1)
+    while frame and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+
+    if not frame:
+        return None
+
+    return (frame.f_code.co_filename, frame.f_lineno)
+
+
+def print_log(level, color, out):
+    if not logger.isEnabledFor(level):
+        return
+
+    if level < logging.ERROR and LOG_RATE_LIMIT:
+        allowed, suppressed = log_sampler.allow(get_call_site())
+        if not allowed:
+            return
+
+        if suppressed:
+            out += " [%d similar messages suppressed]" % suppressed
+
+    logger.log(level, out, extra={'color': color})
+
+
 def vt_clear():
     sys.stdout.write('\033[2J')
 
@@ -117,48 +251,41 @@ def print_h(s, character, text=''):
     return out
 
 
-def print_color(color, out=''):
-    vt_lock.acquire()
-    # Try to write into the SSH console
-    # from app.api_v1.ssh_command_line import append_text
-
-    try:
-        print_formatted_text(ANSI(color + out + bcolors.ENDC))
-    except Exception as err:
-        pass
-
-    vt_lock.release()
+def print_color(color, out='', level=logging.INFO):
+    print_log(level, color, out)
 
 
 def print_json(obj, color=""):
-    from flask import json
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
 
-    if (color == ""):
-        print_color(bcolors.OKBLUE, print_h(80, "#"))
+    from flask import json
 
-    vt_lock.acquire()
     try:
         out = json.dumps(obj, sort_keys=False, indent=4)
-        #buffer1.text += ANSI(color + out + bcolors.ENDC)
-        print_formatted_text(ANSI(color + out + bcolors.ENDC))
     except Exception as err:
-        print(str(err))
+        out = str(err)
 
-    vt_lock.release()
     if (color == ""):
-        print_color(bcolors.OKBLUE, print_h(80, "#"))
+        out = print_h(80, "#") + "\n" + out + "\n" + print_h(80, "#")
+        color = bcolors.OKBLUE
+
+    print_color(color, out, logging.DEBUG)
 
 
 def print_y(text=''):
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+
     text = print_clean_text(text)
-    print_color(bcolors.WARNING, "+ " + text)
+    print_color(bcolors.WARNING, "+ " + text, logging.DEBUG)
 
 
 def print_w(text='', save=True):
-    out = print_h(80, "#", text)
-    print_color(bcolors.WARNING, out)
-    if save:
-        logging.info("INFO " + out)
+    if not logger.isEnabledFor(logging.INFO):
+        return
+
+    print_color(bcolors.WARNING, print_h(80, "#", text))
 
 
 def print_h1(text='', save=True):
@@ -170,8 +297,7 @@ def print_e(text=''):
 
     out1 = print_h(80, "!", "")
     out2 = print_h(80, "!", text)
-    print_color(bcolors.BKG_RED + bcolors.WHITE, "\n" + out1 + "\n" + out2 + "\n" + out1)
-    logging.error(out2)
+    print_color(bcolors.BKG_RED + bcolors.WHITE, "\n" + out1 + "\n" + out2 + "\n" + out1, logging.ERROR)
 
 
 def print_error(text=''):
@@ -180,54 +306,40 @@ def print_error(text=''):
 
 def print_ce(text=''):
     """ Prints a large OKBLUE alert """
-    out = print_h(30, " ", text)
-    print_color(bcolors.OKBLUE, out)
-    logging.error(out)
+    if not logger.isEnabledFor(logging.INFO):
+        return
+
+    print_color(bcolors.OKBLUE, print_h(30, " ", text))
 
 
 def print_tx(text='', log=True, MAX_TEXT_SIZE=80):
-    vt_lock.acquire()
-    sys.stdout.write(bcolors.OKBLUE)
-
-    # sys.stdout.write(write_header(slot))
-    if (log):
-        logging.info("%s" % (text))
-
-    if (len(text) > MAX_TEXT_SIZE):
-        print("%s" % (text[:MAX_TEXT_SIZE]))
-        logging.info("%s" % (text[:MAX_TEXT_SIZE]))
-        sys.stdout.write(bcolors.ENDC)
-        vt_lock.release()
-        print_tx(text[MAX_TEXT_SIZE:], False)
+    if not logger.isEnabledFor(logging.DEBUG):
         return
 
-    print("%s" % (text))
-    sys.stdout.write(bcolors.ENDC)
-    vt_lock.release()
+    lines = [text[i:i + MAX_TEXT_SIZE] for i in range(0, len(text), MAX_TEXT_SIZE)]
+    print_color(bcolors.OKBLUE, "\n".join(lines), logging.DEBUG)
 
 
 def print_super_big(text=''):
-    sys.stdout.write(bcolors.OKBLUE)
-    print_h(80, "*", '')
-    sys.stdout.write(bcolors.OKGREEN)
-    print_h(80, "*", '')
-    sys.stdout.write(bcolors.WARNING)
-    print_h(80, "*", text)
-    sys.stdout.write(bcolors.OKGREEN)
-    print_h(80, "*", '')
-    sys.stdout.write(bcolors.OKBLUE)
-    print_h(80, "*", '')
-    sys.stdout.write(bcolors.ENDC)
-    sys.stdout.flush()
+    if not logger.isEnabledFor(logging.INFO):
+        return
+
+    out1 = print_h(80, "*", '')
+    out2 = print_h(80, "*", text)
+    print_color(bcolors.WARNING, "\n".join([out1, out1, out2, out1, out1]))
 
 
 def print_blue(text=''):
-    out = print_h(80, "*", text)
-    print_color(bcolors.OKBLUE, out)
-    logging.info(out)
+    if not logger.isEnabledFor(logging.INFO):
+        return
+
+    print_color(bcolors.OKBLUE, print_h(80, "*", text))
 
 
 def print_b(text=''):
+    if not logger.isEnabledFor(logging.INFO):
+        return
+
     text = print_clean_text(text)
     print_color(bcolors.OKBLUE, "> " + text)
 
@@ -237,12 +349,16 @@ def print_h2(text=''):
 
 
 def print_green(text=''):
-    out = print_h(80, "-", text)
-    print_color(bcolors.OKGREEN, out)
-    logging.info(out)
+    if not logger.isEnabledFor(logging.INFO):
+        return
+
+    print_color(bcolors.OKGREEN, print_h(80, "-", text))
 
 
 def print_g(text=''):
+    if not logger.isEnabledFor(logging.INFO):
+        return
+
     text = print_clean_text(text)
     print_color(bcolors.OKGREEN, "# " + text)
 
@@ -252,41 +368,60 @@ def print_h3(text=''):
 
 
 def print_h4(text=''):
-    logging.info(print_h(80, "+", text))
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+
+    print_color(None, print_h(80, "+", text), logging.DEBUG)
 
 
 def print_h5(text=''):
-    logging.info(print_h(80, "-", text))
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+
+    print_color(None, print_h(80, "-", text), logging.DEBUG)
 
 
 def print_alert(text=''):
+    if not logger.isEnabledFor(logging.WARNING):
+        return
+
     out1 = print_h(80, "%")
     out2 = print_h(80, "%", text)
-    print_color(bcolors.FAIL, "\n" + out1 + "\n" + out2 + "\n" + out1 + "\n")
-    logging.info(out2)
+    print_color(bcolors.FAIL, "\n" + out1 + "\n" + out2 + "\n" + out1 + "\n", logging.WARNING)
 
 
 def print_exception(err, text=''):
     out1 = print_h(80, "%", text)
     out2 = print_h(80, "%", str(err))
-    print_color(bcolors.FAIL, "\n" + out1 + "\n" + out2)
 
-    # traceback.print_exc()
-    traceback.print_tb(err.__traceback__)
-    logging.info(out1)
-    logging.info(out2)
+    # The traceback goes with the message, so the lines of two threads don't get mixed
+    trace = "".join(traceback.format_tb(err.__traceback__))
+    print_color(bcolors.FAIL, "\n" + out1 + "\n" + out2 + "\n" + trace, logging.ERROR)
 
 
 def print_r(text=''):
+    if not logger.isEnabledFor(logging.WARNING):
+        return
+
     text = print_clean_text(text)
-    print_color(bcolors.FAIL, "! " + text)
+    print_color(bcolors.FAIL, "! " + text, logging.WARNING)
 
 
 def print_big(text=''):
+    if not logger.isEnabledFor(logging.INFO):
+        return
+
     out1 = print_h(80, "%")
     out2 = print_h(80, "%", text)
     print_color(bcolors.HEADER, "\n" + out1 + "\n" + out2 + "\n" + out1 + "\n")
-    logging.info(out2)
+
+
+def print_debug_line(text=''):
+    """ Plain debug output, for the noisy loops """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+
+    print_color(None, text, logging.DEBUG)
 
 
 def set_cursor(x, y):
@@ -0,0 +1,162 @@
+"""
+    Imaging backends for our image operations.
+
+    Every backend exposes the same operations the worker offers, so the API and the worker can switch engine
+    with IMAGING_BACKEND on the app config or IMGAPI_IMAGING_BACKEND on the environment:
+
+        wand    ImageMagick, the default and the most complete one.
+        pillow  Faster for resizes, install pillow-simd to get the SIMD build.
+        vips    libvips through pyvips, fastest and with the lowest memory usage.
+
+    If a backend is not installed we fallback to wand.
+"""
+
+import os
+import time
+
+DEFAULT_BACKEND = "wand"
+
+# operation => transformations that the worker understands
+OPERATIONS = {
+    'convert': ['PNG', 'JPG'],
+    'transform': ['rotate_right', 'rotate_left', 'flop'],
+    'filter': ['blur', 'median'],
+    'generate': ['thumbnail', 'thumbnail_256', 'thumbnail_128', 'thumbnail_64', 'thumbnail_32'],
+}
+
+_backends = {}
+
+
+def load_backend(name):
+    if name == "pillow":
+        from .pillow_backend import PillowBackend
+        return PillowBackend()
+
+    if name == "vips":
+        from .vips_backend import VipsBackend
+        return VipsBackend()
+
+    from .wand_backend import WandBackend
+    return WandBackend()
+
+
+def get_imaging_backend(name=None):
+    """ Returns the backend requested, or the one configured in the environment """
+
+    if not name:
+        name = os.environ.get("IMGAPI_IMAGING_BACKEND", DEFAULT_BACKEND)
+
+    name = name.lower()
+    if name in _backends:
+        return _backends[name]
+
+    try:
+        backend = load_backend(name)
+    except ImportError as e:
+        print(" IMAGING BACKEND " + name + " NOT AVAILABLE " + str(e))
+        backend = load_backend(DEFAULT_BACKEND)
+
+    _backends[name] = backend
+    return backend
+
+
+def get_thumbnail_size(width, height, thumbnail, orientation='h'):
+    """ Our thumbnails keep the aspect ratio, 'h' fixes the width and 'v' fixes the height """
+    aspect_ratio = height / width
+    if orientation == 'v':
+        return int(thumbnail / aspect_ratio), thumbnail
+
+    return thumbnail, int(thumbnail * aspect_ratio)
+
+
+def apply_operation(backend, image, operation, transformation):
+    """ Applies an operation/transformation pair from the API and returns the resulting image """
+
+    if operation == "convert":
+        return backend.convert(image, transformation)
+
+    if operation == "transform":
+        if transformation == "rotate_right":
+            return backend.rotate(image, 90)
+
+        if transformation == "rotate_left":
+            return backend.rotate(image, -90)
+
+        if transformation == "flop":
+            return backend.flop(image)
+
+    if operation == "filter":
+        if transformation == "blur":
+            return backend.blur(image, 4)
+
+        if transformation == "median":
+            return backend.median(image, 8, 5)
+
+    if operation == "generate":
+        size = 16
+        if transformation.startswith("thumbnail_"):
+            size = int(transformation[len("thumbnail_"):])
+
+        width, height = backend.get_size(image)
+        return backend.resize(image, *get_thumbnail_size(width, height, size))
+
+    return image
+
+
+def run_pipeline(backend, image_path, steps, outputs):
+    """ Decodes the image once, applies the steps in order and encodes every output when its step is reached.
+
+        steps   [{'operation', 'transformation'}]
+        outputs [{'target_path', 'format', 'step'}], step is the index of the step after which we save it,
+                -1 saves the original and by default we save after the last step.
+
+        Returns the timings in seconds of every stage.
+    """
+
+    last_step = len(steps) - 1
+    timings = []
+
+    start = time.perf_counter()
+    image = backend.open(filename=image_path)
+    timings.append({'stage': 'decode', 'seconds': time.perf_counter() - start})
+
+    def save_outputs(image, idx):
+        for output in outputs:
+            if output.get('step', last_step) != idx:
+                continue
+
+            start = time.perf_counter()
+
+            # Write next to the target and rename, so nobody can read half a file
+            target_path = output['target_path']
+            tmp_path = target_path + ".TMP." + output['format']
+
+            try:
+                backend.save(image, tmp_path, output['format'])
+                os.replace(tmp_path, target_path)
+            except Exception as e:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise e
+
+            timings.append({'stage': 'encode', 'format': output['format'], 'seconds': time.perf_counter() - start})
+
+    try:
+        save_outputs(image, -1)
+
+        for idx, step in enumerate(steps):
+            start = time.perf_counter()
+            image = apply_operation(backend, image, step['operation'], step['transformation'])
+
+            timings.append({
+                'stage': 'step',
+                'operation': step['operation'],
+                'transformation': step['transformation'],
+                'seconds': time.perf_counter() - start
+            })
+
+            save_outputs(image, idx)
+    finally:
+        backend.close(image)
+
+    return timings
@@ -0,0 +1,161 @@
+"""
+    Benchmark for the imaging backends.
+
+    Runs every operation of every backend against a corpus of images, each pair in a fresh process
+    so the peak memory (RSS) we report belongs only to that backend and operation.
+
+    python -m services.imaging.benchmark --corpus test/unit/apiapp/testing_images --backends wand,pillow,vips
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from services.imaging import OPERATIONS, apply_operation, get_imaging_backend
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.tif', '.tiff']
+
+
+def get_corpus(path):
+    corpus = []
+    for entry in sorted(os.scandir(path), key=lambda e: e.name):
+        if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+            corpus.append(entry.path)
+
+    return corpus
+
+
+def get_peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # macOS reports bytes, linux kilobytes
+    if sys.platform == "darwin":
+        peak = peak // 1024
+
+    return peak
+
+
+def run_operation(backend_name, operation, transformation, corpus, repeat, queue):
+    """ Runs in its own process, the result is sent back through the queue """
+
+    try:
+        backend = get_imaging_backend(backend_name)
+    except ImportError as e:
+        queue.put({'error_msg': str(e)})
+        return
+
+    if backend.name != backend_name:
+        queue.put({'error_msg': backend_name + " is not installed"})
+        return
+
+    baseline_rss = get_peak_rss_kb()
+    target = tempfile.mktemp(suffix=".benchmark")
+    image_format = transformation if operation == "convert" else "PNG"
+
+    errors = 0
+    processed = 0
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for path in corpus:
+            try:
+                image = backend.open(filename=path)
+                image = apply_operation(backend, image, operation, transformation)
+                backend.save(image, target, image_format)
+                backend.close(image)
+                processed += 1
+            except Exception as e:
+                print(" BENCHMARK " + backend_name + " " + path + " FAILED " + str(e))
+                errors += 1
+
+    elapsed = time.perf_counter() - start
+
+    if os.path.exists(target):
+        os.remove(target)
+
+    queue.put({
+        'processed': processed,
+        'errors': errors,
+        'seconds': elapsed,
+        'ops_per_second': processed / elapsed if elapsed > 0 else 0,
+        'peak_rss_kb': get_peak_rss_kb(),
+        'baseline_rss_kb': baseline_rss,
+    })
+
+
+def run_benchmark(backends, corpus, repeat=3):
+    ctx = multiprocessing.get_context("spawn")
+
+    results = []
+    for backend_name in backends:
+        for operation, transformations in OPERATIONS.items():
+            for transformation in transformations:
+                queue = ctx.Queue()
+                process = ctx.Process(target=run_operation,
+                                      args=(backend_name, operation, transformation, corpus, repeat, queue))
+                process.start()
+
+                # The process might crash on a broken backend, don't wait for it forever
+                result = None
+                while result is None and process.is_alive():
+                    try:
+                        result = queue.get(timeout=1)
+                    except Exception:
+                        pass
+
+                if result is None and not queue.empty():
+                    result = queue.get()
+
+                process.join()
+
+                if result is None:
+                    result = {'error_msg': 'crashed with exit code ' + str(process.exitcode)}
+
+                result.update({'backend': backend_name, 'operation': operation, 'transformation': transformation})
+                results.append(result)
+
+                print_result(result)
+
+    return results
+
+
+def print_result(result):
+    name = result['backend'] + " " + result['operation'] + " " + result['transformation']
+    if 'error_msg' in result:
+        print("{:40} {}".format(name, result['error_msg']))
+        return
+
+    print("{:40} {:8.2f} ops/s {:10d} KB peak RSS {:4d} errors".format(name, result['ops_per_second'],
+                                                                       result['peak_rss_kb'], result['errors']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the imaging backends")
+    parser.add_argument("--corpus", default="test/unit/apiapp/testing_images", help="Folder with images")
+    parser.add_argument("--backends", default="wand,pillow,vips", help="Comma separated list of backends")
+    parser.add_argument("--repeat", default=3, type=int, help="Times to process the corpus per operation")
+    parser.add_argument("--output", default=None, help="Write the results as JSON into this file")
+    args = parser.parse_args()
+
+    corpus = get_corpus(args.corpus)
+    if not corpus:
+        print(" NO IMAGES FOUND IN " + args.corpus)
+        return 1
+
+    print(" BENCHMARK " + str(len(corpus)) + " images x " + str(args.repeat))
+    results = run_benchmark(args.backends.split(","), corpus, args.repeat)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({'corpus': corpus, 'repeat': args.repeat, 'results': results}, f, indent=4)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
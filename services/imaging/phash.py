@@ -0,0 +1,62 @@
+"""
+    Perceptual hashes, similar images get hashes with a small hamming distance.
+
+    We decode a tiny grayscale thumbnail with the backend and compute the hashes with NumPy:
+
+        ahash   8x8 average hash, every pixel brighter than the mean.
+        dhash   9x8 difference hash, every pixel brighter than its right neighbour.
+        phash   DCT of a 32x32 thumbnail, the 8x8 low frequencies over their median.
+
+    Hashes are 64 bits, stored as 16 hex characters.
+"""
+
+import numpy as np
+
+HASH_SIZE = 8
+PHASH_SIZE = 32
+
+
+def get_dct_matrix(size):
+    """ Orthonormal DCT-II matrix, dct(A) = D @ A @ D.T """
+    n = np.arange(size)
+    matrix = np.sqrt(2.0 / size) * np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2.0 * size))
+    matrix[0, :] = np.sqrt(1.0 / size)
+    return matrix
+
+
+DCT_MATRIX = get_dct_matrix(PHASH_SIZE)
+
+
+def bits_to_hex(bits):
+    return np.packbits(bits.flatten()).tobytes().hex()
+
+
+def get_hashes_from_pixels(pixels):
+    """ pixels are the 8 bit grayscale values of a PHASH_SIZE x PHASH_SIZE thumbnail """
+
+    matrix = np.frombuffer(pixels, dtype=np.uint8).reshape(PHASH_SIZE, PHASH_SIZE).astype(np.float64)
+
+    block = PHASH_SIZE // HASH_SIZE
+
+    # Average of every block, same as a 8x8 box resize
+    small = matrix.reshape(HASH_SIZE, block, HASH_SIZE, block).mean(axis=(1, 3))
+    ahash = small > small.mean()
+
+    # 9 columns interpolated from the rows averaged into 8
+    rows = matrix.reshape(HASH_SIZE, block, PHASH_SIZE).mean(axis=1)
+    xs = np.linspace(0, PHASH_SIZE - 1, HASH_SIZE + 1)
+    wide = np.array([np.interp(xs, np.arange(PHASH_SIZE), row) for row in rows])
+    dhash = wide[:, :-1] > wide[:, 1:]
+
+    dct = DCT_MATRIX @ matrix @ DCT_MATRIX.T
+    low = dct[:HASH_SIZE, :HASH_SIZE]
+
+    # The DC coefficient is the brightness, it would skew the median
+    phash = low > np.median(low.flatten()[1:])
+
+    return {'ahash': bits_to_hex(ahash), 'dhash': bits_to_hex(dhash), 'phash': bits_to_hex(phash)}
+
+
+def get_image_hashes(backend, image):
+    """ Returns the perceptual hashes of an image opened with any of our backends """
+    return get_hashes_from_pixels(backend.get_gray_pixels(image, PHASH_SIZE, PHASH_SIZE))
@@ -0,0 +1,109 @@
+import io
+
+from PIL import Image, ImageFilter, ImageOps
+
+# EXIF orientations in which the image is stored rotated 90 degrees
+EXIF_ORIENTATION_TAG = 274
+EXIF_ROTATED = [5, 6, 7, 8]
+
+PILLOW_FORMATS = {'JPG': 'JPEG', 'GIFV': 'GIF', 'TGA': 'TGA'}
+
+
+class PillowBackend():
+    """ Pillow, it will use the SIMD resize if pillow-simd is installed instead of Pillow """
+
+    name = "pillow"
+
+    def open(self, filename=None, file=None):
+        # Pillow only reads the header here, pixels get decoded on the first operation
+        return Image.open(file or filename)
+
+    def get_size(self, image):
+        return image.size
+
+    def get_display_size(self, image):
+        width, height = image.size
+        try:
+            if image.getexif().get(EXIF_ORIENTATION_TAG) in EXIF_ROTATED:
+                return height, width
+        except Exception:
+            pass
+
+        return width, height
+
+    def first_frame(self, image):
+        image.seek(0)
+        return image
+
+    def get_gray_pixels(self, image, width, height):
+        """ 8 bit grayscale pixels of the first frame resized to width x height """
+        if image.format == "JPEG":
+            # Decode directly at a reduced scale, only works if the image was not loaded yet
+            image.draft("L", (width, height))
+
+        image.seek(0)
+        return image.convert("L").resize((width, height), Image.BILINEAR).tobytes()
+
+    def convert(self, image, image_format):
+        # The format is applied when we save
+        return image
+
+    def resize(self, image, width, height):
+        if image.format == "JPEG":
+            # Let the JPEG decoder skip the DCT scales we don't need
+            image.draft("RGB", (width, height))
+
+        return image.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+
+    def rotate(self, image, degrees):
+        # Pillow rotates counter clockwise
+        return image.rotate(-degrees, expand=True)
+
+    def flop(self, image):
+        return ImageOps.mirror(image)
+
+    def blur(self, image, sigma):
+        return image.filter(ImageFilter.GaussianBlur(radius=sigma))
+
+    def median(self, image, width, height):
+        """ Original and median side by side, Pillow only has square odd windows """
+        size = max(3, min(width, height) | 1)
+        right = image.filter(ImageFilter.MedianFilter(size=size))
+
+        output = Image.new(image.mode, (image.width * 2, image.height))
+        output.paste(image, (0, 0))
+        output.paste(right, (image.width, 0))
+        return output
+
+    def get_pillow_format(self, image_format):
+        image_format = image_format.upper()
+        return PILLOW_FORMATS.get(image_format, image_format)
+
+    def prepare(self, image, image_format):
+        if image_format == "JPEG" and image.mode not in ["RGB", "L"]:
+            return image.convert("RGB")
+
+        if image.mode == "P" and image_format not in ["GIF", "PNG"]:
+            return image.convert("RGBA")
+
+        return image
+
+    def save(self, image, filename, image_format=None):
+        image_format = image_format or image.format
+        if not image_format:
+            # Pillow finds the format from the extension
+            image.save(filename)
+            return
+
+        image_format = self.get_pillow_format(image_format)
+        self.prepare(image, image_format).save(filename, format=image_format)
+
+    def to_bytes(self, image, image_format):
+        image_format = self.get_pillow_format(image_format)
+
+        output = io.BytesIO()
+        self.prepare(image, image_format).save(output, format=image_format)
+        return output.getvalue()
+
+    def close(self, image):
+        image.close()
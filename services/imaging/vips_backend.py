@@ -0,0 +1,90 @@
+import pyvips
+
+VIPS_SUFFIX = {'JPG': '.jpg', 'JPEG': '.jpg', 'GIFV': '.gif'}
+
+
+class VipsBackend():
+    """ libvips through pyvips, the operations are evaluated lazily when we save the image.
+        We open with the default random access, rotate and median read the pixels out of order
+        and fail on a sequential image.
+    """
+
+    name = "vips"
+
+    def open(self, filename=None, file=None):
+        if file:
+            return pyvips.Image.new_from_buffer(file.read(), "")
+
+        return pyvips.Image.new_from_file(filename)
+
+    def get_size(self, image):
+        return image.width, image.height
+
+    def get_display_size(self, image):
+        orientation = 1
+        if image.get_typeof("orientation") != 0:
+            orientation = image.get("orientation")
+
+        if orientation in [5, 6, 7, 8]:
+            return image.height, image.width
+
+        return image.width, image.height
+
+    def first_frame(self, image):
+        # vips only loads the first page unless n is specified
+        return image
+
+    def get_gray_pixels(self, image, width, height):
+        """ 8 bit grayscale pixels of the first frame resized to width x height """
+        small = image.thumbnail_image(width, height=height, size="force").colourspace("b-w")
+
+        # Drop the alpha
+        if small.bands > 1:
+            small = small[0]
+
+        return small.cast("uchar").write_to_memory()
+
+    def convert(self, image, image_format):
+        return image
+
+    def resize(self, image, width, height):
+        return image.resize(width / image.width, vscale=height / image.height)
+
+    def rotate(self, image, degrees):
+        if degrees == 90:
+            return image.rot90()
+
+        if degrees == -90:
+            return image.rot270()
+
+        return image.rotate(degrees)
+
+    def flop(self, image):
+        return image.fliphor()
+
+    def blur(self, image, sigma):
+        return image.gaussblur(sigma)
+
+    def median(self, image, width, height):
+        """ Original and median side by side """
+        right = image.median(max(width, height))
+        return image.join(right, "horizontal")
+
+    def get_suffix(self, image_format):
+        image_format = image_format.upper()
+        return VIPS_SUFFIX.get(image_format, "." + image_format.lower())
+
+    def save(self, image, filename, image_format=None):
+        if not image_format:
+            image.write_to_file(filename)
+            return
+
+        # Our renditions don't always finish with the format extension
+        with open(filename, 'wb') as f:
+            f.write(self.to_bytes(image, image_format))
+
+    def to_bytes(self, image, image_format):
+        return image.write_to_buffer(self.get_suffix(image_format))
+
+    def close(self, image):
+        pass
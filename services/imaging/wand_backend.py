@@ -0,0 +1,84 @@
+from wand.image import Image
+
+
+class WandBackend():
+    """ ImageMagick through Wand """
+
+    name = "wand"
+
+    def open(self, filename=None, file=None):
+        if file:
+            return Image(file=file)
+
+        return Image(filename=filename)
+
+    def get_size(self, image):
+        return image.width, image.height
+
+    def get_display_size(self, image):
+        """ Image is rotated internally, we have to invert our dimensions """
+        if image.orientation in ['right_top', 'top_right', 'right_bottom', 'bottom_right']:
+            return image.height, image.width
+
+        return image.width, image.height
+
+    def first_frame(self, image):
+        if len(image.sequence) > 1:
+            frame = Image(image=image.sequence[0])
+
+            # The caller only keeps the frame, release the rest of the animation
+            image.close()
+            return frame
+
+        return image
+
+    def get_gray_pixels(self, image, width, height):
+        """ 8 bit grayscale pixels of the first frame resized to width x height """
+        with Image(image=image.sequence[0] if len(image.sequence) > 1 else image) as small:
+            small.resize(width, height)
+            return bytes(small.export_pixels(channel_map='I', storage='char'))
+
+    def convert(self, image, image_format):
+        converted = image.convert(image_format)
+
+        # convert() returns a new image, the caller only keeps that one
+        image.close()
+        return converted
+
+    def resize(self, image, width, height):
+        image.resize(width, height)
+        return image
+
+    def rotate(self, image, degrees):
+        image.rotate(degrees)
+        return image
+
+    def flop(self, image):
+        image.flop()
+        return image
+
+    def blur(self, image, sigma):
+        image.blur(sigma=sigma)
+        return image
+
+    def median(self, image, width, height):
+        """ Original and median side by side """
+        with image.clone() as right:
+            right.statistic("median", width=width, height=height)
+            image.extent(width=image.width * 2)
+            image.composite(right, top=0, left=right.width)
+
+        return image
+
+    def save(self, image, filename, image_format=None):
+        if image_format:
+            image.format = image_format
+
+        image.save(filename=filename)
+
+    def to_bytes(self, image, image_format):
+        image.format = image_format
+        return image.make_blob()
+
+    def close(self, image):
+        image.close()
@@ -0,0 +1,38 @@
+"""
+    Job transitions that the worker publishes on redis.
+
+    The worker stores the final state of a job on a key and then publishes it on the job channel,
+    so the API subscribes first and reads the keys after, and it can never miss a job that ended.
+"""
+
+import json
+
+JOB_CHANNEL_PREFIX = "imgapi:jobs:channel:"
+JOB_STATE_PREFIX = "imgapi:jobs:state:"
+
+# Same as the result_ttl of our jobs
+JOB_STATE_TTL = 5000
+
+
+def get_job_channel(job_id):
+    return JOB_CHANNEL_PREFIX + job_id
+
+
+def get_job_state_key(job_id):
+    return JOB_STATE_PREFIX + job_id
+
+
+def publish_job_state(conn, job_id, job_status, result=None):
+    state = {'job_id': job_id, 'job_status': job_status}
+    if result is not None:
+        state['result'] = result
+
+    message = json.dumps(state, default=str)
+
+    if job_status in ['finished', 'failed']:
+        conn.set(get_job_state_key(job_id), message, ex=JOB_STATE_TTL)
+    elif job_status == 'started':
+        # A job id can run again, clear the end of the last run
+        conn.delete(get_job_state_key(job_id))
+
+    conn.publish(get_job_channel(job_id), message)
@@ -0,0 +1,389 @@
+"""
+    Metrics registry with the Prometheus text exposition format.
+
+    Counters and histograms live in memory on every process, /api/admin/metrics renders them.
+    The API loads this module as services.metrics and the worker as metrics, like job_events.
+
+    Multiprocess mode: set IMGAPI_METRICS_DIR (the same folder for the API and the workers).
+    Every process writes a snapshot <role>_<pid>.json there every METRICS_WRITE_SECONDS and when it exits,
+    the endpoint adds up the snapshots of every process. Snapshots of dead processes are kept,
+    counters never go backwards, delete the folder on deploy to start again.
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_WRITE_SECONDS = 10
+
+# Seconds, from a cached response to a slow external API
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Pipelines take minutes
+PIPELINE_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 21600, 86400)
+
+
+def format_value(value):
+    if value == int(value):
+        return str(int(value))
+
+    return repr(float(value))
+
+
+def format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+
+    if not pairs:
+        return ""
+
+    text = ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for name, value in pairs)
+    return "{" + text + "}"
+
+
+class Metric():
+    """ label values => value, every metric has its own lock """
+
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def get_key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+    def snapshot(self):
+        with self.lock:
+            values = [[list(key), self.copy_value(value)] for key, value in self.values.items()]
+
+        return {'type': self.metric_type, 'help': self.documentation, 'labels': list(self.label_names), 'values': values}
+
+    def copy_value(self, value):
+        return value
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """ A value we read when we render the metrics, collect() returns {label values: value} """
+
+    metric_type = "gauge"
+
+    def __init__(self, name, documentation, label_names=(), collect=None):
+        super().__init__(name, documentation, label_names)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def snapshot(self):
+        if self.collect:
+            try:
+                with self.lock:
+                    self.values = {tuple(key): value for key, value in self.collect().items()}
+            except Exception as e:
+                # The metrics should render even if redis is down
+                print(" METRICS FAILED COLLECTING " + self.name + " " + str(e))
+
+        return super().snapshot()
+
+
+class Histogram(Metric):
+    """ label values => [count per bucket..., sum, count] """
+
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+
+        index = len(self.buckets)
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = position
+                break
+
+        with self.lock:
+            entry = self.values.get(key)
+            if not entry:
+                entry = self.values[key] = [0] * (len(self.buckets) + 3)
+
+            entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def copy_value(self, value):
+        return list(value)
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot['buckets'] = list(self.buckets)
+        return snapshot
+
+
+class MetricsRegistry():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+        self.role = None
+        self.folder = None
+        self.path = None
+        self.accumulate = False
+        self.writer = None
+
+    def register(self, metric):
+        """ Modules can be loaded twice (api and services), the first definition wins """
+
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, label_names=()):
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=(), collect=None):
+        return self.register(Gauge(name, documentation, label_names, collect))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def snapshot(self, include_gauges=True):
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        return {
+            metric.name: metric.snapshot()
+            for metric in metrics
+            if include_gauges or metric.metric_type != "gauge"
+        }
+
+    def reset(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        for metric in metrics:
+            metric.reset()
+
+    # Multiprocess
+
+    def get_snapshot_path(self):
+        return os.path.join(self.folder, "%s_%d.json" % (self.role, os.getpid()))
+
+    def enable_multiprocess(self, role, folder=None, accumulate=False):
+        """ Writes the snapshots of this process so other processes can render them.
+            accumulate is for the RQ worker, every job runs on a forked process that dies after the job,
+            so the job adds its metrics to the file of the worker with flush() instead.
+        """
+
+        folder = folder or os.environ.get("IMGAPI_METRICS_DIR")
+        if not folder or self.folder:
+            return False
+
+        os.makedirs(folder, exist_ok=True)
+
+        self.role = role
+        self.folder = folder
+        self.path = self.get_snapshot_path()
+        self.accumulate = accumulate
+
+        if accumulate:
+            return True
+
+        self.start_writer()
+        atexit.register(self.write_snapshot)
+
+        # Gunicorn forks after loading the app, every worker starts from zero with its own file
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.after_fork)
+
+        return True
+
+    def after_fork(self):
+        self.reset()
+        self.path = self.get_snapshot_path()
+        self.start_writer()
+
+    def start_writer(self):
+        self.writer = threading.Thread(target=self.run_writer, name="metrics_writer", daemon=True)
+        self.writer.start()
+
+    def run_writer(self):
+        while True:
+            time.sleep(METRICS_WRITE_SECONDS)
+
+            try:
+                self.write_snapshot()
+            except Exception as e:
+                print(" METRICS FAILED WRITING " + str(e))
+
+    def write_file(self, snapshot):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(snapshot, f)
+
+        os.replace(self.path + ".tmp", self.path)
+
+    def write_snapshot(self):
+        if not self.folder:
+            return
+
+        # Gauges are read by the process that renders the metrics
+        self.write_file(self.snapshot(include_gauges=False))
+
+    def flush(self):
+        """ Adds our values to the snapshot file and starts again from zero """
+
+        if not self.folder:
+            return
+
+        snapshots = [self.snapshot(include_gauges=False)]
+        self.reset()
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                snapshots.append(json.load(f))
+
+        self.write_file(merge_snapshots(snapshots))
+
+    def read_snapshots(self):
+        snapshots = []
+        for file_name in os.listdir(self.folder):
+            if not file_name.endswith(".json"):
+                continue
+
+            try:
+                with open(os.path.join(self.folder, file_name)) as f:
+                    snapshots.append(json.load(f))
+            except Exception as e:
+                print(" METRICS FAILED READING " + file_name + " " + str(e))
+
+        return snapshots
+
+    def collect(self):
+        """ The metrics of this process, or of every process in multiprocess mode """
+
+        if not self.folder:
+            return self.snapshot()
+
+        # Ours are always up to date
+        if self.accumulate:
+            self.flush()
+        else:
+            self.write_snapshot()
+
+        merged = merge_snapshots(self.read_snapshots())
+        merged.update({name: metric for name, metric in self.snapshot().items() if metric['type'] == "gauge"})
+        return merged
+
+    def render(self):
+        return render_snapshot(self.collect())
+
+
+def merge_snapshots(snapshots):
+    """ Adds up the values of the same metric and labels """
+
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.get(name)
+            if not target:
+                target = merged[name] = dict(metric)
+                target['values'] = {}
+
+            for key, value in metric['values']:
+                key = tuple(key)
+                current = target['values'].get(key)
+
+                if current is None:
+                    target['values'][key] = value
+                elif isinstance(value, list):
+                    target['values'][key] = [a + b for a, b in zip(current, value)]
+                else:
+                    target['values'][key] = current + value
+
+    for metric in merged.values():
+        metric['values'] = [[list(key), value] for key, value in metric['values'].items()]
+
+    return merged
+
+
+def render_snapshot(snapshot):
+    lines = []
+    for name in sorted(snapshot):
+        metric = snapshot[name]
+        label_names = metric['labels']
+
+        lines.append("# HELP %s %s" % (name, metric['help']))
+        lines.append("# TYPE %s %s" % (name, metric['type']))
+
+        for key, value in sorted(metric['values']):
+            if metric['type'] != "histogram":
+                lines.append(name + format_labels(label_names, key) + " " + format_value(value))
+                continue
+
+            # Prometheus buckets are cumulative
+            cumulative = 0
+            for bound, count in zip(metric['buckets'] + ["+Inf"], value[:-2]):
+                cumulative += count
+                le = bound if bound == "+Inf" else format_value(bound)
+                lines.append(name + "_bucket" + format_labels(label_names, key, ("le", le)) + " " + str(cumulative))
+
+            lines.append(name + "_sum" + format_labels(label_names, key) + " " + format_value(value[-2]))
+            lines.append(name + "_count" + format_labels(label_names, key) + " " + format_value(value[-1]))
+
+    return "\n".join(lines) + "\n"
+
+
+metrics_registry = MetricsRegistry()
+
+# Shared by the API and the worker
+
+EXTERNAL_REQUEST_SECONDS = metrics_registry.histogram("imgapi_external_request_seconds",
+                                                      "Latency of the calls to external services",
+                                                      ["service", "status"])
+
+WORKER_JOB_SECONDS = metrics_registry.histogram("imgapi_worker_job_seconds", "Duration of the jobs of the worker",
+                                                ["job", "result"])
+
+
+def get_external_hooks(service):
+    """ requests hooks that record the latency of the call, requests.get(url, hooks=get_external_hooks("ai")) """
+
+    def on_response(response, *args, **kwargs):
+        status = "cache" if getattr(response, 'from_cache', False) else str(response.status_code)
+        EXTERNAL_REQUEST_SECONDS.observe(response.elapsed.total_seconds(), service=service, status=status)
+
+    return {'response': [on_response]}
@@ -1,9 +1,14 @@
+import functools
 import os
+import time
 
 import ffmpeg
 import redis
 import requests
-from rq import Connection, Queue, Worker
+from imaging import apply_operation, get_imaging_backend, run_pipeline
+from job_events import publish_job_state
+from metrics import WORKER_JOB_SECONDS, metrics_registry
+from rq import Connection, Queue, Worker, get_current_job
 from wand.image import Image
 
 # https://www.pythonpool.com/imagemagick-python/
@@ -16,11 +21,48 @@ redis_url = os.getenv('REDISTOGO_URL', 'redis://localhost:6379')
 conn = redis.from_url(redis_url)
 
 
+def publish_job(func):
+    """ Publishes when the job starts and ends, so the API can push it to the clients instead of polling """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        job = get_current_job()
+        if not job:
+            return func(*args, **kwargs)
+
+        publish_job_state(conn, job.id, 'started')
+
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            observe_job(func.__name__, 'failed', start)
+            publish_job_state(conn, job.id, 'failed', {'error_msg': str(e)})
+            raise e
+
+        observe_job(func.__name__, 'finished', start)
+        publish_job_state(conn, job.id, 'finished', result)
+        return result
+
+    return wrapper
+
+
+def observe_job(job_name, result, start):
+    WORKER_JOB_SECONDS.observe(time.time() - start, job=job_name, result=result)
+
+    # The job runs on a forked process, the metrics would die with it
+    try:
+        metrics_registry.flush()
+    except Exception as e:
+        print(" METRICS FAILED FLUSHING " + str(e))
+
+
 def is_worker_alive(msg):
     print("I AM ALIVE " + msg)
     return msg
 
 
+@publish_job
 def convert_video(json):
     """
         Ground work for video https://github.com/kkroening/ffmpeg-python/blob/master/examples/README.md#generate-thumbnail-for-video
@@ -60,9 +102,78 @@ def convert_video(json):
     return {'state': 'success', 'width': width, 'height': height, 'media_id': media_id}
 
 
+@publish_job
+def process_video(json):
+    """ Probes an uploaded video and generates its preview frame and sprite sheet.
+        The upload request doesn't wait for this, the API applies the result on File_Tracking
+        when the client checks /api/media/ready/<media_id>
+    """
+
+    media_id = json['media_id']
+    video_path = json['media_path']
+
+    preview_path = video_path + ".PREVIEW.PNG"
+    sprite_path = video_path + ".SPRITE.JPG"
+
+    sprite_columns = json.get('sprite_columns', 5)
+    sprite_rows = json.get('sprite_rows', 5)
+    sprite_width = json.get('sprite_width', 160)
+
+    info = {}
+    try:
+        probe = ffmpeg.probe(video_path)
+
+        video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
+        width = info['width'] = int(video_stream['width'])
+        height = info['height'] = int(video_stream['height'])
+
+        # Some containers only report the duration on the format
+        duration = video_stream.get('duration', probe['format'].get('duration', 0))
+        duration = info['duration'] = float(duration)
+
+        if os.path.exists(preview_path):
+            os.remove(preview_path)
+
+        ffmpeg.input(video_path, ss=duration / 3).filter('scale', width, -1).output(preview_path,
+                                                                                     vframes=1).run(quiet=True)
+
+    except Exception as e:
+        print(str(e))
+        print(" PROCESS VIDEO " + video_path + " CRASHED ")
+        return {'state': 'error', 'error_msg': 'failed processing', 'media_id': media_id}
+
+    if not os.path.exists(preview_path):
+        return {'state': 'error', 'error_msg': 'failed generating preview', 'media_id': media_id, 'info': info}
+
+    try:
+        # One frame per tile spread along the video, the frontend uses it to scrub
+        frames = sprite_columns * sprite_rows
+        fps = frames / duration if duration > 0 else 1
+
+        ffmpeg.input(video_path).filter('fps', fps=fps).filter('scale', sprite_width, -1).filter(
+            'tile', str(sprite_columns) + "x" + str(sprite_rows)).output(sprite_path, vframes=1).run(quiet=True,
+                                                                                                   overwrite_output=True)
+
+        if os.path.exists(sprite_path):
+            info['sprite'] = {
+                'columns': sprite_columns,
+                'rows': sprite_rows,
+                'width': sprite_width,
+                'interval': duration / frames
+            }
+
+    except Exception as e:
+        # The preview is enough for the media to be ready
+        print(" SPRITE FAILED " + str(e))
+
+    print(" PROCESS VIDEO " + video_path + " WAS SUCCESSFUL ")
+    return {'state': 'success', 'media_id': media_id, 'info': info, 'has_preview': True}
+
+
+@publish_job
 def convert_image(json):
     """ Converts into a different format and returns the file path to retrieve the image
-        More transformations here: https://docs.wand-py.org/en/0.5.9/guide/transform.html
+        The operations are implemented by each imaging backend, check services/imaging
     """
 
     trf = json['transformation']
@@ -71,59 +182,90 @@ def convert_image(json):
     image_path = json['media_path']
     target_path = json['target_path']
 
+    backend = get_imaging_backend()
+
+    # Write next to the target and rename, the API serves the file as soon as it exists
+    tmp_path = target_path + ".TMP" + os.path.splitext(target_path)[1]
+
     try:
-        image = Image(filename=image_path)
+        image = backend.open(filename=image_path)
         if operation == "convert":
             print(" CONVERT " + image_path + " INTO " + trf)
-            image = image.convert(trf)
-
-        elif operation == "transform":
-            if trf == "rotate_right":
-                image.rotate(90)
-            elif trf == "rotate_left":
-                image.rotate(-90)
-            elif trf == "flop":
-                image.flop()
-
-        elif operation == "filter":
-            if trf == "blur":
-                image.blur(sigma=4)
-            elif trf == "median":
-                with image.clone() as right:
-                    right.statistic("median", width=8, height=5)
-                    image.extent(width=image.width * 2)
-                    image.composite(right, top=0, left=right.width)
-
-        elif operation == "generate":
-            aspect_ratio = image.height / image.width
-            if trf == "thumbnail_256":
-                image.resize(256, int(256 * aspect_ratio))
-
-            if trf == "thumbnail_128":
-                image.resize(128, int(128 * aspect_ratio))
-
-            elif trf == "thumbnail_64":
-                image.resize(64, int(64 * aspect_ratio))
-
-            elif trf == "thumbnail_32":
-                image.resize(32, int(32 * aspect_ratio))
-
-            else:
-                image.resize(16, int(16 * aspect_ratio))
-
-        image.save(filename=target_path)
+
+        image = apply_operation(backend, image, operation, trf)
+
+        backend.save(image, tmp_path, trf if operation == "convert" else None)
+        backend.close(image)
+
+        os.replace(tmp_path, target_path)
+
         if os.path.exists(target_path):
             print(operation + " => " + trf + " WAS SUCCESSFUL ")
-            return {'state': 'success', 'operation': operation, 'transformation': trf, 'media_id': media_id}
+            return {
+                'state': 'success',
+                'operation': operation,
+                'transformation': trf,
+                'media_id': media_id,
+                'checksum_md5': json.get('checksum_md5')
+            }
 
     except Exception as e:
         print(str(e))
         print(operation + " => " + trf + " CRASHED ")
 
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
     print(operation + " => " + trf + " FAILED ")
     return {'state': 'error', 'operation': operation, 'transformation': trf, 'media_id': media_id}
 
 
+@publish_job
+def process_pipeline(json):
+    """ Applies a chain of operations to an image with a single decode, and encodes several outputs.
+        The timings of every stage are stored on the job meta and returned with the result.
+    """
+
+    media_id = json['media_id']
+    image_path = json['media_path']
+    steps = json['steps']
+    outputs = json['outputs']
+
+    backend = get_imaging_backend()
+
+    # The result goes back to the clients, they don't need to know our paths
+    public_outputs = [{key: value for key, value in output.items() if key != 'target_path'} for output in outputs]
+
+    ret = {'media_id': media_id, 'checksum_md5': json.get('checksum_md5'), 'steps': steps, 'outputs': public_outputs}
+
+    try:
+        timings = run_pipeline(backend, image_path, steps, outputs)
+    except Exception as e:
+        print(str(e))
+        print(" PIPELINE " + image_path + " CRASHED ")
+
+        ret['state'] = 'error'
+        return ret
+
+    job = get_current_job()
+    if job:
+        job.meta['timings'] = timings
+        job.save_meta()
+
+    for output in outputs:
+        if not os.path.exists(output['target_path']):
+            print(" PIPELINE " + output['target_path'] + " WAS NOT GENERATED ")
+            ret['state'] = 'error'
+            return ret
+
+    print(" PIPELINE " + image_path + " WAS SUCCESSFUL ")
+
+    ret['state'] = 'success'
+    ret['timings'] = timings
+    return ret
+
+
+@publish_job
 def fetch_url_image(json):
     """ Fetches the URL, checks if it is an image and uploads it back to the service using the user token """
 
@@ -164,6 +306,8 @@ def fetch_url_image(json):
 
 
 if __name__ == '__main__':
+    metrics_registry.enable_multiprocess("worker", accumulate=True)
+
     with Connection(conn):
         worker = Worker(list(map(Queue, listen)))
         worker.work()
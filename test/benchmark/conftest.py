@@ -0,0 +1,176 @@
+"""
+    Fixtures of the benchmark suite.
+
+    Everything is local: mongomock (or the mongod of BENCHMARK_MONGODB_HOST), the images of
+    test/unit/apiapp/testing_images and documents generated from a fixed seed, so two runs measure the same work.
+
+    The benchmarks only run with ./run_benchmarks.sh (IMGAPI_BENCHMARK=1), they are too slow for every test run.
+"""
+
+import os
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+if not os.environ.get("IMGAPI_BENCHMARK"):
+    collect_ignore_glob = ["test_*.py"]
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+
+IMAGE_CORPUS_PATH = os.path.join(BENCHMARK_PATH, "..", "unit", "apiapp", "testing_images")
+
+SEED = 1234
+
+EXCHANGE_TICKERS = ['NASDAQ:NVDA', 'NASDAQ:AAPL', 'NYSE:KO', 'NYSE:IBM', 'LSE:BARC', 'XETRA:SAP', 'TSX:SHOP']
+
+WORDS = ("market shares quarter revenue growth guidance analysts earnings forecast dividend "
+         "investors outlook demand supply margin inflation rates chips energy retail").split()
+
+
+def get_text(rnd, words):
+    return " ".join(rnd.choice(WORDS) for _ in range(words))
+
+
+@pytest.fixture(scope="session")
+def app():
+    # The app reads its settings when it is imported, run the benchmarks on their own
+    os.environ["IMGAPI_SETTINGS"] = os.path.join(BENCHMARK_PATH, "benchmark_settings.cfg")
+
+    from imgapi_launcher import app
+
+    # The benchmarks delete and write documents, never on a real database by accident
+    host = app.config['MONGODB_SETTINGS']['host']
+    expected = os.environ.get("BENCHMARK_MONGODB_HOST", "mongomock://")
+    assert host.startswith(expected), "The benchmarks would run on " + host + ", check ~/.imgapi.json"
+
+    return app
+
+
+@pytest.fixture
+def request_context(app):
+    """ Anonymous request, the helpers read the arguments and the current user """
+
+    with app.test_request_context("/api/news/query?no_redirect=1"):
+        yield
+
+
+@pytest.fixture(scope="session")
+def news_documents(app):
+    """ 100 articles as the yfinance pipeline stores them, not saved """
+
+    from api.news.models import DB_News
+
+    rnd = random.Random(SEED)
+    now = datetime(2024, 6, 1)
+
+    documents = []
+    for i in range(100):
+        documents.append(
+            DB_News(
+                status=rnd.choice(['WAITING_INDEX', 'INDEXED', 'WAITING_FOR_AI', 'PROCESSED']),
+                title=get_text(rnd, 12),
+                source_title="Yahoo Finance",
+                creation_date=now - timedelta(hours=i),
+                last_visited_date=now - timedelta(minutes=i),
+                link="https://finance.yahoo.com/news/article-" + str(i) + ".html",
+                thumbnail_url="https://s.yimg.com/thumbnail-" + str(i) + ".jpg",
+                news_type="STORY",
+                publisher="Reuters",
+                articles=[get_text(rnd, 120) for _ in range(3)],
+                interest_score=rnd.randint(0, 10),
+                sentiment_score=rnd.randint(-10, 10),
+                stock_price=rnd.uniform(10, 900),
+                ai_summary=get_text(rnd, 80),
+                external_uuid="%032x" % rnd.getrandbits(128),
+                related_exchange_tickers=rnd.sample(EXCHANGE_TICKERS, 3),
+                source="YFINANCE",
+                languages=['EN'],
+            ))
+
+    return documents
+
+
+@pytest.fixture(scope="session")
+def company_documents(app):
+    """ 100 companies with the fields we fill from yfinance and wikipedia """
+
+    from api.company.models import DB_Company
+
+    rnd = random.Random(SEED)
+    now = datetime(2024, 6, 1)
+
+    documents = []
+    for i in range(100):
+        name = "Company " + str(i)
+        documents.append(
+            DB_Company(
+                safe_name="company_" + str(i),
+                company_name=name,
+                headquarters="Cambridge, United Kingdom",
+                country="United Kingdom",
+                gics_sector="Information Technology",
+                gics_sub_industry="Semiconductors",
+                creation_date=now - timedelta(days=i),
+                last_update_date=now,
+                founded="19" + str(50 + i % 50),
+                wikipedia="https://en.wikipedia.org/wiki/Company_" + str(i),
+                name=name,
+                long_name=name + " Holdings plc",
+                long_business_summary=get_text(rnd, 150),
+                city="Cambridge",
+                phone_number="+44 1223 000" + str(i).zfill(3),
+                zip_code="CB1 " + str(i % 9) + "AA",
+                CIK=rnd.randint(100000, 999999),
+                source="WIKIPEDIA",
+                exchanges=['NASDAQ', 'LSE'],
+                exchange_tickers=rnd.sample(EXCHANGE_TICKERS, 2),
+            ))
+
+    return documents
+
+
+@pytest.fixture(scope="session")
+def image_corpus():
+    corpus = sorted(
+        os.path.join(IMAGE_CORPUS_PATH, file_name) for file_name in os.listdir(IMAGE_CORPUS_PATH)
+        if os.path.splitext(file_name)[1].lower() in ['.jpg', '.jpeg', '.png', '.gif'])
+
+    assert corpus, "No images on " + IMAGE_CORPUS_PATH
+    return corpus
+
+
+class CannedTicker():
+    """ Returns the same price history than yf.Ticker would, without the network """
+
+    def __init__(self, history):
+        self.canned_history = history
+
+    def history(self, start=None, end=None, interval=None):
+        return self.canned_history
+
+
+@pytest.fixture(scope="session")
+def canned_ticker():
+    """ 10 years of weekly prices, up to a fixed date so every run processes the same rows """
+
+    import pandas as pd
+
+    rnd = random.Random(SEED)
+
+    index = pd.date_range(end=datetime(2024, 6, 1), periods=520, freq="W")
+    close = [100 + rnd.uniform(-5, 5) for _ in range(len(index))]
+
+    history = pd.DataFrame(
+        {
+            'Open': [value * 0.99 for value in close],
+            'High': [value * 1.02 for value in close],
+            'Low': [value * 0.98 for value in close],
+            'Close': close,
+            'Volume': [rnd.randint(100000, 5000000) for _ in range(len(index))],
+            'Dividends': [0.0] * len(index),
+            'Stock Splits': [0.0] * len(index),
+        },
+        index=index)
+
+    return CannedTicker(history)
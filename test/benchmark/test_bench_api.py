@@ -0,0 +1,64 @@
+from werkzeug.datastructures import MultiDict
+
+NEWS_QUERY = MultiDict([
+    ('status', 'INDEXED'),
+    ('related_exchange_tickers__in', 'NASDAQ:NVDA,NASDAQ:AAPL,NYSE:KO'),
+    ('creation_date__gte', '7 days'),
+    ('ai_summary__ne', 'NULL'),
+    ('interest_score__gte', '5'),
+    ('is_blocked', 'false'),
+    ('order_by', '-creation_date'),
+    ('limit', '25'),
+])
+
+
+def test_api_clean_news(benchmark, request_context, news_documents):
+    from api import api_clean
+
+    output = benchmark(api_clean, {'news': news_documents})
+    assert len(output['news']) == len(news_documents)
+
+
+def test_get_response_formatted_companies(benchmark, request_context, company_documents):
+    from api import get_response_formatted
+
+    response = benchmark(get_response_formatted, {'companies': company_documents})
+    assert response.status_code == 200
+
+
+def test_mongo_to_dict_news(benchmark, news_documents):
+    from api.query_helper import mongo_to_dict_helper
+
+    def run():
+        return [mongo_to_dict_helper(news) for news in news_documents]
+
+    output = benchmark(run)
+    assert output[0]['title'] == news_documents[0].title
+
+
+def test_mongo_to_dict_companies(benchmark, company_documents):
+    from api.query_helper import mongo_to_dict_helper
+
+    def run():
+        return [mongo_to_dict_helper(company) for company in company_documents]
+
+    output = benchmark(run)
+    assert output[0]['company_name'] == company_documents[0].company_name
+
+
+def test_build_query_from_url(benchmark, request_context):
+    from api.news.models import DB_News
+    from api.query_helper import build_query_from_url
+
+    arguments = NEWS_QUERY.to_dict(flat=False)
+
+    def run():
+        # The reserved arguments are removed from the dictionary we pass
+        return build_query_from_url(NEWS_QUERY.to_dict(), DB_News, arguments)
+
+    query = benchmark(run)
+
+    # Every parameter is a term of the $and
+    fields = [field for term in query['$and'] for field in term]
+    assert {'status', 'related_exchange_tickers', 'creation_date', 'ai_summary'} <= set(fields)
+    assert {'status': 'INDEXED'} in query['$and']
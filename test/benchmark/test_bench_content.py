@@ -0,0 +1,34 @@
+import os
+
+ARTICLE = """
+<html><body>
+<h1>Chip makers lead the market</h1>
+<p>Shares of <b>NVIDIA</b> rose after the company beat the <a href="https://example.com/guidance">guidance</a>
+of the analysts for the <em>third</em> quarter in a row.</p>
+<ul><li>Revenue grew 94%</li><li>Data center sales doubled</li><li>Gross margin of 75%</li></ul>
+<table><tr><th>Quarter</th><th>Revenue</th></tr><tr><td>Q1</td><td>26.0B</td></tr><tr><td>Q2</td><td>30.0B</td></tr></table>
+<blockquote>We are at the beginning of a new industrial revolution.</blockquote>
+</body></html>
+"""
+
+
+def test_markdownify(benchmark):
+    from api.tools.markdownify import markdownify
+
+    html = ARTICLE * 20
+
+    output = benchmark(markdownify, html)
+    assert "**NVIDIA**" in output
+
+
+def test_api_dynamic_conversion(benchmark, request_context, image_corpus):
+    """ Thumbnails of the corpus converted in memory, the rendition is not cached on disk """
+    from api.media.routes import api_dynamic_conversion
+
+    def run():
+        for path in image_corpus:
+            file_name = os.path.basename(path)
+            response = api_dynamic_conversion(None, path, file_name, "PNG", "256", file_name, cache_file=False)
+            assert response.status_code == 200
+
+    benchmark(run)
@@ -0,0 +1,25 @@
+TICKERS = ['NYSE:KREF^A', 'PBR-A', 'NVDA', 'BARC.L', 'SAP.DE', 'XNAS:AAPL', 'TSX:SHOP', 'KO', '7203.T', 'LON:VOD']
+
+
+def test_standardize_ticker_format(benchmark, app):
+    from api.ticker.tickers_helpers import standardize_ticker_format
+
+    def run():
+        return [standardize_ticker_format(ticker) for ticker in TICKERS * 100]
+
+    output = benchmark(run)
+    assert output[2] == "NASDAQ:NVDA"
+
+
+def test_ticker_save_history(benchmark, app, canned_ticker):
+    from api.ticker.batch.yfinance.ytickers_pipeline import ticker_save_history
+    from api.ticker.models import DB_TickerHistoryTS
+
+    full_symbol = "NASDAQ:BENCH"
+
+    def setup():
+        # It doesn't save again the data of the last month
+        DB_TickerHistoryTS.objects(exchange_ticker=full_symbol).delete()
+
+    benchmark.pedantic(ticker_save_history, args=(full_symbol, canned_ticker), setup=setup, rounds=5)
+    assert DB_TickerHistoryTS.objects(exchange_ticker=full_symbol).count() == len(canned_ticker.canned_history)
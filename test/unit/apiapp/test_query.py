@@ -0,0 +1,88 @@
+import re
+from datetime import datetime
+
+from api.news.models import DB_News
+from api.query_helper import build_query_from_url, query_plan_cache
+
+
+def build_query(args, doc_class=None, arguments=None):
+    """ Same as a call to /api/.../query?<args>, the arguments are the repeated values of the url """
+
+    if arguments is None:
+        arguments = {key: [value] for key, value in args.items()}
+
+    return build_query_from_url(dict(args), doc_class, arguments)
+
+
+def test_query_values():
+    assert build_query({'status': 'INDEXED'}) == {'status': 'INDEXED'}
+    assert build_query({'is_public': 'true'}) == {'is_public': True}
+    assert build_query({'is_public': 'false'}) == {'is_public': False}
+
+    # Every parameter is a condition of the $and
+    query = build_query({'status': 'INDEXED', 'source': 'YFINANCE'})
+    assert query == {'$and': [{'status': 'INDEXED'}, {'source': 'YFINANCE'}]}
+
+
+def test_query_operators():
+    assert build_query({'interest_score__gte': '5'}) == {'interest_score': {'$gte': 5.0}}
+    assert build_query({'interest_score__lt': '2.5'}) == {'interest_score': {'$lt': 2.5}}
+    assert build_query({'tags__size': '3'}) == {'tags': {'$size': 3}}
+
+    query = build_query({'title__icontains': 'nvda'})
+    assert query['title'].pattern == 'nvda'
+    assert query['title'].flags & re.IGNORECASE
+
+
+def test_query_null():
+    assert build_query({'ai_summary': 'NULL'}) == {'ai_summary': None}
+    assert build_query({'ai_summary__ne': 'NULL'}) == {'ai_summary': {'$ne': None}}
+
+
+def test_query_lists():
+    query = build_query({'related_exchange_tickers__in': 'NASDAQ:NVDA,NYSE:KO'})
+    assert query == {'related_exchange_tickers': {'$in': ['NASDAQ:NVDA', 'NYSE:KO']}}
+
+    query = build_query({'status__nin': 'CLOSED,DELIVERED'})
+    assert query == {'status': {'$nin': ['CLOSED', 'DELIVERED']}}
+
+    query = build_query({'status__not__in': 'CLOSED,DELIVERED'})
+    assert query == {'status': {'$not': {'$in': ['CLOSED', 'DELIVERED']}}}
+
+
+def test_query_or():
+    query = build_query({'status': 'INDEXED', 'or--source': 'YFINANCE'})
+    assert query == {'$or': [{'status': 'INDEXED'}, {'source': 'YFINANCE'}]}
+
+    # Repeated parameters are OR
+    query = build_query({'source': 'YFINANCE'}, arguments={'source': ['YFINANCE', 'ALPHA']})
+    assert query == {'$or': [{'source': 'YFINANCE'}, {'source': 'ALPHA'}]}
+
+
+def test_query_reserved():
+    args = {'status': 'INDEXED', 'order_by': '-creation_date', 'limit': '10', 'key': '1234', '_private': '1'}
+    assert build_query(args) == {'status': 'INDEXED'}
+
+    assert build_query({'limit': '10'}) == {}
+
+
+def test_query_dates():
+    query = build_query({'creation_date__gte': '7 days'}, DB_News)
+
+    assert isinstance(query['creation_date']['$gte'], datetime)
+    assert query['creation_date']['$gte'] < datetime.now()
+
+
+def test_query_plan_cache():
+    # The same names reuse the plan, only the values change
+    assert build_query({'publisher': 'Reuters', 'news_type': 'STORY'}, DB_News) == {
+        '$and': [{'publisher': 'Reuters'}, {'news_type': 'STORY'}]
+    }
+
+    assert build_query({'publisher': 'Bloomberg', 'news_type': 'VIDEO'}, DB_News) == {
+        '$and': [{'publisher': 'Bloomberg'}, {'news_type': 'VIDEO'}]
+    }
+
+    arguments = {'publisher': ['Reuters'], 'news_type': ['STORY']}
+    plan = query_plan_cache.get(DB_News, {'publisher': 'Reuters', 'news_type': 'STORY'}, arguments)
+    assert plan.hits >= 2
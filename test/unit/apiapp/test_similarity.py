@@ -0,0 +1,67 @@
+import random
+
+from api.media.similarity import BKTree, hamming_distance
+
+
+def test_hamming_distance():
+    assert hamming_distance(0, 0) == 0
+    assert hamming_distance(0b1011, 0b0001) == 2
+    assert hamming_distance(0, 0xFFFFFFFFFFFFFFFF) == 64
+
+
+def test_bktree_search():
+    #
+    # The tree has to return exactly what a linear search over every hash returns
+    #
+
+    rnd = random.Random(1234)
+
+    base = rnd.getrandbits(64)
+    hashes = {}
+    for i in range(500):
+        # Half of them close to the same picture, so the search has something to find
+        value = rnd.getrandbits(64)
+        if i % 2:
+            value = base
+            for bit in rnd.sample(range(64), rnd.randint(0, 12)):
+                value ^= 1 << bit
+
+        hashes["media_" + str(i)] = value
+
+    tree = BKTree()
+    for media_id, value in hashes.items():
+        tree.add(value, media_id)
+
+    assert tree.size == len(hashes)
+
+    for max_distance in [0, 4, 10, 20]:
+        expected = sorted((hamming_distance(base, value), media_id) for media_id, value in hashes.items()
+                          if hamming_distance(base, value) <= max_distance)
+
+        assert sorted(tree.search(base, max_distance)) == expected
+
+
+def test_bktree_same_hash():
+    tree = BKTree()
+    tree.add(0xFF, "a")
+    tree.add(0xFF, "b")
+    tree.add(0xFE, "c")
+
+    assert sorted(tree.search(0xFF, 0)) == [(0, "a"), (0, "b")]
+    assert sorted(tree.search(0xFF, 1)) == [(0, "a"), (0, "b"), (1, "c")]
+
+    assert BKTree().search(0xFF, 64) == []
+
+
+def test_bktree_remove():
+    tree = BKTree()
+    tree.add(0xFF, "a")
+    tree.add(0xFE, "b")
+    tree.add(0xFC, "c")
+
+    # "a" is the root, its children are still found
+    tree.remove(0xFF, "a")
+    tree.remove(0xFF, "missing")
+
+    assert tree.size == 2
+    assert sorted(tree.search(0xFF, 2)) == [(1, "b"), (2, "c")]
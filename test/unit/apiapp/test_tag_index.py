@@ -0,0 +1,68 @@
+import time
+
+from api.gif.tag_index import GifTagIndex
+
+
+def get_test_index():
+    """ An index with our own media, the refresh doesn't go to the database until the timers expire """
+
+    index = GifTagIndex()
+    index.last_refresh = time.time()
+    index.last_rebuild = time.time()
+    index.last_synonyms = time.time()
+
+    index.add("000000000000000000000001", ["Sad", "crying"])
+    index.add("000000000000000000000002", ["sad", "rain", "crying"])
+    index.add("000000000000000000000003", ["happy", "dance"])
+    index.add("000000000000000000000004", ["unhappy", "rain"])
+    index.add("000000000000000000000005", ["sad"])
+
+    index.synonyms = {'sad': {'unhappy'}, 'unhappy': {'sad'}}
+    return index
+
+
+def test_tag_index_match():
+    index = get_test_index()
+
+    # Best first, ties go to the newest media
+    result = index.match(["sad", "rain", "crying"], limit=3)
+    assert result == [(3, "000000000000000000000002"), (2, "000000000000000000000004"),
+                      (2, "000000000000000000000001")]
+
+    assert index.match(["dance"]) == [(1, "000000000000000000000003")]
+    assert index.match(["nothing"]) == []
+    assert index.match([" ", ""]) == []
+
+
+def test_tag_index_synonyms():
+    index = get_test_index()
+
+    media = [media_id for count, media_id in index.match(["sad"])]
+    assert "000000000000000000000004" in media
+    assert "000000000000000000000003" not in media
+
+
+def test_tag_index_match_all():
+    index = get_test_index()
+
+    result = index.match(["sad", "rain"], match_all=True)
+    assert result == [(2, "000000000000000000000004"), (2, "000000000000000000000002")]
+
+    assert index.match(["happy", "rain"], match_all=True) == []
+
+
+def test_tag_index_remove():
+    index = get_test_index()
+    index.update("000000000000000000000002", None)
+
+    assert index.get_tags("000000000000000000000002") == []
+    assert index.match(["crying"]) == [(1, "000000000000000000000001")]
+
+
+def test_tag_index_retag():
+    index = get_test_index()
+    index.update("000000000000000000000003", ["Sad"])
+
+    assert index.get_tags("000000000000000000000003") == ["sad"]
+    assert index.match(["dance"]) == []
+    assert (1, "000000000000000000000003") in index.match(["sad"])
@@ -0,0 +1,64 @@
+from api.user.models import User
+from api.user.token_cache import VerifiedTokenCache, verified_token_cache
+from imgapi_launcher import app
+
+from test.unit.apiapp import client
+
+
+def test_token_cache_entries():
+    cache = VerifiedTokenCache()
+
+    cache.set("token_a", {'username': "user_a"})
+    cache.set("token_b", {'username': "user_a"})
+    cache.set("token_c", {'username': "user_c"})
+
+    assert cache.get("token_a")['username'] == "user_a"
+
+    cache.invalidate("user_a")
+    assert cache.get("token_a") is None
+    assert cache.get("token_b") is None
+    assert cache.get("token_c")['username'] == "user_c"
+
+    # Expired entries are not returned
+    cache.set("token_d", {'username': "user_d"}, ttl=-1)
+    assert cache.get("token_d") is None
+
+
+def test_token_cache_invalidation(client):
+
+    TEST_CREDENTIALS = "username=token_cache_test&email=token_cache_test@engineer.blue&password=test1234test"
+
+    # Delete the user in case we have it already there.
+    client.get("/api/user/remove?" + TEST_CREDENTIALS)
+
+    ret = client.get("/api/user/create?" + TEST_CREDENTIALS)
+    assert ret.json['status'] == 'success'
+
+    ret = client.get("/api/user/login?" + TEST_CREDENTIALS)
+    assert ret.json['status'] == 'success'
+
+    user_token = ret.json['token']
+
+    # A call with the key verifies it and keeps it on the cache
+    ret = client.get("/api/user/token?key=" + user_token)
+    assert ret.json['status'] == 'success'
+    assert verified_token_cache.get(user_token)['username'] == "token_cache_test"
+
+    # Saving the user drops its keys
+    with app.app_context():
+        user = User.objects(username="token_cache_test").first()
+        user.save()
+
+    assert verified_token_cache.get(user_token) is None
+
+    ret = client.get("/api/user/token?key=" + user_token)
+    assert ret.json['status'] == 'success'
+    assert verified_token_cache.get(user_token)
+
+    # Deleting the user drops them too, the key is not valid anymore
+    ret = client.get("/api/user/remove?key=" + user_token)
+    assert ret.json['status'] == 'success'
+    assert verified_token_cache.get(user_token) is None
+
+    ret = client.get("/api/user/token?key=" + user_token)
+    assert ret.json['status'] != 'success'